@@ -0,0 +1,3 @@
+"""
+Benchmark suite of the dicom package: synthetic corpora and timing runner.
+"""
@@ -0,0 +1,161 @@
+"""
+Generator of synthetic DICOM corpora for the benchmarks.
+
+The files are uncompressed (Explicit VR Little Endian) ultrasound images with
+random but reproducible pixels: the same seed always produces the same
+bytes, so timings taken on different versions use identical inputs.
+
+Usage:
+    python -m benchmarks.corpus OUT_DIR --patients 4 --files 10 --bits 16
+    python -m benchmarks.corpus OUT_DIR --patients 1 --files 2 --frames 120
+"""
+
+# Standard library
+import argparse
+from pathlib import Path
+
+# Third-party packages
+import numpy as np
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+US_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.6.1"
+US_MULTIFRAME_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.3.1"
+
+# Fixed prefix, so that the UIDs depend only on the seed
+UID_PREFIX = "1.2.826.0.1.3680043.10.1234."
+
+
+# pylint: disable-next=too-many-arguments
+def synthetic_pixels(rows: int, cols: int, bits: int = 8, frames: int = 1,
+                     seed: int = 0):
+    """
+    Returns reproducible pixels: a moving gradient with noise.
+
+    Parameters:
+    rows, cols: size of each frame.
+    bits: 8 or 16 bits per pixel.
+    frames: number of frames; with more than one the shape is (frames, rows, cols).
+
+    Returns:
+    numpy.ndarray: uint8 or uint16 pixels.
+    """
+    if bits not in (8, 16):
+        raise ValueError("Invalid bits: expected 8 or 16.")
+    rng = np.random.default_rng(seed)
+    high = (1 << (12 if bits == 16 else 8)) - 1
+    ramp = np.add.outer(np.arange(rows), np.arange(cols)) * (high / max(rows + cols - 2, 1))
+    dtype = np.uint16 if bits == 16 else np.uint8
+
+    pixels = np.empty((frames, rows, cols), dtype=dtype)
+    for i in range(frames):
+        noise = rng.normal(0, high * 0.05, (rows, cols))
+        frame = np.roll(ramp, i * 4, axis=1) + noise
+        pixels[i] = np.clip(frame, 0, high).astype(dtype)
+    return pixels if frames > 1 else pixels[0]
+
+
+# pylint: disable-next=too-many-arguments
+def make_dataset(path: Path, pixels, patient: str = "Synthetic^Patient",
+                 patient_id: str = "000000", frame_time: float = 40.0,
+                 seed: int = 0) -> FileDataset:
+    """
+    Builds a DICOM dataset holding the given pixels.
+
+    Parameters:
+    path: file name stored in the dataset.
+    pixels: (rows, cols) or (frames, rows, cols) uint8/uint16 array.
+    frame_time: FrameTime of the multi-frame files, in milliseconds.
+    seed: used to derive reproducible UIDs.
+    """
+    multi_frame = pixels.ndim == 3
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = (US_MULTIFRAME_IMAGE_STORAGE if multi_frame
+                                         else US_IMAGE_STORAGE)
+    file_meta.MediaStorageSOPInstanceUID = generate_uid(UID_PREFIX, [patient_id, str(seed)])
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(str(path), {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid(UID_PREFIX, [patient_id, "study"])
+    ds.SeriesInstanceUID = generate_uid(UID_PREFIX, [patient_id, "series"])
+    ds.PatientName = patient
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.PatientIdentityRemoved = "NO"
+    ds.Modality = "US"
+    ds.InstanceNumber = seed + 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.Rows, ds.Columns = pixels.shape[-2:]
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = 12 if ds.BitsAllocated == 16 else 8
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 0
+    if multi_frame:
+        ds.NumberOfFrames = pixels.shape[0]
+        ds.FrameTime = frame_time
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+# pylint: disable-next=too-many-arguments
+def write_file(path: Path, rows: int = 512, cols: int = 512, bits: int = 8,
+               frames: int = 1, seed: int = 0, **kwargs) -> Path:
+    """
+    Writes a single synthetic DICOM file and returns its path.
+    """
+    path = Path(path)
+    pixels = synthetic_pixels(rows, cols, bits, frames, seed)
+    make_dataset(path, pixels, seed=seed, **kwargs).save_as(str(path), write_like_original=False)
+    return path
+
+
+# pylint: disable-next=too-many-arguments
+def make_tree(root: Path, patients: int = 2, files: int = 5, rows: int = 512,
+              cols: int = 512, bits: int = 8, frames: int = 1, seed: int = 0) -> list:
+    """
+    Writes a tree root/PazienteN/DICOM/K.dcm of patients x files synthetic files.
+
+    Returns:
+    list: Paths of the written files.
+    """
+    written = []
+    for p in range(patients):
+        folder = Path(root) / f"Paziente{p + 1}" / "DICOM"
+        folder.mkdir(parents=True, exist_ok=True)
+        for f in range(files):
+            written.append(write_file(folder / f"1-{f + 1}.dcm", rows, cols, bits, frames,
+                                      seed=seed + p * files + f,
+                                      patient=f"Synthetic^Patient{p + 1}",
+                                      patient_id=f"{p + 1:06d}"))
+    return written
+
+
+def setup_parser() -> argparse.Namespace:
+    """
+    Parses the command line of the corpus generator.
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic DICOM corpus")
+    parser.add_argument("root", type=Path, help="Directory where the tree is written")
+    parser.add_argument("--patients", type=int, default=2, help="Number of patients (default: 2)")
+    parser.add_argument("--files", type=int, default=5, help="Files per patient (default: 5)")
+    parser.add_argument("--rows", type=int, default=512, help="Rows per frame (default: 512)")
+    parser.add_argument("--cols", type=int, default=512, help="Columns per frame (default: 512)")
+    parser.add_argument("--bits", type=int, choices=[8, 16], default=8,
+                        help="Bits per pixel (default: 8)")
+    parser.add_argument("--frames", type=int, default=1,
+                        help="Frames per file; more than one writes cines (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = setup_parser()
+    paths = make_tree(args.root, args.patients, args.files, args.rows, args.cols,
+                      args.bits, args.frames, args.seed)
+    print(f"{len(paths)} files written in {args.root}")
@@ -0,0 +1,282 @@
+"""
+Timing runner of the benchmark suite.
+
+A synthetic corpus is generated in a temporary directory (see corpus.py),
+then every case is run ``--repeat`` times and the wall times are saved to a
+JSON file together with the environment. Cases:
+
+- ``cli-*``: the ``dicom`` command in a new interpreter, end to end;
+- ``processing-*``: ``DICOM.processing`` in process, on 8/16-bit trees,
+  cines and the header-only path;
+- ``stages-*``: the read, render and write stages of processing, timed
+  one file at a time, summed over the corpus;
+- ``cine-*``: encoding of a cine as GIF, MP4 and animated WebP, with the
+  size of the output;
+- ``compare-*``: exact and fast SSIM of two rendered images;
+- ``acquire-*``: single-frame and continuous capture from a synthetic video.
+
+Usage:
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --quick --baseline old.json
+"""
+
+# Standard library
+import argparse
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+
+# Third-party packages
+import cv2
+import numpy as np
+
+# Local modules
+from dicom import capture, dicom, similarity
+from benchmarks import corpus
+
+SIZES = {
+    "full": {"patients": 4, "files": 8, "rows": 512, "cols": 512, "frames": 60, "video": 120},
+    "quick": {"patients": 2, "files": 2, "rows": 256, "cols": 256, "frames": 10, "video": 20},
+}
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """
+    Runs func ``repeat`` times and returns its wall times in seconds.
+
+    ``setup`` is run before every call and is not timed.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"times": times, "min": min(times), "median": statistics.median(times)}
+
+
+def cli(*args) -> None:
+    """
+    Runs the dicom command line in a new interpreter.
+    """
+    code = "import sys, dicom; sys.argv = ['dicom'] + sys.argv[1:]; dicom.main()"
+    subprocess.run([sys.executable, "-c", code, "--verbosity", "WARNING", *args], check=True)
+
+
+def stages(root: Path, repeat: int, **options) -> dict:
+    """
+    Times the read, render and write stages of processing on every file.
+
+    Each stage is run on one file at a time, so the times do not overlap.
+    """
+    processor = dicom.DICOM(root, False, force=True, **options)
+    jobs = processor._collect_files() # pylint: disable=protected-access
+    totals = {"read": [], "render": [], "write": []}
+    for _ in range(repeat):
+        elapsed = dict.fromkeys(totals, 0.0)
+        for job in jobs:
+            start = time.perf_counter()
+            data = processor._read(job) # pylint: disable=protected-access
+            elapsed["read"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            tasks = processor._render(job, data) # pylint: disable=protected-access
+            elapsed["render"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            for task in tasks:
+                processor._write(task) # pylint: disable=protected-access
+            elapsed["write"] += time.perf_counter() - start
+        for name, value in elapsed.items():
+            totals[name].append(value)
+    return {name: {"times": times, "min": min(times), "median": statistics.median(times)}
+            for name, times in totals.items()}
+
+
+def cine(frames, repeat: int, frame_time: float = 40.0) -> dict:
+    """
+    Times the cine encoders of processing on the same uint8 frames.
+
+    Returns:
+    dict: Timings of each format, with the size in bytes of its output.
+    """
+    encoders = {"gif": dicom.DICOM._dicom_to_gif, # pylint: disable=protected-access
+                "mp4": dicom.DICOM._dicom_to_mp4, # pylint: disable=protected-access
+                "webp": dicom.DICOM._dicom_to_webp} # pylint: disable=protected-access
+    results = {}
+    for name, encoder in encoders.items():
+        buffer = io.BytesIO()
+
+        def encode(encoder=encoder, buffer=buffer):
+            buffer.seek(0)
+            buffer.truncate()
+            encoder(iter(frames), frame_time, buffer)
+
+        results[name] = measure(encode, repeat)
+        results[name]["bytes"] = len(buffer.getvalue())
+    return results
+
+
+def write_video(path: Path, frames: int, size: tuple) -> Path:
+    """
+    Writes a synthetic MJPG video of moving gradients.
+    """
+    # pylint: disable-next=c-extension-no-member
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 25, size)
+    for frame in corpus.synthetic_pixels(size[1], size[0], 8, frames, seed=1):
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)) # pylint: disable=c-extension-no-member
+    writer.release()
+    return path
+
+
+# pylint: disable-next=too-many-locals
+def run(work: Path, size: dict, repeat: int, only: list = None) -> dict:
+    """
+    Generates the corpora in ``work`` and runs every case.
+
+    Returns:
+    dict: Timings of each case, keyed by case name.
+    """
+    def selected(name):
+        return not only or any(name.startswith(prefix) for prefix in only)
+
+    shape = {"rows": size["rows"], "cols": size["cols"]}
+    trees = {
+        "8bit": corpus.make_tree(work / "8bit", size["patients"], size["files"], bits=8, **shape),
+        "16bit": corpus.make_tree(work / "16bit", size["patients"], size["files"], bits=16, **shape),
+        "cine": corpus.make_tree(work / "cine", 1, 2, bits=8, frames=size["frames"], **shape),
+    }
+    results = {}
+
+    def case(name, func, setup=None):
+        if selected(name):
+            print(f"{name}...", file=sys.stderr)
+            results[name] = measure(func, repeat, setup)
+
+    for tree in trees:
+        root = work / tree
+        case(f"cli-processing-{tree}",
+             lambda root=root: cli("processing", "--dicom_dir", str(root), "--force"))
+        case(f"processing-{tree}",
+             lambda root=root: dicom.DICOM(root, True, force=True).processing())
+        if selected(f"stages-{tree}"):
+            print(f"stages-{tree}...", file=sys.stderr)
+            results[f"stages-{tree}"] = stages(root, repeat)
+    case("processing-header", lambda: dicom.DICOM(work / "16bit", True, force=True,
+                                                 formats=("txt",)).processing())
+    for cine_format in ("gif", "mp4", "webp"):
+        case(f"processing-cine-{cine_format}",
+             lambda cine_format=cine_format: dicom.DICOM(work / "cine", False, force=True,
+                                                         formats=(cine_format,)).processing())
+    if selected("cine"):
+        print("cine...", file=sys.stderr)
+        frames = corpus.synthetic_pixels(size["rows"], size["cols"], 8, size["frames"], seed=3)
+        results["cine"] = cine(frames, repeat)
+
+    image1, image2 = work / "image1.png", work / "image2.png"
+    pixels = corpus.synthetic_pixels(size["rows"] * 2, size["cols"] * 2, 8, 2, seed=2)
+    cv2.imwrite(str(image1), pixels[0]) # pylint: disable=c-extension-no-member
+    cv2.imwrite(str(image2), pixels[1]) # pylint: disable=c-extension-no-member
+    case("cli-compare", lambda: cli("compare", "--image1", str(image1), "--image2", str(image2)))
+    case("compare-exact", lambda: dicom.compare_image(image1, image2))
+    gray1, gray2 = pixels[0], pixels[1]
+    case("compare-fast", lambda: similarity.fast_ssim(gray1, gray2, max_side=512))
+    case("compare-fast-threshold",
+         lambda: similarity.fast_ssim(gray1, gray2, max_side=512, threshold=0.95))
+
+    video = write_video(work / "video.avi", size["video"], (size["cols"], size["rows"]))
+    case("cli-acquire", lambda: cli("acquire", "--video", str(video),
+                                    "--output", str(work / "frame.png")))
+    case("acquire-frame", lambda: dicom.acquire(str(video), work / "frame.png"))
+    case("acquire-sequence", lambda: capture.acquire_sequence(str(video), work / "frames",
+                                                              frames=size["video"]))
+    return results
+
+
+def environment() -> dict:
+    """
+    Returns the versions and machine the benchmarks ran on.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "dicom": metadata.version("dicom"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__, # pylint: disable=no-member
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def compare_results(results: dict, baseline: dict) -> list:
+    """
+    Returns the ratio current/baseline of the median of every common case.
+    """
+    def flatten(cases):
+        flat = {}
+        for name, value in cases.items():
+            if "median" in value:
+                flat[name] = value["median"]
+            else:
+                flat.update({f"{name}.{stage}": v["median"] for stage, v in value.items()})
+        return flat
+
+    current, previous = flatten(results), flatten(baseline)
+    return [(name, previous[name], current[name], current[name] / previous[name])
+            for name in sorted(current.keys() & previous.keys()) if previous[name] > 0]
+
+
+def setup_parser() -> argparse.Namespace:
+    """
+    Parses the command line of the benchmark runner.
+    """
+    parser = argparse.ArgumentParser(description="Run the dicom benchmarks")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"),
+                        help="JSON file where the results are saved")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case (default: 3)")
+    parser.add_argument("--quick", action="store_true", help="Use a small corpus")
+    parser.add_argument("--only", nargs="+", help="Run only the cases with these prefixes")
+    parser.add_argument("--baseline", type=Path,
+                        help="Results of a previous version to compare with")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """
+    Runs the benchmarks, saves the results and compares them with a baseline.
+    """
+    args = setup_parser()
+    size = SIZES["quick" if args.quick else "full"]
+    with tempfile.TemporaryDirectory(prefix="dicom-bench-") as work:
+        results = run(Path(work), size, args.repeat, args.only)
+
+    report = {"environment": environment(), "corpus": size, "repeat": args.repeat,
+              "results": results}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved in {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        for name, before, after, ratio in compare_results(results, baseline):
+            print(f"{name:40s} {before:9.4f}s {after:9.4f}s  x{ratio:.2f}")
+
+
+if __name__ == "__main__":
+    main()
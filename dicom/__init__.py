@@ -3,6 +3,7 @@ This module permited to create the package of the app dicom
 """
 
 from . import dicom
+from .api import anonymize, encode, iter_frames, iter_tree, load, ssim, to_array
 
 def main():
     """
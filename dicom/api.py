@@ -0,0 +1,238 @@
+"""
+In-memory API: DICOM data in, arrays or encoded bytes out, no files written.
+
+- ``load`` reads a dataset from bytes, a binary file-like object or a path;
+- ``to_array`` and ``iter_frames`` return the pixels mapped to uint8;
+- ``encode`` returns PNG, JPG, GIF, MP4 or WebP bytes;
+- ``anonymize`` returns the anonymized file as bytes;
+- ``ssim`` compares two arrays;
+- ``iter_tree`` walks a directory and yields the results one file at a time.
+
+Every function accepts either a dataset or anything ``load`` accepts, and
+uses the same rendering as the ``processing`` subcommand.
+
+Example
+-------
+    import dicom
+    ds = dicom.load(request_body)
+    png = dicom.encode(ds, "png")
+    anonymous = dicom.anonymize(ds)
+"""
+
+# Standard library
+import io
+import os
+from typing import NamedTuple
+
+# Local modules
+from .dicom import DICOM, RenderContext
+from .discovery import iter_directories
+
+# The third-party packages are imported by the functions that use them, as
+# in dicom.py, so that ``import dicom`` stays fast.
+# pylint: disable=import-outside-toplevel,protected-access
+
+ENCODINGS = ("png", "jpg", "gif", "mp4", "webp")
+CINE_ENCODERS = {"gif": DICOM._dicom_to_gif, "mp4": DICOM._dicom_to_mp4,
+                 "webp": DICOM._dicom_to_webp}
+
+
+class Result(NamedTuple):
+    """
+    Item yielded by ``iter_tree``.
+
+    ``image`` is the uint8 array (None if not requested), ``encoded`` maps
+    each requested format to its bytes, ``error`` is set when the file could
+    not be read or rendered.
+    """
+    path: str
+    dataset: object = None
+    image: object = None
+    encoded: dict = None
+    error: Exception = None
+
+
+def load(source, stop_before_pixels: bool = False):
+    """
+    Reads a DICOM dataset.
+
+    Parameters:
+    source: bytes-like object, binary file-like object, path, or an
+        already loaded pydicom Dataset (returned as is).
+    stop_before_pixels: if True, the pixel data is not read.
+
+    Returns:
+    pydicom.Dataset: The dataset.
+    """
+    import pydicom
+
+    if isinstance(source, pydicom.Dataset):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return pydicom.dcmread(source, stop_before_pixels=stop_before_pixels)
+
+
+def _context(source, strategy: str, percentiles: tuple) -> RenderContext:
+    return RenderContext(load(source), strategy, percentiles)
+
+
+def to_array(source, strategy: str = "minmax", percentiles: tuple = (0.5, 99.5)):
+    """
+    Returns the pixels mapped to uint8, shape (H, W[, 3]) or (N, H, W[, 3]).
+
+    Parameters:
+    source: dataset or anything accepted by ``load``.
+    strategy: intensity mapping, one of intensity.STRATEGIES.
+    percentiles: percentiles of the "percentile" strategy.
+    """
+    return _context(source, strategy, percentiles).image
+
+
+def iter_frames(source, strategy: str = "minmax", percentiles: tuple = (0.5, 99.5)):
+    """
+    Yields the frames mapped to uint8 one at a time.
+
+    Only one mapped frame is in memory at a time; a single-frame image
+    yields one frame.
+    """
+    yield from _context(source, strategy, percentiles).frames()
+
+
+def _encode(context: RenderContext, image_format: str) -> bytes:
+    """
+    Encodes the pixels of a render context.
+    """
+    buffer = io.BytesIO()
+    if context.multi_frame:
+        CINE_ENCODERS.get(image_format, DICOM._dicom_to_gif)(
+            context.frames(), context.frame_time, buffer)
+    elif image_format in CINE_ENCODERS:
+        CINE_ENCODERS[image_format]([context.image], 100, buffer)
+    elif image_format == "png":
+        DICOM._dicom_to_png(context.image, buffer)
+    else:
+        DICOM._dicom_to_jpg(context.image, buffer)
+    return buffer.getvalue()
+
+
+def encode(source, image_format: str = "png", strategy: str = "minmax",
+           percentiles: tuple = (0.5, 99.5)) -> bytes:
+    """
+    Renders a dataset or a uint8 array and returns the encoded image.
+
+    Parameters:
+    source: uint8 numpy array, dataset or anything accepted by ``load``.
+    image_format: "png", "jpg", "gif", "mp4" or "webp". A multi-frame
+        dataset or a (N, H, W[, 3]) array is encoded as an MP4 or animated
+        WebP if requested, as an animated GIF otherwise; its frame duration
+        is the FrameTime of the dataset (100 ms for arrays).
+
+    Returns:
+    bytes: The encoded image.
+    """
+    import numpy as np
+
+    if image_format not in ENCODINGS:
+        raise ValueError(f"Invalid format: expected one of {ENCODINGS}.")
+    if not isinstance(source, np.ndarray):
+        return _encode(_context(source, strategy, percentiles), image_format)
+
+    buffer = io.BytesIO()
+    if source.ndim == 4 or (source.ndim == 3 and source.shape[-1] not in (3, 4)):
+        CINE_ENCODERS.get(image_format, DICOM._dicom_to_gif)(source, 100, buffer)
+    elif image_format in CINE_ENCODERS:
+        CINE_ENCODERS[image_format]([source], 100, buffer)
+    elif image_format == "png":
+        DICOM._dicom_to_png(source, buffer)
+    else:
+        DICOM._dicom_to_jpg(source, buffer)
+    return buffer.getvalue()
+
+
+def anonymize(source) -> bytes:
+    """
+    Returns the anonymized DICOM file as bytes.
+
+    The patient data is replaced as in ``processing --anonymous``; the pixel
+    data is copied without being decoded. A dataset passed in is modified.
+    """
+    ds = load(source)
+    DICOM._anonymize(ds)
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    return buffer.getvalue()
+
+
+def ssim(image1, image2, fast: bool = False, **options) -> float:
+    """
+    Computes the Structural Similarity Index of two arrays.
+
+    Parameters:
+    image1, image2: arrays with the same shape; RGB arrays are converted to
+        grayscale first.
+    fast: if True, uses similarity.fast_ssim with ``options`` (max_side,
+        tile); otherwise the exact SSIM, as compare_image.
+
+    Returns:
+    float: The SSIM, 1.0 for identical images.
+    """
+    import cv2
+
+    def gray(image):
+        if image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) # pylint: disable=c-extension-no-member
+        return image
+
+    image1, image2 = gray(image1), gray(image2)
+    if image1.shape != image2.shape:
+        raise ValueError(f"different sizes {image1.shape} and {image2.shape}")
+    if fast:
+        from .similarity import fast_ssim
+        return fast_ssim(image1, image2, **options).score
+
+    from skimage.metrics import structural_similarity
+    return float(structural_similarity(image1, image2))
+
+
+# pylint: disable-next=too-many-arguments
+def iter_tree(root, image: bool = True, formats: tuple = (), anonymous: bool = False,
+              strategy: str = "minmax", percentiles: tuple = (0.5, 99.5)):
+    """
+    Walks a directory and yields a Result for every DICOM file (recognized by
+    suffix or content, see discovery), lazily and in path order.
+
+    Each file is read and rendered only when the caller asks for the next
+    result, and nothing is written to disk; the ``OUTPUT`` directories of
+    previous runs are skipped.
+
+    Parameters:
+    root: directory to walk.
+    image: if True, every Result carries the uint8 array.
+    formats: encodings returned in Result.encoded, e.g. ("png",).
+    anonymous: if True, the dataset is anonymized (and "dcm" in formats
+        returns the anonymized file).
+    """
+    for cartella, files in iter_directories(root, workers=1):
+        for file in files:
+            path = os.path.join(cartella, file)
+            try:
+                ds = load(path)
+                if anonymous:
+                    DICOM._anonymize(ds)
+                context = RenderContext(ds, strategy, percentiles)
+                array = context.image if image else None
+                encoded = {}
+                for image_format in formats:
+                    if image_format == "dcm":
+                        buffer = io.BytesIO()
+                        ds.save_as(buffer)
+                        encoded["dcm"] = buffer.getvalue()
+                    elif image_format in ENCODINGS:
+                        encoded[image_format] = _encode(context, image_format)
+                    else:
+                        raise ValueError(f"Invalid format: expected one of {ENCODINGS} or dcm.")
+                result = Result(path, ds, array, encoded)
+            except Exception as e: # pylint: disable=broad-exception-caught
+                result = Result(path, error=e)
+            yield result
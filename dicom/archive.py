@@ -0,0 +1,174 @@
+"""
+Archive sink: the outputs of a run streamed into zip or tar files.
+
+Instead of several small files per image, every output (rendered images,
+text dumps, anonymized copies) becomes a member of one archive per run or
+one archive per patient folder, i.e. per first-level folder of the input
+tree. The member names are the output paths relative to the output
+directory, so extracting the archives reproduces the tree that processing
+would write.
+
+An archive is written under a temporary name and renamed when it is
+closed, so a run that fails does not leave a partial archive in place of
+the previous one. Images are stored as they are, text and DICOM files are
+deflated in zip archives.
+"""
+
+# Standard library
+import io
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+FORMATS = ("zip", "tar")
+GROUPS = ("run", "patient")
+
+# Name of the archive of a whole run and of the files outside patient folders
+RUN_NAME = "OUTPUT"
+
+# Outputs already compressed, stored without deflating them again
+STORED = (".png", ".jpg", ".gif")
+
+
+class ArchiveSink():
+    """
+    Writer of the outputs of a run into archives.
+
+    A copy sent to another process (e.g. pickled to a process pool) has no
+    archive: its members are taken back with ``take`` and written with
+    ``extend``.
+
+    Parameters
+    ----------
+    directory : str
+        Base directory of the outputs: the archives are written in it and
+        the member names are relative to it.
+    archive_format : str
+        "zip" or "tar".
+    group : str
+        "run" (one archive) or "patient" (one archive per first-level folder).
+    max_open : int
+        Archives kept open at the same time; the least recently used one is
+        closed and reopened in append mode when needed again.
+    """
+    def __init__(self, directory, archive_format: str = "zip", group: str = "run",
+                 max_open: int = 32) -> None:
+        if archive_format not in FORMATS:
+            raise ValueError(f"Invalid archive format: expected one of {FORMATS}.")
+        if group not in GROUPS:
+            raise ValueError(f"Invalid archive group: expected one of {GROUPS}.")
+        self.directory = directory
+        self.archive_format = archive_format
+        self.group = group
+        self.max_open = max_open
+        self.paths = []
+        self._members = []
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {"archive_format": self.archive_format, "group": self.group}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(None, state["archive_format"], state["group"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.close(commit=exc_type is None)
+
+    def _locate(self, path: str) -> tuple:
+        """
+        Returns the archive name and the member name of an output path.
+        """
+        member = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        if member.startswith("../"):
+            raise ValueError(f"Invalid output {path}: expected a path inside {self.directory}")
+        if self.group == "patient" and "/" in member:
+            name, member = member.split("/", 1)
+            return name, member
+        return RUN_NAME, member
+
+    def _archive(self, name: str):
+        """
+        Returns the open archive ``name``, opening it if needed.
+        """
+        if name in self._open:
+            self._open.move_to_end(name)
+            return self._open[name]
+        if len(self._open) >= self.max_open:
+            _, archive = self._open.popitem(last=False)
+            archive.close()
+
+        path = os.path.join(self.directory, f"{name}.{self.archive_format}")
+        tmp_path = path + ".tmp"
+        mode = "a" if path in self.paths else "w"
+        if mode == "w":
+            os.makedirs(self.directory, exist_ok=True)
+            self.paths.append(path)
+        if self.archive_format == "zip":
+            archive = zipfile.ZipFile(tmp_path, mode) # pylint: disable=consider-using-with
+        else:
+            archive = tarfile.open(tmp_path, mode) # pylint: disable=consider-using-with
+        self._open[name] = archive
+        return archive
+
+    def _write_member(self, path: str, data: bytes) -> None:
+        name, member = self._locate(path)
+        archive = self._archive(name)
+        if self.archive_format == "zip":
+            compression = (zipfile.ZIP_STORED if os.path.splitext(member)[1].lower() in STORED
+                           else zipfile.ZIP_DEFLATED)
+            archive.writestr(member, data, compress_type=compression)
+        else:
+            info = tarfile.TarInfo(member)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+
+    def add(self, path: str, data: bytes) -> None:
+        """
+        Writes an output, given by the path it would have on disk.
+        """
+        self.extend([(str(path), data)])
+
+    def extend(self, members: list) -> None:
+        """
+        Writes (path, data) pairs, or buffers them in a copy without archive.
+        """
+        with self._lock:
+            if self.directory is None:
+                self._members.extend(members)
+                return
+            for path, data in members:
+                self._write_member(path, data)
+
+    def take(self) -> list:
+        """
+        Returns and forgets the buffered members.
+        """
+        with self._lock:
+            members, self._members = self._members, []
+        return members
+
+    def close(self, commit: bool = True) -> None:
+        """
+        Closes the archives and moves them to their final names.
+
+        With ``commit`` False (a failed or interrupted run) the temporary
+        archives are deleted instead and the previous ones are left in place.
+        """
+        with self._lock:
+            while self._open:
+                _, archive = self._open.popitem(last=False)
+                archive.close()
+            for path in self.paths:
+                if commit:
+                    os.replace(path + ".tmp", path)
+                elif os.path.exists(path + ".tmp"):
+                    os.remove(path + ".tmp")
+            self.paths = []
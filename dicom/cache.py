@@ -0,0 +1,261 @@
+"""
+Content-addressed cache of the encoded image outputs.
+
+Archives often hold the same pixel data many times: images exported again
+under another patient or folder, anonymized re-imports. The key of an
+output is the BLAKE2 digest of the Pixel Data bytes, of every element of the
+Image Pixel group (0028,xxxx: size, bit depth, photometric interpretation,
+rescale, window, LUTs), of the Frame Time and of the rendering options, so
+two files share their encodes exactly when they would render identically.
+
+The encodes are stored as ``<directory>/<key[:2]>/<key>.<format>``. On a hit
+the output is hard-linked to the entry (or copied, across file systems),
+without decoding the pixels or encoding the image again. The cache is
+bounded by ``max_bytes``: when it is exceeded the least recently used
+entries, by access time, are removed until it is below ``LOW_WATERMARK`` of
+the bound. An entry is only ever replaced by a rename and an output is
+unlinked before it is written again, so a linked output never changes
+under the cache or vice versa. Several processes can share a cache.
+"""
+
+# Standard library
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import BinaryIO, NamedTuple
+
+# Bumped when the rendering changes, so that older encodes are not reused
+VERSION = 1
+
+# Fraction of max_bytes the cache is trimmed to when it exceeds it
+LOW_WATERMARK = 0.9
+
+# Total size of the entries of every cache directory used by this process, scanned when
+# first needed and shared by the copies of a RenderCache sent to the same worker process
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+class Hit(NamedTuple):
+    """
+    Cached encode of an output, opened so that it survives an eviction.
+    """
+    entry: str
+    file: BinaryIO
+
+
+class Miss(NamedTuple):
+    """
+    Output to encode with ``payload`` and then store under ``key``.
+    """
+    key: str
+    fmt: str
+    payload: object
+
+
+def parse_size(value: str) -> int:
+    """
+    Parses a size in bytes with an optional K, M, G or T suffix, e.g. "20G".
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    text = value.strip().upper().removesuffix("B")
+    try:
+        size = int(float(text[:-1]) * units[text[-1]]) if text[-1:] in units else int(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}: expected e.g. 500M or 20G") from e
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}: expected a positive size")
+    return size
+
+
+class RenderCache():
+    """
+    Size-bounded cache of encoded outputs, keyed by content.
+
+    A copy sent to another process (e.g. pickled to a process pool) uses the
+    same directory and bound and starts with empty ``stats``, which are sent
+    back and added with ``merge``. The total size of the entries is scanned
+    once per process, not once per copy.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the cache, created if needed.
+    max_bytes : int
+        Bound of the total size of the entries.
+    """
+    def __init__(self, directory, max_bytes: int = 10 << 30) -> None:
+        if max_bytes <= 0:
+            raise ValueError("Invalid max_bytes: expected a positive size.")
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        return {"directory": self.directory, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["directory"], state["max_bytes"])
+
+    def merge(self, stats: dict) -> None:
+        """
+        Adds the stats collected by another copy of the cache.
+        """
+        with self._lock:
+            for name, count in stats.items():
+                self.stats[name] += count
+
+    @staticmethod
+    def key(ds, options: dict) -> str:
+        """
+        Returns the key of the rendering of a dataset with the given options.
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps({"version": VERSION, "options": options},
+                                 sort_keys=True).encode("utf-8"))
+        digest.update(str(ds.file_meta.get("TransferSyntaxUID", "")).encode("utf-8"))
+        for element in ds.group_dataset(0x0028):
+            digest.update(f"{element.tag}={element.value!r};".encode("utf-8"))
+        digest.update(f"{ds.get((0x0018, 0x1063))!r};".encode("utf-8")) # Frame Time
+        digest.update(ds.PixelData)
+        return digest.hexdigest()
+
+    def entry(self, key: str, fmt: str) -> str:
+        """
+        Returns the path of the encode of ``key`` in format ``fmt``.
+        """
+        return os.path.join(self.directory, key[:2], f"{key}.{fmt}")
+
+    def lookup(self, key: str, fmt: str):
+        """
+        Returns the Hit of an encode, or None, and marks it as recently used.
+        """
+        entry = self.entry(key, fmt)
+        try:
+            file = open(entry, "rb") # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        try:
+            os.utime(entry, ns=(time.time_ns(), os.fstat(file.fileno()).st_mtime_ns))
+        except OSError:
+            pass # evicted meanwhile: the open file is still readable
+        with self._lock:
+            self.stats["hits"] += 1
+        return Hit(entry, file)
+
+    @staticmethod
+    def restore(hit: Hit, path: str) -> int:
+        """
+        Writes a cached encode to ``path``, as a hard link when possible.
+
+        Returns:
+        int: Bytes copied, 0 for a link.
+        """
+        with hit.file:
+            try:
+                os.link(hit.entry, path)
+                return 0
+            except OSError:
+                # Evicted since the lookup, another file system or too many links
+                with open(path, "wb") as f:
+                    shutil.copyfileobj(hit.file, f, 1 << 20)
+                    return f.tell()
+
+    def store(self, key: str, fmt: str, path: str = None, data: bytes = None) -> None:
+        """
+        Adds the encode written at ``path`` (linked or copied), or ``data``.
+
+        A failure is logged: the output itself is already written.
+        """
+        entry = self.entry(key, fmt)
+        tmp_path = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            if data is not None:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+            else:
+                try:
+                    os.link(path, tmp_path)
+                except OSError:
+                    shutil.copyfile(path, tmp_path)
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(entry) # an entry written again is replaced
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, entry)
+        except OSError as e:
+            logging.warning("Impossibile salvare %s nella cache: %s", path or entry, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self.stats["stored"] += 1
+        with _sizes_lock:
+            if self.directory not in _sizes:
+                _sizes[self.directory] = sum(entry[2] for entry in self._scan())
+            else:
+                _sizes[self.directory] += size
+            if _sizes[self.directory] > self.max_bytes:
+                self._trim()
+
+    def _scan(self) -> list:
+        """
+        Returns (access time, path, size) of every entry.
+        """
+        entries = []
+        try:
+            buckets = [e.path for e in os.scandir(self.directory) if e.is_dir()]
+        except FileNotFoundError:
+            return entries
+        for bucket in buckets:
+            try:
+                with os.scandir(bucket) as files:
+                    for file in files:
+                        if not file.name.endswith(".tmp"):
+                            stat = file.stat()
+                            entries.append((stat.st_atime_ns, file.path, stat.st_size))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _trim(self) -> None:
+        """
+        Removes the least recently used entries down to the low watermark.
+
+        The directory is scanned again, so the entries added by other
+        processes are counted too. Called with the size lock held.
+        """
+        entries = sorted(self._scan())
+        size = sum(entry[2] for entry in entries)
+        target = self.max_bytes * LOW_WATERMARK
+        evicted = 0
+        for _, path, entry_size in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass # removed by another process
+            size -= entry_size
+        _sizes[self.directory] = size
+        with self._lock:
+            self.stats["evicted"] += evicted
+        logging.info("Cache %s: rimosse %d voci, %d byte", self.directory, evicted, size)
+
+    def size(self) -> int:
+        """
+        Returns the total size of the entries on disk.
+        """
+        return sum(entry[2] for entry in self._scan())
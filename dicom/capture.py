@@ -0,0 +1,238 @@
+"""
+Continuous frame acquisition from a video device or file.
+
+A reader thread keeps the source open and pushes the frames into a bounded
+ring buffer; separate writer threads encode them to PNG files. When the
+writers cannot keep up, the oldest buffered frame is dropped and counted, so
+the reader never blocks the device.
+
+With a deduplication threshold, each frame is compared with the last frame
+handed to a writer on a downscaled grayscale copy and is kept only when their
+SSIM drops below the threshold. A frame dropped from the full buffer never
+becomes the reference, so the frames similar to it are not skipped.
+"""
+
+# Standard library
+import logging
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+# Third-party packages
+import cv2
+
+# Local modules
+from .metrics import stage
+from .similarity import downscale, fast_ssim
+
+
+class FrameRing():
+    """
+    Thread-safe ring buffer of frames.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of buffered frames.
+    """
+    def __init__(self, size: int) -> None:
+        if size < 1:
+            raise ValueError("Invalid buffer size: expected a positive integer.")
+        self._items = deque(maxlen=size)
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item) -> None:
+        """
+        Adds an item, dropping the oldest one if the buffer is full.
+        """
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self):
+        """
+        Returns the oldest item, waiting for one; None once closed and empty.
+        """
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            return self._items.popleft() if self._items else None
+
+    def close(self) -> None:
+        """
+        Signals that no more items will be added.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class ChangeDetector():
+    """
+    Decides whether a frame differs enough from the last kept one.
+
+    ``is_new`` compares and keeps a frame at once. When the frames are kept
+    later (e.g. once handed to a writer) they are compared with ``differs``
+    on their ``reduce`` copy and kept with ``keep``.
+
+    Parameters
+    ----------
+    threshold : float
+        Frames with SSIM >= threshold from the last kept frame are skipped.
+    size : int
+        Longest side of the grayscale copy on which SSIM is computed.
+    """
+    def __init__(self, threshold: float, size: int = 64) -> None:
+        self.threshold = threshold
+        self.size = size
+        self._last = None
+        self._last_index = None
+        self._lock = threading.Lock()
+
+    def reduce(self, frame):
+        """
+        Returns the downscaled grayscale copy of a frame that is compared.
+        """
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
+        return downscale(frame, self.size)
+
+    def differs(self, small) -> bool:
+        """
+        Returns True if a reduced frame differs from the last kept one.
+        """
+        with self._lock:
+            last = self._last
+        if last is not None and last.shape == small.shape:
+            return not fast_ssim(last, small, tile=self.size, threshold=self.threshold).passed
+        return True
+
+    def keep(self, small, index: int = None) -> None:
+        """
+        Makes a reduced frame the reference; with an index, only if it is
+        newer than the reference (several writers may keep frames).
+        """
+        with self._lock:
+            if index is None or self._last_index is None or index > self._last_index:
+                self._last, self._last_index = small, index
+
+    def is_new(self, frame) -> bool:
+        """
+        Returns True, and keeps the frame, if it must be kept.
+        """
+        small = self.reduce(frame)
+        if not self.differs(small):
+            return False
+        self.keep(small)
+        return True
+
+
+# pylint: disable-next=too-many-arguments,too-many-locals,too-many-statements
+def acquire_sequence(source, output_dir: Path, frames: int = None, duration: float = None,
+                     fps: float = None, buffer_size: int = 64, writers: int = 2,
+                     dedup_threshold: float = None, dedup_size: int = 64,
+                     metrics=None) -> dict:
+    """
+    Captures a sequence of frames and saves them as PNG files.
+
+    The capture stops after ``frames`` frames, after ``duration`` seconds or
+    at the end of the source, whichever comes first.
+
+    Parameters:
+    source: int (device index) or str/Path (video file or device /dev/videoX)
+    output_dir: directory where frame_000000.png, frame_000001.png... are saved
+    frames: maximum number of frames
+    duration: maximum capture time in seconds
+    fps: if set, frames are read at most at this rate
+    buffer_size: number of frames buffered between reader and writers
+    writers: number of writer threads
+    dedup_threshold: if set, frames with SSIM >= threshold from the last written one are skipped
+    dedup_size: longest side of the grayscale copy used for the deduplication SSIM
+    metrics: if set, Metrics collector of the "capture", "dedup" and "write" stages of each frame
+
+    Returns:
+    dict: captured, written, dropped and skipped frame counts, elapsed seconds and achieved fps.
+    """
+    if frames is None and duration is None:
+        raise ValueError("You must provide frames or duration for a continuous capture!")
+    if writers < 1:
+        raise ValueError("Invalid writers: expected a positive integer.")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    cap = cv2.VideoCapture(source) # pylint: disable=c-extension-no-member
+    if not cap.isOpened():
+        raise RuntimeError(f"Unable to open the source:: {source}")
+    if fps is not None:
+        cap.set(cv2.CAP_PROP_FPS, fps) # pylint: disable=c-extension-no-member
+
+    ring = FrameRing(buffer_size)
+    detector = None if dedup_threshold is None else ChangeDetector(dedup_threshold, dedup_size)
+    stats = {"captured": 0, "written": 0, "dropped": 0, "skipped": 0, "elapsed": 0.0, "fps": 0.0}
+    lock = threading.Lock()
+
+    def read():
+        start = time.perf_counter()
+        try:
+            while frames is None or stats["captured"] < frames:
+                if duration is not None and time.perf_counter() - start >= duration:
+                    break
+                if fps is not None:
+                    delay = start + stats["captured"] / fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                index = stats["captured"]
+                with stage(metrics, "capture", index, frames=1):
+                    ret, frame = cap.read()
+                if not ret:
+                    break
+                new, small = True, None
+                if detector is not None:
+                    with stage(metrics, "dedup", index):
+                        small = detector.reduce(frame)
+                        new = detector.differs(small)
+                if new:
+                    ring.put((index, frame, small))
+                else:
+                    stats["skipped"] += 1
+                stats["captured"] += 1
+        finally:
+            stats["elapsed"] = time.perf_counter() - start
+            cap.release()
+            ring.close()
+
+    def write():
+        while (item := ring.get()) is not None:
+            index, frame, small = item
+            if small is not None:
+                detector.keep(small, index) # the reference once it is sure to be written
+            path = str(output_dir / f"frame_{index:06d}.png")
+            with stage(metrics, "write", index, frames=1) as record:
+                cv2.imwrite(path, frame) # pylint: disable=c-extension-no-member
+                record["bytes_written"] = os.path.getsize(path)
+            with lock:
+                stats["written"] += 1
+
+    threads = [threading.Thread(target=read, name="acquire-reader")]
+    threads += [threading.Thread(target=write, name=f"acquire-writer-{i}") for i in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats["dropped"] = ring.dropped
+    if stats["elapsed"] > 0:
+        stats["fps"] = stats["captured"] / stats["elapsed"]
+    if metrics is not None:
+        metrics.info.update(stats)
+    logging.info("Frame acquisiti: %d, salvati: %d, scartati: %d, duplicati: %d, %.1f fps",
+                 stats["captured"], stats["written"], stats["dropped"], stats["skipped"],
+                 stats["fps"])
+    return stats
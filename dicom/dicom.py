@@ -23,17 +23,190 @@ Examples
 
 # Standard library
 import argparse
+import cProfile
 import logging
+import io
 import os
+import shutil
+from functools import partial
 from pathlib import Path
 
-# Third-party packages
-import pydicom
-import matplotlib.pyplot as plt
-from PIL import Image
-import cv2
-import numpy as np
-from skimage.metrics import structural_similarity
+# Local modules
+from .cache import Hit, Miss, RenderCache, parse_size
+from .manifest import Manifest, fingerprint
+from .metrics import Metrics, stage
+from .sharding import parse_shard, read_worklist, select, write_worklist
+from . import discovery, pipeline
+
+# The third-party packages (pydicom, numpy, PIL, matplotlib, cv2, skimage)
+# and the process pool are imported by the functions that use them, so that
+# every subcommand loads only its own libraries and the CLI starts quickly.
+# pylint: disable=import-outside-toplevel
+
+FORMATS = ("jpg", "png", "gif", "txt", "mp4", "webp")
+DEFAULT_FORMATS = ("jpg", "png", "gif", "txt")
+IMAGE_FORMATS = ("jpg", "png", "gif", "mp4", "webp")
+# Outputs of the multi-frame files (cines)
+CINE_FORMATS = ("gif", "mp4", "webp")
+# Codec of the MP4 cines, available in every OpenCV build with FFmpeg
+MP4_FOURCC = "mp4v"
+
+class RenderContext():
+    """
+    Pixel data of a single DICOM file, decoded and rescaled at most once.
+
+    Every encoder of the file receives the same uint8 buffer, so the pixels
+    are never converted twice. Multi-frame data can also be rescaled one
+    frame at a time with ``frames()``, keeping the memory bounded.
+
+    Parameters
+    ----------
+    ds : pydicom.Dataset
+        Dataset read from the DICOM file.
+    strategy : str
+        Intensity mapping strategy, one of intensity.STRATEGIES.
+    percentiles : tuple
+        Percentiles used by the "percentile" strategy.
+    """
+    # Uncompressed transfer syntaxes whose Pixel Data can be viewed directly
+    NATIVE_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+    def __init__(self, ds, strategy:str = "minmax", percentiles:tuple = (0.5, 99.5)) -> None:
+        from .intensity import IntensityMapper
+
+        self.ds = ds
+        self.multi_frame = (0x0028, 0x0008) in ds  # Number of Frames
+        self._mapper = IntensityMapper(ds, strategy, percentiles)
+        self._fitted = False
+        self._pixels = None
+        self._image = None
+
+    @property
+    def frame_time(self):
+        """
+        Frame Time (0018,1063) in milliseconds.
+        """
+        return self.ds[0x0018,0x1063].value
+
+    @property
+    def pixels(self):
+        """
+        Stored pixel values, shape (H, W[, S]) or (N, H, W[, S]) for multi-frame.
+
+        Uncompressed little endian data is a read-only view of the Pixel Data
+        bytes; any other encoding is decoded by pydicom.
+        """
+        if self._pixels is None:
+            self._pixels = self._native_view()
+            if self._pixels is None:
+                self._pixels = self.ds.pixel_array
+        return self._pixels
+
+    @property
+    def mapper(self):
+        """
+        Intensity mapper fitted on the pixels, one frame at a time.
+        """
+        if not self._fitted:
+            self._mapper.fit(self._frames() if self.multi_frame else [self.pixels])
+            self._fitted = True
+        return self._mapper
+
+    @property
+    def image(self):
+        """
+        Pixels mapped to uint8, shape (H, W) or (N, H, W) for multi-frame.
+        """
+        if self._image is None:
+            self._image = self.mapper.apply(self.pixels)
+        return self._image
+
+    def frames(self):
+        """
+        Yields the mapped frames one at a time.
+
+        The mapping is the same for every frame, so the result equals
+        iterating over ``image`` without holding all frames in memory.
+        """
+        if self._image is not None or not self.multi_frame:
+            yield from (self.image if self.multi_frame else [self.image])
+            return
+        mapper = self.mapper
+        for frame in self._frames():
+            yield mapper.apply(frame)
+
+    def _frames(self):
+        """
+        Yields the stored frames one at a time.
+
+        When the Pixel Data is mapped from the file (see
+        DICOM._map_pixel_data) the pages of a frame are released once it has
+        been used, so that the resident memory stays at about one frame.
+        Where madvise is not available (e.g. Windows) they are not released.
+        """
+        import mmap
+        import numpy as np
+
+        base = self.pixels
+        while isinstance(base, np.ndarray):
+            base = base.base
+        mapping = base.obj if isinstance(base, memoryview) else None
+        if not isinstance(mapping, mmap.mmap) or not hasattr(mmap, "MADV_DONTNEED"):
+            yield from self.pixels
+            return
+        address = np.frombuffer(mapping, np.uint8, 1).ctypes.data
+        for frame in self.pixels:
+            yield frame
+            end = frame.ctypes.data + frame.nbytes - address
+            end -= end % mmap.PAGESIZE
+            if end > 0:
+                mapping.madvise(mmap.MADV_DONTNEED, 0, end)
+
+    def _native_view(self):
+        """
+        Returns the Pixel Data bytes as an array without copying them, or
+        None if the data is encapsulated, big endian or bit-packed.
+        """
+        import numpy as np
+        from pydicom.pixel_data_handlers.util import pixel_dtype
+
+        ds = self.ds
+        file_meta = getattr(ds, "file_meta", None)
+        if (file_meta is None
+                or file_meta.get("TransferSyntaxUID") not in self.NATIVE_SYNTAXES
+                or "PixelData" not in ds
+                or ds.get("BitsAllocated") not in (8, 16, 32)
+                or (ds.get("SamplesPerPixel", 1) != 1 and ds.get("PlanarConfiguration", 0) != 0)):
+            return None
+
+        shape = (int(ds.get("NumberOfFrames", 1) or 1), ds.Rows, ds.Columns,
+                 ds.get("SamplesPerPixel", 1))
+        dtype = pixel_dtype(ds)
+        count = int(np.prod(shape))
+        if len(ds.PixelData) < count * dtype.itemsize:
+            return None
+
+        arr = np.frombuffer(ds.PixelData, dtype=dtype, count=count).reshape(shape)
+        if shape[3] == 1:
+            arr = arr[..., 0]
+        return arr if self.multi_frame else arr[0]
+
+
+def parse_formats(value: str) -> tuple:
+    """
+    Parses a comma-separated list of output formats, e.g. "jpg,txt".
+
+    "none" selects no per-file output, e.g. to only export the metadata.
+    """
+    if value.strip().lower() == "none":
+        return ()
+    formats = tuple(f.strip().lower() for f in value.split(",") if f.strip())
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(
+            f"invalid formats {value!r}: expected a comma-separated subset of {','.join(FORMATS)}")
+    return formats
+
 
 # pylint: disable=too-few-public-methods
 class DICOM():
@@ -51,131 +224,723 @@ class DICOM():
         Directory contenente i file DICOM.
     anonymous : bool
         Se True, i file vengono anonimizzati.
+    workers : int
+        Numero di processi usati per elaborare i file (1 = seriale).
+    force : bool
+        Se True, rielabora anche i file le cui uscite sono già aggiornate.
+    png_mode : str
+        "pixels" salva i pixel reali, "figure" salva il grafico matplotlib.
+    formats : tuple
+        Formati di uscita da generare, sottoinsieme di FORMATS.
+    intensity : str
+        Strategia di conversione delle intensità in 8 bit ("minmax", "window", "percentile").
+    percentiles : tuple
+        Percentili usati dalla strategia "percentile".
+    prefetch : int
+        Numero di file letti in anticipo dalla pipeline.
+    writers : int
+        Numero di thread che scrivono le uscite.
+    metrics : metrics.Metrics
+        Se indicato, raccoglie tempi, byte e frame di ogni fase.
+    files : list
+        Se indicato, elabora solo questi file (contenuti in path) invece di
+        esplorare la cartella, ad esempio il risultato di una query dell'indice.
+    export : export.MetadataExport
+        Se indicato, vi aggiunge i metadati di ogni file (anonimizzati se richiesto).
+    scan_workers : int
+        Numero di thread che esplorano le sottocartelle in cerca di file DICOM.
+    output_root : Path
+        Se indicata, le uscite sono scritte in questa cartella (esterna a path),
+        che riproduce l'albero delle cartelle di ingresso, invece che nelle
+        cartelle OUTPUT accanto ai file.
+    archive : archive.ArchiveSink
+        Se indicato, le uscite sono scritte in archivi zip/tar invece che in
+        file separati; tutti i file vengono elaborati di nuovo.
+    shard : tuple
+        Se indicato, (i, N): elabora solo i file assegnati allo shard i di N.
+    shard_by : str
+        Assegna agli shard i singoli file ("file") o le cartelle dei pazienti ("patient").
+    cache : cache.RenderCache
+        Se indicata, le immagini già codificate per gli stessi pixel e le
+        stesse opzioni sono collegate (hard link) o copiate dalla cache
+        invece di essere decodificate e codificate di nuovo.
     """
-    def __init__(self, path:Path, anonymous:bool) -> None:
+    PNG_MODES = ("pixels", "figure")
+
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, path:Path, anonymous:bool, workers:int = 1, force:bool = False,
+                 png_mode:str = "pixels", formats:tuple = DEFAULT_FORMATS,
+                 intensity:str = "minmax", percentiles:tuple = (0.5, 99.5),
+                 prefetch:int = 4, writers:int = 4, metrics=None, files:list = None,
+                 export=None, scan_workers:int = 8, output_root:Path = None,
+                 archive=None, shard:tuple = None, shard_by:str = "file",
+                 cache=None) -> None:
+        from .intensity import STRATEGIES
+
         self.path = path
         self.anonymous = anonymous
+        self.workers = workers
+        self.force = force
+        self.png_mode = png_mode
+        self.formats = tuple(formats)
+        self.intensity = intensity
+        self.percentiles = tuple(percentiles)
+        self.prefetch = prefetch
+        self.writers = writers
+        self.metrics = metrics
+        self.files = None if files is None else list(files)
+        self.export = export
+        self.scan_workers = scan_workers
+        self.output_root = output_root
+        self.archive = archive
+        self.shard = shard
+        self.shard_by = shard_by
+        self.cache = cache
+        self._fingerprints = {} # source -> fingerprint taken by _read, for the manifests
 
         if not self._is_consistent():
             raise ValueError("Invalid path: expected a directory.")
+        if self.workers < 1:
+            raise ValueError("Invalid workers: expected a positive integer.")
+        if self.prefetch < 1 or self.writers < 1 or self.scan_workers < 1:
+            raise ValueError("Invalid prefetch/writers/scan_workers: expected positive integers.")
+        if self.png_mode not in self.PNG_MODES:
+            raise ValueError(f"Invalid png_mode: expected one of {self.PNG_MODES}.")
+        if not set(self.formats) <= set(FORMATS):
+            raise ValueError(f"Invalid formats: expected a subset of {FORMATS}.")
+        if self.intensity not in STRATEGIES:
+            raise ValueError(f"Invalid intensity: expected one of {STRATEGIES}.")
+        if self.shard is not None and not 0 <= self.shard[0] < self.shard[1]:
+            raise ValueError("Invalid shard: expected (i, N) with 0 <= i < N.")
+        if self.shard_by not in ("file", "patient"):
+            raise ValueError("Invalid shard_by: expected file or patient.")
+        if self.output_root is not None:
+            root, output_root = os.path.abspath(self.path), os.path.abspath(self.output_root)
+            #The outputs (e.g. the anonymized copies) must not become inputs of the next run
+            if os.path.commonpath([root, output_root]) == root:
+                raise ValueError("Invalid output_root: expected a directory outside path.")
+
+    def __getstate__(self) -> dict:
+        #A copy sent to a worker process processes the jobs it is given: the
+        #file list (possibly tens of thousands of paths) is not sent with every job
+        state = dict(self.__dict__)
+        state["files"] = None
+        state["_fingerprints"] = {}
+        return state
 
     def _is_consistent(self) -> bool:
         return self.path.is_dir()
 
-    def _print_info(self, dicom, file_name):
+    @staticmethod
+    def _print_info(dicom, file_name):
         """
         Salva le informazioni di un file DICOM in un file di testo.
         """
-        with open(file_name, "w", encoding="utf-8") as f:
-            print(dicom, file=f)
+        file_name.write(f"{dicom}\n".encode("utf-8"))
 
-    def _dicom_to_graphic(self,dicom,file_name):
+    @staticmethod
+    def _dicom_to_graphic(pixels,file_name):
         """
         Defines a function that saves the plot as a PNG file.
         """
-        plt.imshow(dicom.pixel_array, cmap="gray")
-        plt.savefig(file_name)
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots()
+        ax.imshow(pixels, cmap="gray")
+        fig.savefig(file_name, format="png")
+        plt.close(fig)
+
+    @staticmethod
+    def _dicom_to_png(image,file_name):
+        """
+        Defines a function that saves the rescaled pixels in PNG format.
+        """
+        from PIL import Image
+
+        Image.fromarray(image).save(file_name, format="PNG")
+
+    @staticmethod
+    def _dicom_to_jpg(image,file_name):
+        """
+        Defines a function that saves the rescaled pixels in JPG format.
+        """
+        from PIL import Image
+
+        Image.fromarray(image).save(file_name, format="JPEG")
 
-    def _dicom_to_jpg(self,ds,file_name):
+    @staticmethod
+    def _dicom_to_gif(frames,time_frame,file_name):
         """
-        Defines a function that saves the file in JPG format.
+        Defines a function that saves the rescaled frames in GIF format.
+
+        The frames are encoded and written one at a time as they are
+        produced by the iterable, so only one frame is held in memory.
         """
-        im = ds.pixel_array.astype(float)
-        rescaled_image =(np.maximum(im,0)/im.max())*255 #float pixels
-        final_image = np.uint8(rescaled_image) #integers pixels
-        final_image = Image.fromarray(final_image)
-        final_image.save(file_name)
+        from PIL import Image, GifImagePlugin
+
+        for i, frame in enumerate(frames):
+            img = Image.fromarray(frame)
+            params = {"duration": time_frame}
+            if img.mode == "RGB":
+                img = img.convert("P", palette=Image.Palette.ADAPTIVE)
+                params["include_color_table"] = True
+            if i == 0:
+                header, _ = GifImagePlugin.getheader(img, None, {"loop": 0})
+                file_name.write(b"".join(header))
+            for chunk in GifImagePlugin.getdata(img, (0, 0), **params):
+                file_name.write(chunk)
+        file_name.write(b";") # GIF trailer
 
-    def _dicom_to_gif(self,ds,file_name):
+    @staticmethod
+    def _dicom_to_mp4(frames,time_frame,file_name):
         """
-        Defines a function that saves the file in GIF format.
+        Defines a function that saves the rescaled frames as an MP4 video.
+
+        The frames are encoded one at a time by cv2.VideoWriter at
+        1000 / time_frame frames per second. The writer needs a path, so the
+        video is written to a temporary file and then copied.
+        """
+        import tempfile
+        import cv2
+        # pylint: disable=c-extension-no-member
+
+        fd, path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        writer = None
+        try:
+            for frame in frames:
+                if frame.ndim == 2:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                else:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                # The codec crops odd sizes: pad to even ones instead
+                frame = cv2.copyMakeBorder(frame, 0, frame.shape[0] % 2, 0, frame.shape[1] % 2,
+                                           cv2.BORDER_CONSTANT, value=0)
+                if writer is None:
+                    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*MP4_FOURCC),
+                                             1000 / float(time_frame),
+                                             (frame.shape[1], frame.shape[0]))
+                    if not writer.isOpened():
+                        raise RuntimeError(f"cannot open the {MP4_FOURCC} video encoder")
+                writer.write(frame)
+            if writer is not None:
+                writer.release()
+                writer = None
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, file_name, 1 << 20)
+        finally:
+            if writer is not None:
+                writer.release()
+            os.remove(path)
+
+    @staticmethod
+    def _dicom_to_webp(frames,time_frame,file_name):
         """
-        time_frame = ds[0x0018,0x1063].value
-        imgs = ds.pixel_array.astype(float)
-        rescaled_images =(np.maximum(imgs,0)/imgs.max())*255 #float pixels
-        final_images = np.uint8(rescaled_images) #integers pixels
-        # final_images is a multi-frame array with shape (N, H, W),
-        # where N is the number of frames. Iterating over it yields
-        # one 2D frame per step, so this comprehension is valid.
-        imgs = [Image.fromarray(img) for img in final_images]  # pylint: disable=E1133
-        imgs[0].save(file_name, save_all=True, append_images=imgs[1:], duration=time_frame, loop=0)
+        Defines a function that saves the rescaled frames as an animated WebP.
 
+        Unlike the GIF there is no palette quantization; the encoder needs all
+        the uint8 frames at once.
+        """
+        from PIL import Image
 
+        images = [Image.fromarray(frame) for frame in frames]
+        images[0].save(file_name, format="WEBP", save_all=True, append_images=images[1:],
+                       duration=float(time_frame), loop=0, quality=80, method=0)
 
-    def _make_anonymus_dicom(self,dicom,file_name):
+    @staticmethod
+    def _anonymize(dicom):
         """
-        Defines a function that anonymizes a DICOM file.
+        Replaces the patient data of a dataset in place.
         """
         dicom[0x0010, 0x0010].value = "Anonymous"
         dicom[0x0010, 0x0020].value = "Anonymous"
         dicom[0x0010, 0x0030].value = ""
         dicom[0x0010, 0x0040].value = ""
         dicom[0x0012, 0x0062].value = "YES"
+
+    def _copy_anonymus_dicom(self,dicom,source,pixel_offset,file_name):
+        """
+        Writes a DICOM file read without its pixel data.
+
+        The (anonymized) header is written first, then the bytes of the
+        source file from ``pixel_offset`` onwards (the Pixel Data element and
+        any trailing element) are copied unchanged, without being decoded.
+        """
         dicom.save_as(file_name)
+        with open(source, "rb") as f:
+            f.seek(pixel_offset)
+            shutil.copyfileobj(f, file_name, 1 << 20)
+
+    def _read_header(self, source):
+        """
+        Reads a DICOM file stopping before the pixel data.
+
+        Returns:
+        tuple: The dataset and the offset of the Pixel Data element, or None
+        if the file was read in full because its transfer syntax is deflated.
+        """
+        import pydicom
+
+        with open(source, "rb") as f:
+            ds = pydicom.dcmread(f, stop_before_pixels=True)
+            pixel_offset = f.tell()
+
+        # In a deflated file the offset refers to the decompressed stream
+        if ds.file_meta.get("TransferSyntaxUID") == pydicom.uid.DeflatedExplicitVRLittleEndian:
+            return pydicom.dcmread(source), None
+        return ds, pixel_offset
+
+    @staticmethod
+    def _map_pixel_data(source, ds, pixel_offset) -> bool:
+        """
+        Completes a dataset read by _read_header with its Pixel Data, mapped
+        from the file instead of read into memory, and the elements after it.
+
+        Only uncompressed little endian data is mapped: the pages of the file
+        are loaded as the frames are used, so the memory does not grow with
+        the frame count. The elements from the Pixel Data onwards must be
+        removed before the dataset is written (see _render).
+
+        Returns:
+        bool: False if the Pixel Data must be read by pydicom instead.
+        """
+        import mmap
+        import struct
+        import numpy as np
+        from pydicom.dataelem import DataElement
+        from pydicom.filereader import read_dataset
+
+        syntax = ds.file_meta.get("TransferSyntaxUID")
+        #The layouts viewed without copy by RenderContext; pydicom handles the others
+        if (syntax not in RenderContext.NATIVE_SYNTAXES
+                or ds.get("BitsAllocated") not in (8, 16, 32)
+                or (ds.get("SamplesPerPixel", 1) != 1 and ds.get("PlanarConfiguration", 0) != 0)):
+            return False
+        implicit = syntax == RenderContext.NATIVE_SYNTAXES[0]
+        with open(source, "rb") as f:
+            f.seek(pixel_offset)
+            header = f.read(12)
+            if not header: # no Pixel Data: the header is the whole dataset
+                return True
+            if header[:4] != b"\xe0\x7f\x10\x00": # (7FE0,0010) little endian
+                return False
+            if implicit:
+                vr = "OB" if ds.get("BitsAllocated", 8) <= 8 else "OW"
+                length, start = struct.unpack("<I", header[4:8])[0], pixel_offset + 8
+            else:
+                vr = header[4:6].decode("ascii", "replace")
+                if vr not in ("OB", "OW"):
+                    return False
+                length, start = struct.unpack("<I", header[8:12])[0], pixel_offset + 12
+            #Encapsulated (undefined length), empty or truncated data is left to pydicom
+            if length in (0, 0xFFFFFFFF) or start + length > os.fstat(f.fileno()).st_size:
+                return False
+            f.seek(start + length)
+            try:
+                tail = read_dataset(f, implicit, True)
+            except Exception: # pylint: disable=broad-exception-caught
+                return False
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        ds.add(DataElement(0x7FE00010, vr, np.frombuffer(mapping, np.uint8, length, start)))
+        ds.update(tail)
+        return True
+
+    def _options(self) -> dict:
+        """
+        Returns the options that affect the outputs, as stored in the manifest.
+        """
+        return {"anonymous": self.anonymous, "png_mode": self.png_mode,
+                "formats": sorted(self.formats), "intensity": self.intensity,
+                "percentiles": list(self.percentiles)}
 
-    def processing(self) -> None:
+    def _read(self, file_paths: dict) -> tuple:
+        """
+        Reads a DICOM file, only its header when no image output is requested.
+
+        For the image outputs the Pixel Data of uncompressed files is mapped
+        (see _map_pixel_data); other encodings are read in full by pydicom.
+
+        Returns:
+        tuple: The dataset and the offset of its Pixel Data element in the
+        file, or None if the whole file was read.
+        """
+        import pydicom
+
+        source = file_paths["dicom"]
+        if self.archive is None:
+            #Hashed here, in the reader thread or worker, and not again by the manifest;
+            #the bytes are counted by the read stage, which finds them in the page cache
+            with stage(self.metrics, "digest", source):
+                self._fingerprints[source] = fingerprint(source)
+        with stage(self.metrics, "read", source, bytes_read=os.path.getsize(source)):
+            if not set(self.formats) & set(IMAGE_FORMATS):
+                return self._read_header(source)
+            ds, pixel_offset = self._read_header(source)
+            if pixel_offset is None or self._map_pixel_data(source, ds, pixel_offset):
+                return ds, pixel_offset
+            return pydicom.dcmread(source), None
+
+    def _render(self, file_paths: dict, dataset: tuple) -> list:
+        """
+        Decodes a DICOM file read by _read and prepares its outputs.
+
+        The mapped Pixel Data and the elements after it are removed from the
+        dataset once the outputs are prepared, so that the anonymized copy
+        writes the header only and copies the rest of the file.
+        """
+        ds, pixel_offset = dataset
+        try:
+            return self._render_tasks(file_paths, ds, pixel_offset)
+        finally:
+            if pixel_offset is not None:
+                for tag in [tag for tag in ds.keys() if tag >= 0x7FE00010]:
+                    del ds[tag]
+
+    def _render_tasks(self, file_paths: dict, ds, pixel_offset) -> list:
+        """
+        Prepares the outputs of a DICOM file read by _read.
+
+        Returns:
+        list: Write tasks (source, path, payload): the payload is either the bytes
+        of the output or a function that writes it to a binary file. The
+        GIF frames and the anonymized copy are encoded by the function, so
+        they are never held in memory as a whole.
+        """
+        source = file_paths["dicom"]
+        file = os.path.basename(source)
+        tasks = []
+
+        if self.anonymous:
+            logging.info("\t\t---Rendo il file: %s anonimo", file)
+            with stage(self.metrics, "anonymize", source):
+                self._anonymize(ds)
+            if pixel_offset is None:
+                tasks.append((source, file_paths["anon"], ds.save_as))
+            else:
+                tasks.append((source, file_paths["anon"], partial(
+                    self._copy_anonymus_dicom, ds, source, pixel_offset)))
+
+        if self.export is not None:
+            self.export.add(ds, source)
+
+        #Without image outputs the pixel data is neither read nor decoded; files without
+        #pixel data (e.g. structured reports, key objects, DICOMDIR) only get the other outputs
+        if set(self.formats) & set(IMAGE_FORMATS) and "PixelData" not in ds:
+            logging.info("\t\t--Il file: %s non contiene immagini", file)
+        elif set(self.formats) & set(IMAGE_FORMATS):
+            context = RenderContext(ds, self.intensity, self.percentiles)
+            images = [f for f in (CINE_FORMATS if context.multi_frame else ("jpg", "png"))
+                      if f in self.formats]
+            key = None
+            if self.cache is not None and images:
+                with stage(self.metrics, "hash", source, bytes_read=len(ds.PixelData)):
+                    key = self.cache.key(ds, {"png_mode": self.png_mode,
+                                              "intensity": self.intensity,
+                                              "percentiles": list(self.percentiles)})
+                hits = {f: self.cache.lookup(key, f) for f in images}
+                for image, hit in hits.items():
+                    if hit is not None:
+                        tasks.append((source, file_paths[image], hit))
+                images = [f for f in images if hits[f] is None]
+
+            def encode(image, payload):
+                if key is not None:
+                    payload = Miss(key, image, payload)
+                tasks.append((source, file_paths[image], payload))
+
+            #When every image is in the cache the pixels are not decoded
+            if key is None or images:
+                with stage(self.metrics, "decode", source,
+                                   frames=int(ds.get("NumberOfFrames", 1) or 1)):
+                    _ = context.pixels
+            if context.multi_frame:
+                logging.info("\t\t--Il file: %s è multi-frame",file)
+                encoders = {"gif": self._dicom_to_gif, "mp4": self._dicom_to_mp4,
+                            "webp": self._dicom_to_webp}
+                if images:
+                    with stage(self.metrics, "rescale", source):
+                        _ = context.mapper # the frames are measured here, mapped while written
+                for cine in images:
+                    encode(cine, partial(encoders[cine], context.frames(), context.frame_time))
+            else:
+                logging.info("\t\t--Il file: %s è single-frame",file)
+                if "jpg" in images or ("png" in images and self.png_mode == "pixels"):
+                    with stage(self.metrics, "rescale", source):
+                        _ = context.image
+                if "jpg" in images:
+                    encode("jpg", partial(self._dicom_to_jpg, context.image))
+                if "png" in images:
+                    if self.png_mode == "figure":
+                        buffer = io.BytesIO()
+                        with stage(self.metrics, "figure", source):
+                            self._dicom_to_graphic(context.pixels, buffer)
+                        encode("png", buffer.getvalue())
+                    else:
+                        encode("png", partial(self._dicom_to_png, context.image))
+
+        if "txt" in self.formats:
+            buffer = io.BytesIO()
+            self._print_info(ds, buffer)
+            tasks.append((source, file_paths["info"], buffer.getvalue()))
+        return tasks
+
+    def _write(self, task: tuple) -> str:
+        """
+        Executes a write task produced by _render and returns its path.
+
+        The stage is named after the output, e.g. "write-gif"; the anonymized
+        copy is "write-dcm" and an output taken from the cache "cache-gif".
+        """
+        source, path, payload = task
+        miss = None
+        if isinstance(payload, Miss):
+            miss, payload = payload, payload.payload
+        extension = os.path.splitext(path)[1].lstrip(".").lower()
+        name = ("cache-" if isinstance(payload, Hit) else "write-") + extension
+        with stage(self.metrics, name, source) as record:
+            if self.archive is not None:
+                if isinstance(payload, Hit):
+                    with payload.file:
+                        data = payload.file.read()
+                else:
+                    buffer = io.BytesIO()
+                    if isinstance(payload, bytes):
+                        buffer.write(payload)
+                    else:
+                        payload(buffer)
+                    data = buffer.getvalue()
+                self.archive.add(path, data)
+                record["bytes_written"] = len(data)
+                if miss is not None:
+                    self.cache.store(miss.key, miss.fmt, data=data)
+                return path
+            #The previous output may be a hard link to a cache entry: it is
+            #replaced, never truncated
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            if isinstance(payload, Hit):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                record["bytes_written"] = self.cache.restore(payload, path)
+                return path
+            try:
+                f = open(path, "wb") # pylint: disable=consider-using-with
+            except FileNotFoundError:
+                #The output directory is created with the first output written in it
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open(path, "wb") # pylint: disable=consider-using-with
+            with f:
+                if isinstance(payload, bytes):
+                    f.write(payload)
+                else:
+                    payload(f)
+                record["bytes_written"] = f.tell()
+        if miss is not None:
+            self.cache.store(miss.key, miss.fmt, path=path)
+        return path
+
+    def _process_file(self, file_paths: dict) -> list:
+        """
+        Reads a single DICOM file and writes all of its outputs.
+
+        Returns:
+        list: Paths of the written outputs.
+        """
+        tasks = self._render(file_paths, self._read(file_paths))
+        return [self._write(task) for task in tasks]
+
+    def _process_file_measured(self, file_paths: dict) -> tuple:
+        """
+        Runs _process_file in a worker process.
+
+        Returns:
+        tuple: The written outputs, the metrics records, the metadata rows,
+        the archive members, the fingerprint of the file and the cache stats,
+        which the parent process merges into its own.
+        """
+        outputs = self._process_file(file_paths)
+        return (outputs, self.metrics.records if self.metrics is not None else [],
+                self.export.take() if self.export is not None else [],
+                self.archive.take() if self.archive is not None else [],
+                self._fingerprints.pop(file_paths["dicom"], None),
+                self.cache.stats if self.cache is not None else {})
+
+    def _export_header(self, source: str) -> None:
+        """
+        Exports the metadata of a file that is not processed again.
+        """
+        try:
+            ds, _ = self._read_header(source)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logging.error("Impossibile esportare i metadati del file %s: %s", source, e)
+            return
+        if self.anonymous:
+            self._anonymize(ds)
+        self.export.add(ds, source)
+
+    def _job(self, cartella: str, file: str) -> dict:
+        """
+        Returns the paths of a DICOM file and of its outputs.
+
+        The outputs go to the OUTPUT subdirectory of the folder, or to the
+        same folder under ``output_root``. They are named after the file
+        without its .dcm suffix; a file without the suffix (e.g. a PACS
+        export) keeps its whole name.
+        """
+        if self.output_root is None:
+            output_directory = cartella + "/OUTPUT"
+        else:
+            relative = os.path.relpath(os.path.abspath(cartella), os.path.abspath(self.path))
+            output_directory = os.path.normpath(os.path.join(self.output_root, relative))
+        name_file = file[:-4] if file.endswith(".dcm") else file
+        return {
+            "dicom": f"{cartella}/{file}",
+            "info": f"{output_directory}/{name_file}.txt",
+            "png": f"{output_directory}/{name_file}.png",
+            "jpg": f"{output_directory}/{name_file}.jpg",
+            "gif": f"{output_directory}/{name_file}.gif",
+            "mp4": f"{output_directory}/{name_file}.mp4",
+            "webp": f"{output_directory}/{name_file}.webp",
+            "anon": f"{output_directory}/ANONYMUS_{file}"
+            }
+
+    def _collect_files(self) -> list:
+        """
+        Walks the input tree and returns the output paths of every DICOM file.
+
+        The DICOM files are recognized by suffix or content (see discovery)
+        and the subdirectories are scanned by ``scan_workers`` threads. When a
+        file list is given (e.g. the result of an index query) the tree is not
+        walked: the listed DICOM files inside the directory are used. With a
+        shard only the files assigned to it are returned (see sharding).
+        """
+        if self.files is not None:
+            root = os.path.abspath(self.path)
+            paths = []
+            for path in self.files:
+                path = os.path.abspath(path)
+                if os.path.commonpath([root, path]) == root and discovery.is_dicom(path):
+                    paths.append(path)
+            logging.info("File selezionati: %d", len(paths))
+        else:
+            #The results of previous runs (OUTPUT directories) are not inputs
+            paths = discovery.discover(self.path, self.scan_workers)
+            logging.info("File DICOM trovati in %s: %d", self.path, len(paths))
+
+        if self.shard is not None:
+            paths = select(paths, self.path, self.shard, self.shard_by)
+            logging.info("File dello shard %d/%d: %d", *self.shard, len(paths))
+        return [self._job(*os.path.split(path)) for path in paths]
+
+    def processing(self) -> dict:
         """
         Processes a DICOM file.
         This function takes a DICOM file as input and performs the necessary
         operations to extract, modify, or analyze its data.
+
+        With a single worker the files go through a pipeline: a thread reads
+        ahead up to ``prefetch`` files, the pixels are decoded and rendered
+        in the calling thread and ``writers`` threads write the outputs.
+        With ``workers`` greater than one the files are distributed over a
+        process pool. A failure on a single file does not stop the run: the
+        error is logged and returned.
+
+        Every ``OUTPUT`` directory keeps a manifest of the processed files:
+        unless ``force`` is set, files that did not change since the previous
+        run with the same options are skipped. With an archive there is no
+        manifest: the archives are written again with every file.
+
+        Returns:
+        dict: Error message of every file that could not be processed,
+        keyed by the DICOM path.
         """
-        dir_path = self.path
-        flag_anonymous = self.anonymous
+        jobs = self._collect_files()
+        options = self._options()
 
-        for cartella,sottocartelle,files in os.walk(dir_path):
-            logging.info("\nCi troviamo nella cartella: %s",cartella)
-            logging.info("\tLe sottocartelle presenti sono: %s",sottocartelle)
-            logging.info("\tI file presenti sono: %s",files)
+        #The output directories are created only when an output is written
+        manifests = {}
 
-            #Parameter indicating whether DICOM files exist in the folder
-            dicom_exists = 0
+        def manifest_of(job):
+            output_directory = os.path.dirname(job["info"])
+            if output_directory not in manifests:
+                manifests[output_directory] = Manifest(output_directory)
+            return manifests[output_directory]
 
-            #I create the output_directory to save the result
-            output_directory = cartella + "/OUTPUT"
-            os.makedirs(output_directory, exist_ok=True)
-
-            for file in files:
-                if file.endswith(".dcm"):
-                    dicom_exists = 1
-
-                    #File paths
-                    name_file = file[:-4] #I remove .dcm from the name
-                    file_paths = {
-                        "dicom": f"{cartella}/{file}",
-                        "info": f"{output_directory}/{name_file}.txt",
-                        "png": f"{output_directory}/{name_file}.png",
-                        "jpg": f"{output_directory}/{name_file}.jpg",
-                        "gif": f"{output_directory}/{name_file}.gif",
-                        "anon": f"{output_directory}/ANONYMUS_{file}"
-                        }
-
-                    ds = pydicom.dcmread(file_paths["dicom"])
-
-                    if flag_anonymous:
-                        logging.info("\t\t---Rendo il file: %s anonimo", file)
-                        self._make_anonymus_dicom(ds,file_paths["anon"])
-
-                    if (0x0028, 0x0008) in ds:  # Number of Frames
-                        logging.info("\t\t--Il file: %s è multi-frame",file)
-                        self._dicom_to_gif(ds, file_paths["gif"])
-                    else:
-                        logging.info("\t\t--Il file: %s è single-frame",file)
-                        self._dicom_to_jpg(ds, file_paths["jpg"])
-                        self._dicom_to_graphic(ds, file_paths["png"])
+        if self.archive is None and not self.force:
+            pending = [job for job in jobs
+                       if not manifest_of(job).is_current(job["dicom"], options)]
+            logging.info("File già aggiornati: %d, da elaborare: %d",
+                         len(jobs) - len(pending), len(pending))
+            if self.export is not None:
+                #The metadata of the skipped files is exported from their header
+                current = {job["dicom"] for job in pending}
+                for job in jobs:
+                    if job["dicom"] not in current:
+                        self._export_header(job["dicom"])
+            jobs = pending
 
-                    self._print_info(ds,file_paths["info"])
-                    #I delete the output_directory if there are no DICOM files in the folder
-            if dicom_exists == 0:
-                os.rmdir(output_directory)
+        results = {}
+        errors = {}
+        if self.workers == 1:
+            results, failures = pipeline.run(jobs, self._read, self._render, self._write,
+                                             key=lambda job: job["dicom"],
+                                             prefetch=self.prefetch, writers=self.writers)
+            for file, e in failures.items():
+                errors[file] = f"{type(e).__name__}: {e}"
+        else:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self._process_file_measured, job): job["dicom"]
+                           for job in jobs}
+                for future in as_completed(futures):
+                    try:
+                        source = futures[future]
+                        (results[source], records, rows, members, stamp,
+                         cache_stats) = future.result()
+                        if stamp is not None:
+                            self._fingerprints[source] = stamp
+                        if self.metrics is not None:
+                            self.metrics.merge(records)
+                        if self.export is not None:
+                            self.export.extend(rows)
+                        if self.archive is not None:
+                            self.archive.extend(members)
+                        if self.cache is not None:
+                            self.cache.merge(cache_stats)
+                    except Exception as e: # pylint: disable=broad-exception-caught
+                        errors[futures[future]] = f"{type(e).__name__}: {e}"
 
-def acquire(source, frame_name: Path):
+        if self.archive is None:
+            for job in jobs:
+                if job["dicom"] in results:
+                    manifest_of(job).update(job["dicom"], options, results[job["dicom"]],
+                                            self._fingerprints.pop(job["dicom"], None))
+                else:
+                    manifest_of(job).discard(job["dicom"])
+        self._fingerprints.clear()
+        for manifest in manifests.values():
+            manifest.save()
+
+        errors = dict(sorted(errors.items()))
+        for file, error in errors.items():
+            logging.error("Impossibile elaborare il file %s: %s", file, error)
+        if self.metrics is not None:
+            self.metrics.info.update({"files": len(jobs), "processed": len(results),
+                                      "errors": len(errors)})
+        return errors
+
+def acquire(source, frame_name: Path, metrics: Metrics = None):
     """
     Captures a frame from a video or a webcam and saves it as a PNG.
     
     Parameters:
     source: int (device index) or str/Path (video file or device /dev/videoX)
     frame_name: Path of the directory or file where the frame will be saved
+    metrics: if set, Metrics collector of the "capture" and "write" stages
     """
+    import cv2
+
 
     # Gestione nome file
     if os.path.isdir(frame_name):
@@ -190,17 +955,20 @@ def acquire(source, frame_name: Path):
     if not cap.isOpened():
         raise RuntimeError(f"Unable to open the source:: {source}")
 
-    ret, frame = cap.read()
+    with stage(metrics, "capture", frame_name, frames=1):
+        ret, frame = cap.read()
     if not ret:
         cap.release()
         raise RuntimeError("Unable to read the frame from the source")
 
     # Salva il frame
-    cv2.imwrite(str(frame_name), frame)
+    with stage(metrics, "write", frame_name, frames=1) as record:
+        cv2.imwrite(str(frame_name), frame)
+        record["bytes_written"] = os.path.getsize(frame_name)
     cap.release()
     logging.info("Frame successfully captured and saved!")
 
-def compare_image(path1:Path, path2:Path) -> None:
+def compare_image(path1:Path, path2:Path, metrics: Metrics = None) -> None:
     """
     Compare two image files using Structural Similarity Index (SSIM).
     The function validates that both inputs are `.jpg` or `.png` files,
@@ -209,9 +977,13 @@ def compare_image(path1:Path, path2:Path) -> None:
     Args:
         path1 (Path): First image path.
         path2 (Path): Second image path.
+        metrics (Metrics): If set, collects the "decode" and "ssim" stages.
     Raises:
         ValueError: If a path is not a valid image file.
     """
+    import cv2
+    from skimage.metrics import structural_similarity
+
     valid_extensions = {'.jpg', '.png'}
 
     # Funzione interna per verificare se un path è valido
@@ -223,14 +995,17 @@ def compare_image(path1:Path, path2:Path) -> None:
     if not _is_valid_image(path2):
         raise ValueError(f"{path2} It is not a valid image file.")
 
-    mag01 = cv2.imread(str(path1)) # pylint: disable=c-extension-no-member
-    mag02 = cv2.imread(str(path2)) # pylint: disable=c-extension-no-member
+    with stage(metrics, "decode", path1, bytes_read=os.path.getsize(path1), frames=1):
+        mag01 = cv2.imread(str(path1)) # pylint: disable=c-extension-no-member
+        #conversione scala di grigi
+        mag01 = cv2.cvtColor(mag01, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
+    with stage(metrics, "decode", path2, bytes_read=os.path.getsize(path2), frames=1):
+        mag02 = cv2.imread(str(path2)) # pylint: disable=c-extension-no-member
+        mag02 = cv2.cvtColor(mag02, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
 
-    #conversione scala di grigi
-    mag01 = cv2.cvtColor(mag01, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
-    mag02 = cv2.cvtColor(mag02, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
-
-    (p,_) = structural_similarity(mag01,mag02, full = True)
+    # Only the mean is used: the full SSIM map is not requested
+    with stage(metrics, "ssim", f"{path1} - {path2}"):
+        p = structural_similarity(mag01,mag02)
 
     #Indice di similarietà 1=uguali, 0=totale differenza
     logging.debug("Indice di similarità: %0.4f", p)
@@ -253,23 +1028,140 @@ def setup_parser() -> argparse.Namespace:
                         help="Selected verbosity",
                         choices=["NOTSET","DEBUG","INFO","WARNING","ERROR","CRITICAL"],
                         default="INFO")
+    parser.add_argument("--metrics-out",
+                        type=Path,
+                        help="Save time, bytes, frames and peak memory of every stage as JSON")
+    parser.add_argument("--profile",
+                        type=Path,
+                        help="Run under cProfile and save the statistics (pstats format)")
+
+    #Options shared by processing and watch
+    rendering = argparse.ArgumentParser(add_help=False)
+    rendering.add_argument("--dicom_dir",
+                           type=Path,
+                           required=True,
+                           help="directory path")
+    rendering.add_argument("--anonymous",
+                           action="store_true",
+                           help="If set, anonymize patient data")
+    rendering.add_argument("--png",
+                           dest="png_mode",
+                           choices=DICOM.PNG_MODES,
+                           default="pixels",
+                           help=(
+                               "PNG output: the real pixel grid (default) "
+                               "or the matplotlib figure"
+                               ))
+    rendering.add_argument("--formats",
+                           type=parse_formats,
+                           default=DEFAULT_FORMATS,
+                           help=(
+                               f"Comma-separated outputs to generate among {','.join(FORMATS)}, "
+                               f"or none (default: {','.join(DEFAULT_FORMATS)}); mp4 and webp "
+                               "apply to multi-frame files"
+                               ))
+    rendering.add_argument("--intensity",
+                           choices=["minmax", "window", "percentile"],
+                           default="minmax",
+                           help=(
+                               "Mapping of the pixel values to 8 bit: clip at 0 and divide by the "
+                               "maximum (default), the VOI window of the file, or a percentile clip"
+                               ))
+    rendering.add_argument("--percentiles",
+                           type=float,
+                           nargs=2,
+                           metavar=("LOW", "HIGH"),
+                           default=(0.5, 99.5),
+                           help="Percentiles used by --intensity percentile (default: 0.5 99.5)")
+    rendering.add_argument("--prefetch",
+                           type=int,
+                           default=4,
+                           help="Files read ahead of the decoding stage (default: 4)")
+    rendering.add_argument("--writers",
+                           type=int,
+                           default=4,
+                           help="Threads writing the outputs (default: 4)")
+    rendering.add_argument("--output-root",
+                           type=Path,
+                           help=(
+                               "Write the outputs under this directory, mirroring the input tree, "
+                               "instead of in an OUTPUT folder next to each file"
+                               ))
+    rendering.add_argument("--shard",
+                           type=parse_shard,
+                           metavar="I/N",
+                           help=(
+                               "Process only shard I of N (0 <= I < N): run one process per "
+                               "shard, on one or more hosts, to cover the tree exactly once"
+                               ))
+    rendering.add_argument("--shard-by",
+                           choices=["file", "patient"],
+                           default="file",
+                           help=(
+                               "Assign single files (default) or whole patient folders to the "
+                               "shards, by a hash of their relative path"
+                               ))
+    rendering.add_argument("--cache-dir",
+                           type=Path,
+                           help=(
+                               "Cache of the encoded images, keyed by pixel data and options: "
+                               "identical images are linked or copied from it, not encoded again"
+                               ))
+    rendering.add_argument("--cache-size",
+                           type=parse_size,
+                           default="10G",
+                           help="Maximum size of --cache-dir, e.g. 500M (default: 10G)")
 
     subparser = parser.add_subparsers(dest="action", required=True)
 
     #Action 1: Elaborate file in DICOM format
     parser_a1 = subparser.add_parser("processing",
+                                     parents=[rendering],
                                      help=(
                                          "DICOM file processing requires two parameters: "
                                          "path and anonymous flag"
                                          )
                                     )
-    parser_a1.add_argument("--dicom_dir",
-                           type=Path,
-                           required=True,
-                           help="directory path")
-    parser_a1.add_argument("--anonymous",
+    parser_a1.add_argument("--force",
                            action="store_true",
-                           help="If set, anonymize patient data")
+                           help="If set, reprocess also the files whose outputs are up to date")
+    parser_a1.add_argument("--workers",
+                           type=int,
+                           default=1,
+                           help="Number of processes used to process the files (default: 1)")
+    parser_a1.add_argument("--metadata-out",
+                           type=Path,
+                           help="Export the metadata of all files to one JSON Lines (.jsonl) "
+                                "or CSV (.csv) file")
+    parser_a1.add_argument("--tags",
+                           nargs="+",
+                           help="Tags exported with --metadata-out, as keywords or GGGG,EEEE "
+                                "(default: patient, study, series and image tags)")
+    parser_a1.add_argument("--index",
+                           type=Path,
+                           help="Process only the files of this index matching --where")
+    parser_a1.add_argument("--where",
+                           nargs="+",
+                           default=[],
+                           help="Index conditions, as in the query subcommand")
+    parser_a1.add_argument("--scan-workers",
+                           type=int,
+                           default=8,
+                           help="Threads scanning the subdirectories for DICOM files (default: 8)")
+    parser_a1.add_argument("--archive",
+                           choices=["zip", "tar"],
+                           help="Write all the outputs into zip or tar archives instead of files")
+    parser_a1.add_argument("--archive-per",
+                           dest="archive_group",
+                           choices=["run", "patient"],
+                           default="run",
+                           help=(
+                               "One archive per run (OUTPUT.zip, default) or per patient folder "
+                               "(first-level folder of --dicom_dir)"
+                               ))
+    parser_a1.add_argument("--worklist",
+                           type=Path,
+                           help="Take the files of --shard from this work list (see worklist)")
 
     #Action 2: Frame acquisition from stdin (ultrasound device)
     parser_a2 = subparser.add_parser("acquire",
@@ -284,7 +1176,35 @@ def setup_parser() -> argparse.Namespace:
     parser_a2.add_argument("--output",
                            type=Path,
                            required=False,
-                           help="Image path")
+                           help="Image path (directory of the frames in continuous mode)")
+    parser_a2.add_argument("--frames",
+                           type=int,
+                           help="Continuous mode: number of frames to capture")
+    parser_a2.add_argument("--duration",
+                           type=float,
+                           help="Continuous mode: capture time in seconds")
+    parser_a2.add_argument("--fps",
+                           type=float,
+                           help="Continuous mode: maximum capture rate")
+    parser_a2.add_argument("--buffer",
+                           type=int,
+                           default=64,
+                           help="Continuous mode: frames buffered before dropping (default: 64)")
+    parser_a2.add_argument("--writers",
+                           type=int,
+                           default=2,
+                           help="Continuous mode: number of writer threads (default: 2)")
+    parser_a2.add_argument("--dedup",
+                           type=float,
+                           metavar="THRESHOLD",
+                           help=(
+                               "Continuous mode: save a frame only if its SSIM with the last "
+                               "saved frame is below THRESHOLD"
+                               ))
+    parser_a2.add_argument("--dedup-size",
+                           type=int,
+                           default=64,
+                           help="Continuous mode: image side used for the --dedup SSIM (default: 64)")
 
     #Action 3: Comparison between two images using Structural Similarity Index (SSIM)
     parser_a3 = subparser.add_parser("compare",
@@ -295,12 +1215,149 @@ def setup_parser() -> argparse.Namespace:
                                      )
     parser_a3.add_argument("--image1",
                            type=Path,
-                           required=True,
                            help="Path of the first image")
     parser_a3.add_argument("--image2",
                            type=Path,
-                           required=True,
                            help="Path of the second image")
+    parser_a3.add_argument("--reference",
+                           type=Path,
+                           help="Batch mode: reference image compared with every --candidates")
+    parser_a3.add_argument("--candidates",
+                           type=Path,
+                           nargs="+",
+                           help="Batch mode: images compared with --reference")
+    parser_a3.add_argument("--dir1",
+                           type=Path,
+                           help="Batch mode: first directory, paired with --dir2 by relative path")
+    parser_a3.add_argument("--dir2",
+                           type=Path,
+                           help="Batch mode: second directory")
+    parser_a3.add_argument("--output",
+                           type=Path,
+                           help="Batch mode: CSV or JSON (.json) file where the scores are saved")
+    parser_a3.add_argument("--workers",
+                           type=int,
+                           default=1,
+                           help="Batch mode: number of threads (default: 1)")
+    parser_a3.add_argument("--fast",
+                           action="store_true",
+                           help="Tiled SSIM without the full map, with optional downscale and threshold")
+    parser_a3.add_argument("--max-side",
+                           type=int,
+                           help="Fast mode: downscale the images to this longest side first")
+    parser_a3.add_argument("--tile",
+                           type=int,
+                           default=256,
+                           help="Fast mode: tile side in pixels (default: 256)")
+    parser_a3.add_argument("--threshold",
+                           type=float,
+                           help="Fast mode: pass/fail threshold, stops as soon as it is decided")
+
+    #Action 4: Index the headers of a DICOM tree
+    parser_a4 = subparser.add_parser("index",
+                                     help="Build or update the SQLite index of the DICOM headers")
+    parser_a4.add_argument("--dicom_dir",
+                           type=Path,
+                           required=True,
+                           help="directory path")
+    parser_a4.add_argument("--db",
+                           type=Path,
+                           default=Path("dicom_index.db"),
+                           help="Index database (default: dicom_index.db)")
+
+    #Action 5: Query the index
+    parser_a5 = subparser.add_parser("query", help="Search the index of the DICOM headers")
+    parser_a5.add_argument("--db",
+                           type=Path,
+                           default=Path("dicom_index.db"),
+                           help="Index database (default: dicom_index.db)")
+    parser_a5.add_argument("--where",
+                           nargs="+",
+                           default=[],
+                           help="Conditions TAG OP VALUE joined with AND, OP one of "
+                                "= != > >= < <= ~ (glob), e.g. Modality=US StudyDate>=20200101")
+    parser_a5.add_argument("--columns",
+                           nargs="+",
+                           default=["path"],
+                           help="Columns to print (default: path)")
+    parser_a5.add_argument("--format",
+                           dest="output_format",
+                           choices=["text", "csv", "json"],
+                           default="text",
+                           help="Output format (default: text, tab-separated)")
+    parser_a5.add_argument("--limit",
+                           type=int,
+                           help="Maximum number of results")
+
+    #Action 6: Split a DICOM tree into shards balanced by size
+    parser_a6 = subparser.add_parser("worklist",
+                                     help="Write a work list that splits a tree into N shards "
+                                          "of similar size, for processing --worklist")
+    parser_a6.add_argument("--dicom_dir",
+                           type=Path,
+                           required=True,
+                           help="directory path")
+    parser_a6.add_argument("--shards",
+                           type=int,
+                           required=True,
+                           help="Number of shards")
+    parser_a6.add_argument("--shard-by",
+                           choices=["file", "patient"],
+                           default="file",
+                           help="Balance single files (default) or whole patient folders")
+    parser_a6.add_argument("--output",
+                           type=Path,
+                           default=Path("worklist.json"),
+                           help="Work list file (default: worklist.json)")
+
+    #Action 7: Process the DICOM files as they arrive
+    parser_a7 = subparser.add_parser("watch",
+                                     parents=[rendering],
+                                     help="Watch a directory and process every new DICOM file "
+                                          "as soon as it is completely written")
+    parser_a7.add_argument("--interval",
+                           type=float,
+                           default=1.0,
+                           help="Seconds between two polls of the directory (default: 1)")
+    parser_a7.add_argument("--settle",
+                           type=float,
+                           default=2.0,
+                           help="Seconds a file must stay unchanged before it is processed "
+                                "(default: 2)")
+    parser_a7.add_argument("--batch",
+                           type=int,
+                           default=16,
+                           help="Maximum files processed together (default: 16)")
+    parser_a7.add_argument("--max-pending",
+                           type=int,
+                           default=256,
+                           help="Maximum settled files waiting to be processed; the polling "
+                                "pauses when they are reached (default: 256)")
+
+    #Action 8: Assemble the series into volumes
+    parser_a8 = subparser.add_parser("volumes",
+                                     help="Write every series of a tree as a memory-mappable "
+                                          ".npy volume with a JSON sidecar")
+    parser_a8.add_argument("--dicom_dir",
+                           type=Path,
+                           required=True,
+                           help="directory path")
+    parser_a8.add_argument("--output",
+                           type=Path,
+                           required=True,
+                           help="Directory of the volumes, <study UID>/<series UID>.npy")
+    parser_a8.add_argument("--order",
+                           choices=["auto", "position", "instance", "path"],
+                           default="auto",
+                           help="Slice order: ImagePositionPatient along the normal, "
+                                "InstanceNumber or path (default: auto, the first available)")
+    parser_a8.add_argument("--force",
+                           action="store_true",
+                           help="Write the volumes even if their files did not change")
+    parser_a8.add_argument("--scan-workers",
+                           type=int,
+                           default=8,
+                           help="Threads scanning the directory tree (default: 8)")
     return parser.parse_args()
 
 def main(arguments: argparse.Namespace) -> None:
@@ -313,11 +1370,95 @@ def main(arguments: argparse.Namespace) -> None:
     logging.debug("Verbosity: %s", arguments.verbosity)
     logging.debug("Action: %s", arguments.action)
 
+    collector = Metrics() if arguments.metrics_out is not None else None
+    profiler = cProfile.Profile() if arguments.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        _run_action(arguments, collector)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(arguments.profile)
+            logging.info("Profilo salvato in: %s", arguments.profile)
+        if collector is not None:
+            collector.write(arguments.metrics_out)
+            logging.info("Metriche salvate in: %s", arguments.metrics_out)
+
+
+# pylint: disable-next=too-many-branches,too-many-statements
+def _run_action(arguments: argparse.Namespace, collector: Metrics = None) -> None:
+    """
+    Runs the action selected on the command line.
+    """
     if arguments.action == "processing":
         logging.debug("DICOM dir: %s",arguments.dicom_dir)
         logging.debug("Anonymous: %s",arguments.anonymous)
-        processing_dicom = DICOM(arguments.dicom_dir, arguments.anonymous)
-        processing_dicom.processing()
+        logging.debug("Workers: %s",arguments.workers)
+        logging.debug("Force: %s",arguments.force)
+        logging.debug("PNG mode: %s",arguments.png_mode)
+        logging.debug("Formats: %s",arguments.formats)
+        logging.debug("Intensity: %s %s",arguments.intensity,arguments.percentiles)
+        logging.debug("Cache: %s %s",arguments.cache_dir,arguments.cache_size)
+        files = None
+        if arguments.index is not None:
+            from .index import Index
+            with Index(arguments.index) as index:
+                files = index.paths(arguments.where)
+        shard = arguments.shard
+        if arguments.worklist is not None:
+            if shard is None:
+                raise ValueError("--worklist requires --shard.")
+            listed = read_worklist(arguments.worklist, arguments.dicom_dir, shard)
+            if files is not None:
+                selected = {os.path.abspath(path) for path in files}
+                listed = [path for path in listed if os.path.abspath(path) in selected]
+            #The work list already selects the files of the shard
+            files, shard = listed, None
+        export = None
+        if arguments.metadata_out is not None:
+            from .export import DEFAULT_TAGS, MetadataExport
+            export = MetadataExport(arguments.metadata_out, arguments.tags or DEFAULT_TAGS)
+        cache = None
+        if arguments.cache_dir is not None:
+            cache = RenderCache(arguments.cache_dir, arguments.cache_size)
+        archive = None
+        if arguments.archive is not None:
+            from .archive import ArchiveSink
+            archive = ArchiveSink(arguments.output_root or arguments.dicom_dir,
+                                  arguments.archive, arguments.archive_group)
+        processing_dicom = DICOM(arguments.dicom_dir, arguments.anonymous,
+                                 workers=arguments.workers,
+                                 force=arguments.force,
+                                 png_mode=arguments.png_mode,
+                                 formats=arguments.formats,
+                                 intensity=arguments.intensity,
+                                 percentiles=arguments.percentiles,
+                                 prefetch=arguments.prefetch,
+                                 writers=arguments.writers,
+                                 metrics=collector,
+                                 files=files,
+                                 export=export,
+                                 scan_workers=arguments.scan_workers,
+                                 output_root=arguments.output_root,
+                                 archive=archive,
+                                 shard=shard,
+                                 shard_by=arguments.shard_by,
+                                 cache=cache)
+        try:
+            errors = processing_dicom.processing()
+        except BaseException:
+            #An interrupted run leaves the previous archives in place
+            if archive is not None:
+                archive.close(commit=False)
+            raise
+        finally:
+            if export is not None:
+                export.close()
+        if archive is not None:
+            archive.close()
+        if errors:
+            logging.error("%d file non elaborati", len(errors))
 
     elif arguments.action == "acquire":
         logging.debug("FD: %s",arguments.fd)
@@ -328,13 +1469,104 @@ def main(arguments: argparse.Namespace) -> None:
             source = arguments.video
         else:
             raise ValueError("You must provide either --fd or --video as the source!")
-        acquire(source, arguments.output)
+        if arguments.frames is None and arguments.duration is None:
+            acquire(source, arguments.output, metrics=collector)
+        else:
+            from . import capture
+            capture.acquire_sequence(source, arguments.output or Path("frames"),
+                                     frames=arguments.frames,
+                                     duration=arguments.duration,
+                                     fps=arguments.fps,
+                                     buffer_size=arguments.buffer,
+                                     writers=arguments.writers,
+                                     dedup_threshold=arguments.dedup,
+                                     dedup_size=arguments.dedup_size,
+                                     metrics=collector)
 
     elif arguments.action == "compare":
         logging.debug("Image1: %s", arguments.image1)
         logging.debug("Image2: %s",arguments.image2)
-        score = compare_image(arguments.image1,arguments.image2)
-        logging.info("Indice di similarità: %0.4f", score)
+        from . import similarity
+        if arguments.reference is not None and arguments.candidates:
+            pairs = similarity.pairs_one_to_many(arguments.reference, arguments.candidates)
+        elif arguments.dir1 is not None and arguments.dir2 is not None:
+            pairs = similarity.pairs_directories(arguments.dir1, arguments.dir2)
+        elif arguments.image1 is not None and arguments.image2 is not None:
+            if not arguments.fast:
+                score = compare_image(arguments.image1,arguments.image2,metrics=collector)
+                logging.info("Indice di similarità: %0.4f", score)
+                return
+            pairs = [(arguments.image1, arguments.image2)]
+        else:
+            raise ValueError(
+                "You must provide --image1 and --image2, --reference and --candidates, "
+                "or --dir1 and --dir2!")
+
+        fast = None
+        if arguments.fast:
+            fast = {"max_side": arguments.max_side, "tile": arguments.tile,
+                    "threshold": arguments.threshold}
+        rows = similarity.compare_batch(pairs, arguments.workers, fast=fast, metrics=collector)
+        for row in rows:
+            if row["score"] is not None:
+                logging.info("%s - %s: %0.4f %s", row["image1"], row["image2"], row["score"],
+                             {True: "(superato)", False: "(non superato)"}.get(row.get("passed"), ""))
+        if arguments.output is not None:
+            similarity.write_scores(rows, arguments.output)
+
+    elif arguments.action == "index":
+        logging.debug("DICOM dir: %s",arguments.dicom_dir)
+        logging.debug("Database: %s",arguments.db)
+        from .index import Index
+        with Index(arguments.db) as index:
+            index.update(arguments.dicom_dir)
+
+    elif arguments.action == "query":
+        logging.debug("Database: %s",arguments.db)
+        logging.debug("Where: %s",arguments.where)
+        from .index import Index, write_rows
+        if not arguments.db.is_file():
+            raise ValueError(f"{arguments.db} It is not an index: run the index subcommand first.")
+        with Index(arguments.db) as index:
+            rows = index.query(arguments.where, arguments.columns, arguments.limit)
+        write_rows(rows, arguments.columns, arguments.output_format)
+
+    elif arguments.action == "watch":
+        logging.debug("DICOM dir: %s",arguments.dicom_dir)
+        logging.debug("Interval: %s Settle: %s",arguments.interval,arguments.settle)
+        from .watch import Watcher
+        cache = None
+        if arguments.cache_dir is not None:
+            cache = RenderCache(arguments.cache_dir, arguments.cache_size)
+        processor = DICOM(arguments.dicom_dir, arguments.anonymous,
+                          png_mode=arguments.png_mode,
+                          formats=arguments.formats,
+                          intensity=arguments.intensity,
+                          percentiles=arguments.percentiles,
+                          prefetch=arguments.prefetch,
+                          writers=arguments.writers,
+                          metrics=collector,
+                          output_root=arguments.output_root,
+                          shard=arguments.shard,
+                          shard_by=arguments.shard_by,
+                          cache=cache)
+        watcher = Watcher(processor, arguments.interval, arguments.settle,
+                          arguments.batch, arguments.max_pending)
+        stats = watcher.run()
+        logging.info("File elaborati: %d, errori: %d", stats["processed"], stats["errors"])
+
+    elif arguments.action == "worklist":
+        logging.debug("DICOM dir: %s",arguments.dicom_dir)
+        logging.debug("Shards: %s %s",arguments.shards,arguments.shard_by)
+        write_worklist(arguments.output, arguments.dicom_dir, arguments.shards,
+                       arguments.shard_by)
+
+    elif arguments.action == "volumes":
+        logging.debug("DICOM dir: %s",arguments.dicom_dir)
+        logging.debug("Output: %s Order: %s",arguments.output,arguments.order)
+        from .volume import assemble
+        assemble(arguments.dicom_dir, arguments.output, arguments.order, arguments.force,
+                 metrics=collector, scan_workers=arguments.scan_workers)
 
     else:
         raise ValueError(f"Unknown action {arguments.action}")
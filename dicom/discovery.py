@@ -0,0 +1,118 @@
+"""
+Discovery of the DICOM files of a directory tree.
+
+A file is a DICOM file when its name ends with ``.dcm`` or, whatever its
+name, when it starts with the 128-byte preamble followed by the ``DICM``
+marker of the DICOM file format (PACS exports usually have no suffix). Only
+the files without the suffix are opened, and only their first 132 bytes are
+read.
+
+The tree is scanned with ``os.scandir``, which returns the file type with the
+directory entries, so no ``stat`` call is made per entry. The subdirectories
+are scanned concurrently by a thread pool: listing a directory and reading a
+preamble release the GIL, so the scan overlaps the latency of the file
+system. The ``OUTPUT`` directories written by processing are never entered
+and symbolic links to directories are not followed, as in ``os.walk``.
+"""
+
+# Standard library
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+PREAMBLE = 128
+MAGIC = b"DICM"
+SUFFIX = ".dcm"
+SKIPPED = ("OUTPUT",)
+
+
+def has_magic(path: str) -> bool:
+    """
+    Checks whether a file has the DICOM preamble and the DICM marker.
+    """
+    try:
+        with open(path, "rb") as f:
+            return f.read(PREAMBLE + len(MAGIC))[PREAMBLE:] == MAGIC
+    except OSError:
+        return False
+
+
+def is_dicom(path: str, sniff: bool = True) -> bool:
+    """
+    Checks whether a file is a DICOM file, by suffix or (if ``sniff``) by content.
+    """
+    return path.endswith(SUFFIX) or (sniff and has_magic(path))
+
+
+def scan_directory(directory: str, sniff: bool = True, skip: tuple = SKIPPED) -> tuple:
+    """
+    Lists a single directory.
+
+    Returns:
+    tuple: The sorted names of its DICOM files and the paths of the
+    subdirectories to scan.
+    """
+    files, directories = [], []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in skip:
+                            directories.append(entry.path)
+                    elif entry.is_file() and is_dicom(entry.path, sniff):
+                        files.append(entry.name)
+                except OSError as e:
+                    logging.warning("Impossibile leggere %s: %s", entry.path, e)
+    except OSError as e:
+        logging.warning("Impossibile leggere la cartella %s: %s", directory, e)
+    return sorted(files), sorted(directories)
+
+
+def iter_directories(root, workers: int = 8, sniff: bool = True, skip: tuple = SKIPPED):
+    """
+    Scans a tree and yields (directory, DICOM file names) for every directory
+    containing DICOM files, as soon as it has been listed.
+
+    The order depends on the scan; with ``workers`` equal to 1 the tree is
+    scanned in the calling thread, top-down and in name order.
+    """
+    root = os.fspath(root)
+    if workers <= 1:
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            files, directories = scan_directory(directory, sniff, skip)
+            if files:
+                yield directory, files
+            pending.extend(reversed(directories))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="discovery") as executor:
+        futures = {executor.submit(scan_directory, root, sniff, skip): root}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = futures.pop(future)
+                files, directories = future.result()
+                for subdirectory in directories:
+                    futures[executor.submit(scan_directory, subdirectory, sniff, skip)] = subdirectory
+                if files:
+                    yield directory, files
+
+
+def discover(root, workers: int = 8, sniff: bool = True, skip: tuple = SKIPPED) -> list:
+    """
+    Returns the sorted paths of the DICOM files under root.
+
+    Parameters:
+    root: directory to scan.
+    workers: threads scanning the subdirectories concurrently.
+    sniff: if False, only the ``.dcm`` suffix is checked and no file is opened.
+    skip: names of the directories that are never entered.
+    """
+    paths = [os.path.join(directory, file)
+             for directory, files in iter_directories(root, workers, sniff, skip)
+             for file in files]
+    paths.sort()
+    return paths
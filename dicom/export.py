@@ -0,0 +1,204 @@
+"""
+Bulk export of DICOM header metadata to a single JSON Lines or CSV file.
+
+Every processed file becomes one row with its path and the configured tags,
+always in the same order and with the same columns: a missing tag is null in
+JSON Lines and an empty field in CSV, so the files of different runs can be
+concatenated and loaded as a table. Multi-valued elements are JSON arrays, or
+values joined with a backslash (the DICOM separator) in CSV.
+
+Binary elements (OB, OW, OF, OD, OL, OV, UN), sequences and the pixel data are
+never exported. The rows are buffered and written in bulk.
+"""
+
+# Standard library
+import csv
+import io
+import json
+import os
+import threading
+
+# Third-party packages
+from pydicom.datadict import dictionary_VR, keyword_for_tag, tag_for_keyword
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+from pydicom.valuerep import DSdecimal, DSfloat, IS
+
+DEFAULT_TAGS = (
+    "PatientID", "PatientName", "PatientBirthDate", "PatientSex",
+    "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "SOPClassUID",
+    "TransferSyntaxUID", "Modality", "StudyDate", "StudyTime", "StudyDescription",
+    "SeriesDescription", "SeriesNumber", "InstanceNumber", "Manufacturer",
+    "ManufacturerModelName", "Rows", "Columns", "NumberOfFrames", "FrameTime",
+    "BitsAllocated", "PhotometricInterpretation",
+)
+EXCLUDED_VRS = {"OB", "OW", "OF", "OD", "OL", "OV", "UN", "SQ", "OB or OW", "US or OW"}
+FORMATS = ("jsonl", "csv")
+
+
+def parse_tag(spec: str) -> tuple:
+    """
+    Parses a tag given by keyword (e.g. "Modality") or as "GGGG,EEEE".
+
+    Returns:
+    tuple: The column name (the keyword if known) and the pydicom Tag.
+    """
+    spec = spec.strip()
+    if "," in spec:
+        try:
+            tag = Tag(*(int(part, 16) for part in spec.split(",")))
+        except ValueError as e:
+            raise ValueError(f"Invalid tag {spec!r}: expected a keyword or GGGG,EEEE") from e
+        name = keyword_for_tag(tag) or f"{tag.group:04X},{tag.element:04X}"
+    else:
+        value = tag_for_keyword(spec)
+        if value is None:
+            raise ValueError(f"Invalid tag {spec!r}: unknown keyword")
+        tag, name = Tag(value), spec
+    try:
+        excluded = dictionary_VR(tag) in EXCLUDED_VRS
+    except KeyError: # private or unknown tag: checked on each element
+        excluded = False
+    if excluded or tag == 0x7FE00010:
+        raise ValueError(f"Invalid tag {spec!r}: binary elements and sequences are not exported")
+    return name, tag
+
+
+def _convert(value):
+    """
+    Converts a single element value to a JSON-compatible type.
+    """
+    if isinstance(value, IS):
+        return int(value)
+    if isinstance(value, (DSfloat, DSdecimal)):
+        return float(value)
+    if isinstance(value, (int, float)) or value is None:
+        return value
+    if isinstance(value, bytes):
+        return None
+    return str(value)
+
+
+class MetadataExport():
+    """
+    Writer of the metadata rows of a run.
+
+    A copy sent to another process (e.g. pickled to a process pool) has no
+    file: its rows are taken back with ``take`` and written with ``extend``.
+
+    Parameters
+    ----------
+    path : str
+        Output file; the format is deduced from the suffix (.csv or .jsonl)
+        unless given.
+    tags : tuple
+        Tags to export, as keywords or "GGGG,EEEE".
+    output_format : str
+        "jsonl" or "csv".
+    buffer_rows : int
+        Rows kept in memory before they are written.
+    """
+    def __init__(self, path, tags: tuple = DEFAULT_TAGS, output_format: str = None,
+                 buffer_rows: int = 1000) -> None:
+        if output_format is None:
+            output_format = "csv" if os.path.splitext(str(path))[1].lower() == ".csv" else "jsonl"
+        if output_format not in FORMATS:
+            raise ValueError(f"Invalid format: expected one of {FORMATS}.")
+        self.path = path
+        self.output_format = output_format
+        self.tags = [parse_tag(tag) for tag in tags]
+        self.columns = ["path"] + [name for name, _ in self.tags]
+        self.buffer_rows = buffer_rows
+        self._rows = []
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            self._file = open(path, "w", encoding="utf-8", newline="") # pylint: disable=consider-using-with
+            if output_format == "csv":
+                csv.writer(self._file).writerow(self.columns)
+
+    def __getstate__(self) -> dict:
+        return {"tags": [spec for spec, _ in self.tags], "output_format": self.output_format}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(None, state["tags"], state["output_format"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def row(self, ds, source: str) -> dict:
+        """
+        Returns the metadata row of a dataset.
+        """
+        row = {"path": str(source)}
+        for name, tag in self.tags:
+            element = ds.get(tag)
+            if element is None and tag.group == 0x0002:
+                element = getattr(ds, "file_meta", {}).get(tag)
+            if element is None or element.VR in EXCLUDED_VRS:
+                row[name] = None
+            elif isinstance(element.value, (MultiValue, list)):
+                row[name] = [_convert(value) for value in element.value]
+            else:
+                row[name] = _convert(element.value)
+        return row
+
+    def add(self, ds, source: str) -> None:
+        """
+        Buffers the row of a dataset, writing the buffer when it is full.
+        """
+        self.extend([self.row(ds, source)])
+
+    def extend(self, rows: list) -> None:
+        """
+        Buffers rows produced by ``row``.
+        """
+        with self._lock:
+            self._rows.extend(rows)
+            if self._file is not None and len(self._rows) >= self.buffer_rows:
+                self._flush()
+
+    def take(self) -> list:
+        """
+        Returns and forgets the buffered rows.
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        return rows
+
+    def _flush(self) -> None:
+        """
+        Writes the buffered rows with a single write call.
+        """
+        buffer = io.StringIO()
+        if self.output_format == "csv":
+            writer = csv.writer(buffer)
+            writer.writerows([self._csv_value(row[c]) for c in self.columns] for row in self._rows)
+        else:
+            for row in self._rows:
+                buffer.write(json.dumps(row, ensure_ascii=False))
+                buffer.write("\n")
+        self._file.write(buffer.getvalue())
+        self._rows = []
+
+    @staticmethod
+    def _csv_value(value):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            return "\\".join("" if v is None else str(v) for v in value)
+        return value
+
+    def close(self) -> None:
+        """
+        Writes the remaining rows and closes the file.
+        """
+        if self._file is None:
+            return
+        with self._lock:
+            self._flush()
+        self._file.close()
+        self._file = None
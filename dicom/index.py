@@ -0,0 +1,253 @@
+"""
+SQLite index of the DICOM headers of a directory tree.
+
+Every DICOM file outside the ``OUTPUT`` directories (recognized by suffix or
+content, see discovery) gets one row with its
+absolute path, size, modification time, frame count and the tags in TAGS.
+Re-indexing reads again only the files whose size or modification time
+changed and removes the rows of the files that no longer exist, so updating
+a large tree costs little more than walking it.
+
+Queries are lists of conditions such as ``Modality=US`` or
+``StudyDate>=20200101`` joined with AND; the most selective columns have a
+SQLite index, so lookups take milliseconds on hundreds of thousands of rows.
+"""
+
+# Standard library
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+# Local modules
+from .discovery import discover
+
+# Tags stored in the index and their SQLite type
+TAGS = {
+    "PatientID": "TEXT",
+    "PatientName": "TEXT",
+    "StudyInstanceUID": "TEXT",
+    "SeriesInstanceUID": "TEXT",
+    "SOPInstanceUID": "TEXT",
+    "Modality": "TEXT",
+    "StudyDate": "TEXT",
+    "StudyDescription": "TEXT",
+    "SeriesDescription": "TEXT",
+    "InstanceNumber": "INTEGER",
+    "Rows": "INTEGER",
+    "Columns": "INTEGER",
+}
+COLUMNS = {"path": "TEXT", "size": "INTEGER", "mtime_ns": "INTEGER", "frames": "INTEGER", **TAGS}
+INDEXED = ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "Modality", "StudyDate")
+
+# Bump when COLUMNS changes: an index with another version is rebuilt
+SCHEMA_VERSION = 1
+
+OPERATORS = {"=": "=", "!=": "!=", ">=": ">=", "<=": "<=", ">": ">", "<": "<", "~": "GLOB"}
+_CONDITION = re.compile(r"^\s*(\w+)\s*(!=|>=|<=|=|>|<|~)\s*(.*?)\s*$")
+
+# Rows written per transaction while indexing
+BATCH_SIZE = 1000
+
+
+def parse_condition(condition: str) -> tuple:
+    """
+    Parses a condition "TAG OP VALUE", e.g. "Modality=US" or "PatientName~Liver*".
+
+    OP is one of =, !=, >, >=, <, <= or ~ (glob pattern, case sensitive).
+
+    Returns:
+    tuple: (column, SQL operator, value).
+    """
+    match = _CONDITION.match(condition)
+    if match is None:
+        raise ValueError(f"Invalid condition {condition!r}: expected TAG OP VALUE, "
+                         f"with OP one of {', '.join(OPERATORS)}")
+    column, operator, value = match.groups()
+    if column not in COLUMNS:
+        raise ValueError(f"Invalid condition {condition!r}: expected a column among "
+                         f"{', '.join(COLUMNS)}")
+    if COLUMNS[column] == "INTEGER" and operator != "~":
+        try:
+            value = int(value)
+        except ValueError as e:
+            raise ValueError(f"Invalid condition {condition!r}: {column} is an integer") from e
+    return column, OPERATORS[operator], value
+
+
+def _value(ds, tag: str):
+    """
+    Returns the value of a tag to store in the index, None if absent.
+    """
+    value = ds.get(tag)
+    if value is None or value == "":
+        return None
+    if TAGS[tag] == "INTEGER":
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+    return str(value)
+
+
+def write_rows(rows: list, columns: list, output_format: str = "text", stream=None) -> None:
+    """
+    Writes query results as tab-separated text, CSV or JSON (default: stdout).
+    """
+    stream = stream if stream is not None else sys.stdout
+    if output_format == "json":
+        json.dump(rows, stream, indent=1)
+        stream.write("\n")
+    elif output_format == "csv":
+        writer = csv.DictWriter(stream, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            stream.write("\t".join("" if row[c] is None else str(row[c]) for c in columns) + "\n")
+
+
+class Index():
+    """
+    Metadata index stored in a SQLite database.
+
+    Parameters
+    ----------
+    path : str
+        Database file, created if missing.
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self._create()
+
+    def _create(self) -> None:
+        """
+        Creates the tables, rebuilding them if the schema changed.
+        """
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        with self.connection:
+            if version != SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS files")
+            columns = ", ".join(f"{name} {kind}" for name, kind in COLUMNS.items())
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS files ({columns}, PRIMARY KEY (path))")
+            for column in INDEXED:
+                self.connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS files_{column} ON files ({column})")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self) -> None:
+        """
+        Closes the database.
+        """
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def update(self, root) -> dict:
+        """
+        Indexes the DICOM files under root, reading only new or changed files.
+
+        A file that disappears while the tree is scanned (e.g. a folder still
+        being filled or cleaned) is treated as removed.
+
+        Returns:
+        dict: Number of files added, updated, removed, unchanged and unreadable.
+        """
+        import pydicom # pylint: disable=import-outside-toplevel
+
+        root = os.path.abspath(root)
+        prefix = os.path.join(root, "")
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            "SELECT path, size, mtime_ns FROM files WHERE substr(path, 1, ?) = ?",
+            (len(prefix), prefix))}
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "errors": 0}
+        rows = []
+        insert = (f"INSERT OR REPLACE INTO files ({', '.join(COLUMNS)}) "
+                  f"VALUES ({', '.join('?' * len(COLUMNS))})")
+
+        for path in discover(root):
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                # Deleted or moved since it was found: its row, if any, is removed
+                logging.warning("File %s non più accessibile: %s", path, e)
+                continue
+            previous = known.pop(path, None)
+            if previous == (stat.st_size, stat.st_mtime_ns):
+                stats["unchanged"] += 1
+                continue
+            try:
+                ds = pydicom.dcmread(path, stop_before_pixels=True,
+                                     specific_tags=[*TAGS, "NumberOfFrames"])
+            except Exception as e: # pylint: disable=broad-exception-caught
+                logging.error("Impossibile indicizzare il file %s: %s", path, e)
+                stats["errors"] += 1
+                continue
+            stats["added" if previous is None else "updated"] += 1
+            rows.append((path, stat.st_size, stat.st_mtime_ns,
+                         int(ds.get("NumberOfFrames", 1) or 1),
+                         *(_value(ds, tag) for tag in TAGS)))
+            if len(rows) >= BATCH_SIZE:
+                with self.connection:
+                    self.connection.executemany(insert, rows)
+                rows = []
+
+        with self.connection:
+            self.connection.executemany(insert, rows)
+            self.connection.executemany("DELETE FROM files WHERE path = ?",
+                                        [(path,) for path in known])
+        stats["removed"] = len(known)
+        if stats["added"] or stats["updated"] or stats["removed"]:
+            # Statistics let SQLite pick the most selective index of a query
+            self.connection.execute("ANALYZE")
+        logging.info("Indice %s: %d aggiunti, %d aggiornati, %d rimossi, %d invariati, %d errori",
+                     self.path, stats["added"], stats["updated"], stats["removed"],
+                     stats["unchanged"], stats["errors"])
+        return stats
+
+    def query(self, conditions: list = (), columns: list = None, limit: int = None) -> list:
+        """
+        Returns the rows matching all the conditions, ordered by path.
+
+        Parameters:
+        conditions: strings accepted by parse_condition.
+        columns: columns to return (default: all).
+        limit: maximum number of rows.
+
+        Returns:
+        list: One dict per file.
+        """
+        columns = list(columns) if columns else list(COLUMNS)
+        unknown = [column for column in columns if column not in COLUMNS]
+        if unknown:
+            raise ValueError(f"Invalid columns {unknown}: expected some of {', '.join(COLUMNS)}")
+
+        clauses, parameters = [], []
+        for column, operator, value in map(parse_condition, conditions):
+            clauses.append(f"{column} {operator} ?")
+            parameters.append(value)
+        sql = f"SELECT {', '.join(columns)} FROM files"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY path"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        return [dict(zip(columns, row)) for row in self.connection.execute(sql, parameters)]
+
+    def paths(self, conditions: list = ()) -> list:
+        """
+        Returns the paths of the files matching all the conditions.
+        """
+        return [row["path"] for row in self.query(conditions, columns=["path"])]
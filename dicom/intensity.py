@@ -0,0 +1,203 @@
+"""
+Mapping of stored DICOM pixel values to 8-bit display values.
+
+The stored values are first converted with the modality LUT (RescaleSlope and
+RescaleIntercept) and then mapped to 0-255 with one of the strategies:
+
+- ``minmax``: values are clipped at 0 and divided by the maximum, as done by
+  the original JPG/GIF export.
+- ``window``: the VOI window of the file (WindowCenter/WindowWidth) with the
+  DICOM linear function.
+- ``percentile``: values are clipped between two percentiles and stretched.
+
+For 8 and 16 bit integer data the whole mapping is precomputed as a lookup
+table over every possible stored value, so an image is converted with a
+single indexing operation and no floating point copy of it is ever made.
+"""
+
+# Standard library
+import logging
+from collections.abc import Sequence
+
+# Third-party packages
+import numpy as np
+
+STRATEGIES = ("minmax", "window", "percentile")
+
+
+def _first(value):
+    """
+    Returns the first value of a multi-valued element.
+    """
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return value[0]
+    return value
+
+
+class IntensityMapper():
+    """
+    Maps the stored pixel values of a dataset to uint8.
+
+    The statistics required by the strategy are accumulated with ``fit`` one
+    frame at a time, then ``apply`` converts each frame.
+
+    Parameters
+    ----------
+    ds : pydicom.Dataset
+        Dataset whose pixels are mapped.
+    strategy : str
+        One of STRATEGIES.
+    percentiles : tuple
+        Lower and upper percentile used by the "percentile" strategy.
+    """
+    def __init__(self, ds, strategy:str = "minmax", percentiles:tuple = (0.5, 99.5)) -> None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Invalid strategy: expected one of {STRATEGIES}.")
+        if not 0 <= percentiles[0] < percentiles[1] <= 100:
+            raise ValueError("Invalid percentiles: expected 0 <= low < high <= 100.")
+
+        self.strategy = strategy
+        self.percentiles = percentiles
+        self.slope = float(ds.get("RescaleSlope", 1) or 1)
+        self.intercept = float(ds.get("RescaleIntercept", 0) or 0)
+        self.invert = ds.get("PhotometricInterpretation") == "MONOCHROME1"
+        self.window = None
+
+        if strategy == "window":
+            center, width = ds.get("WindowCenter"), ds.get("WindowWidth")
+            if center is None or width is None:
+                logging.warning("WindowCenter/WindowWidth assenti, uso la strategia minmax")
+                self.strategy = "minmax"
+            else:
+                self.window = (float(_first(center)), float(_first(width)))
+
+        self._dtype = None
+        self._histogram = None
+        self._min = None
+        self._max = None
+        self._lut = None
+
+    def fit(self, frames):
+        """
+        Accumulates the statistics of the given frames.
+
+        Parameters:
+        frames: iterable of arrays, e.g. the frames of a multi-frame image.
+
+        Returns:
+        IntensityMapper: self, to allow chaining.
+        """
+        for frame in frames:
+            self._dtype = frame.dtype
+            if self.strategy == "window":
+                continue
+            if self._lut_size(frame.dtype) and self.strategy == "percentile":
+                counts = np.bincount(self._index(frame).ravel(),
+                                     minlength=self._lut_size(frame.dtype))
+                self._histogram = counts if self._histogram is None else self._histogram + counts
+            else:
+                low, high = frame.min(), frame.max()
+                self._min = low if self._min is None else min(self._min, low)
+                self._max = high if self._max is None else max(self._max, high)
+        self._lut = None
+        return self
+
+    def apply(self, frame):
+        """
+        Maps a frame to uint8 with the statistics collected by ``fit``.
+        """
+        size = self._lut_size(frame.dtype)
+        if size:
+            if self._lut is None:
+                self._lut = self._map(self._stored_values(frame.dtype))
+            return self._lut[self._index(frame)]
+        return self._map(frame.astype(np.float32))
+
+    @staticmethod
+    def _lut_size(dtype) -> int:
+        """
+        Returns the lookup table size for 8/16-bit integers, or 0 if none is used.
+        """
+        if dtype.kind in "ui" and dtype.itemsize <= 2:
+            return 1 << (8 * dtype.itemsize)
+        return 0
+
+    @staticmethod
+    def _index(frame):
+        """
+        Returns the lookup table index of every pixel, i.e. its unsigned bit pattern.
+        """
+        if frame.dtype.kind == "i":
+            return frame.view(np.dtype(f"u{frame.dtype.itemsize}"))
+        return frame
+
+    @staticmethod
+    def _stored_values(dtype):
+        """
+        Returns every stored value of dtype, ordered by its unsigned bit pattern.
+        """
+        unsigned = np.dtype(f"u{dtype.itemsize}")
+        return np.arange(1 << (8 * dtype.itemsize), dtype=unsigned).view(dtype)
+
+    def _map(self, stored):
+        """
+        Applies modality LUT and strategy to an array of stored values.
+        """
+        values = stored * self.slope + self.intercept
+
+        if self.strategy == "minmax":
+            high = self._modality_bounds()[1]
+            if high is None or high <= 0:
+                return np.zeros(values.shape, dtype=np.uint8)
+            np.maximum(values, 0, out=values)
+            np.divide(values, high, out=values)
+            np.multiply(values, 255, out=values)
+            return values.astype(np.uint8)
+
+        if self.strategy == "window":
+            center, width = self.window
+            if width <= 1:
+                values = np.where(values > center - 0.5, 255.0, 0.0)
+            else:
+                values = ((values - (center - 0.5)) / (width - 1) + 0.5) * 255
+        else:
+            low, high = self._percentile_bounds()
+            if low is None or high <= low:
+                return np.zeros(values.shape, dtype=np.uint8)
+            values = (values - low) / (high - low) * 255
+
+        out = np.rint(np.clip(values, 0, 255)).astype(np.uint8)
+        return 255 - out if self.invert else out
+
+    def _modality_bounds(self) -> tuple:
+        """
+        Returns the minimum and maximum modality value seen by ``fit``.
+        """
+        if self._min is None:
+            return None, None
+        bounds = sorted((self._min * self.slope + self.intercept,
+                         self._max * self.slope + self.intercept))
+        return bounds[0], bounds[1]
+
+    def _percentile_bounds(self) -> tuple:
+        """
+        Returns the modality values at the configured percentiles.
+        """
+        if self._histogram is None:
+            if self._min is None:
+                return None, None
+            # Data without lookup table: only the range is known
+            return self._modality_bounds()
+        total = self._histogram.sum()
+        if total == 0:
+            return None, None
+        order = np.argsort(self._stored_values(self._dtype), kind="stable")
+        cumulative = np.cumsum(self._histogram[order])
+        values = self._stored_values(self._dtype)[order]
+        low = values[np.searchsorted(cumulative, total * self.percentiles[0] / 100, side="right")
+                     .clip(0, len(values) - 1)]
+        high = values[np.searchsorted(cumulative, total * self.percentiles[1] / 100, side="left")
+                      .clip(0, len(values) - 1)]
+        bounds = sorted((float(low) * self.slope + self.intercept,
+                         float(high) * self.slope + self.intercept))
+        return bounds[0], bounds[1]
@@ -0,0 +1,170 @@
+"""
+Persistent manifest of the files already processed in an output directory.
+
+The manifest is a JSON file stored inside every ``OUTPUT`` directory. For each
+source DICOM file it records size, modification time, SHA-256 digest, the
+processing options and the names of the outputs written, so that a later run
+can skip the files whose outputs are still current.
+
+Several processes (e.g. the shards of a run) may process files of the same
+directory: ``save`` merges the entries changed by this process into the
+manifest on disk while holding a lock on the directory, so no entry of the
+other processes is lost.
+"""
+
+# Standard library
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the SHA-256 digest of a file, reading it in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(path: str) -> dict:
+    """
+    Returns size, modification time and SHA-256 digest of a file, as
+    recorded in the manifest.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path)}
+
+
+@contextmanager
+def _locked(directory: str):
+    """
+    Holds an exclusive lock on a directory, where flock is available.
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+class Manifest():
+    """
+    Manifest of a single output directory.
+
+    Parameters
+    ----------
+    directory : str
+        Output directory where the manifest is stored.
+    """
+    FILE_NAME = ".manifest.json"
+
+    def __init__(self, directory: str) -> None:
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.entries = self._load()
+        self.changed = False
+        self._changes = set()
+
+    def _load(self) -> dict:
+        """
+        Reads the manifest on disk, empty if missing or unreadable.
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Manifest %s non leggibile, verrà ricreato: %s", self.path, e)
+            return {}
+
+    def is_current(self, source: str, options: dict) -> bool:
+        """
+        Checks whether the outputs recorded for ``source`` are up to date.
+
+        Size and modification time are compared first; the content digest
+        is computed only when the size matches but the timestamp does not.
+        """
+        entry = self.entries.get(os.path.basename(source))
+        if entry is None or entry["options"] != options:
+            return False
+
+        directory = os.path.dirname(self.path)
+        if not all(os.path.isfile(os.path.join(directory, name)) for name in entry["outputs"]):
+            return False
+
+        stat = os.stat(source)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns != entry["mtime_ns"]:
+            if file_digest(source) != entry["sha256"]:
+                return False
+            entry["mtime_ns"] = stat.st_mtime_ns
+            self.changed = True
+            self._changes.add(os.path.basename(source))
+        return True
+
+    def update(self, source: str, options: dict, outputs: list,
+               source_fingerprint: dict = None) -> None:
+        """
+        Records the outputs written for ``source`` with the given options.
+
+        ``source_fingerprint`` is the result of ``fingerprint(source)`` taken
+        when the source was read; without it the source is read again.
+        """
+        if source_fingerprint is None:
+            source_fingerprint = fingerprint(source)
+        self.entries[os.path.basename(source)] = {
+            **source_fingerprint,
+            "options": options,
+            "outputs": sorted(os.path.basename(output) for output in outputs),
+        }
+        self.changed = True
+        self._changes.add(os.path.basename(source))
+
+    def discard(self, source: str) -> None:
+        """
+        Removes ``source`` from the manifest so that it is processed again.
+        """
+        if self.entries.pop(os.path.basename(source), None) is not None:
+            self.changed = True
+            self._changes.add(os.path.basename(source))
+
+    def save(self) -> None:
+        """
+        Writes the manifest atomically if it has been modified.
+
+        Only the entries changed by this instance are applied to the current
+        content of the file, which may have been saved by another process.
+        """
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with _locked(directory):
+            entries = self._load()
+            for name in self._changes:
+                if name in self.entries:
+                    entries[name] = self.entries[name]
+                else:
+                    entries.pop(name, None)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        self.entries = entries
+        self.changed = False
+        self._changes = set()
@@ -0,0 +1,178 @@
+"""
+Lightweight per-stage instrumentation of processing, compare and acquire.
+
+Each timed stage of an item (a DICOM file, an image pair, a frame) becomes a
+record with its wall time, bytes read and written, frame count and memory:
+the resident set size when the stage ended, its change during the stage and
+how much the stage raised the peak RSS of the process. ``summary`` aggregates
+the records per stage and per item and ``write`` saves them as JSON.
+
+The memory is that of the whole process: a stage running in a thread next to
+others (e.g. the writers of the pipeline) is charged their allocations too.
+
+The functions of the package receive an optional ``Metrics`` instance: when
+it is None the ``stage`` helper returns a no-op context, so the hot paths pay
+for a single function call.
+"""
+
+# Standard library
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+COUNTERS = ("bytes_read", "bytes_written", "frames")
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """
+    Returns the peak resident set size in MiB of this process (or of its
+    terminated children), or None where it is not available.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def rss_mb() -> float:
+    """
+    Returns the current resident set size in MiB of this process, or None
+    where /proc/self/statm is not available.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+def _delta(end, start):
+    return None if end is None or start is None else end - start
+
+
+class Metrics():
+    """
+    Thread-safe collector of stage records.
+
+    A copy sent to another process (e.g. pickled to a process pool) starts
+    empty: its records are sent back and added with ``merge``.
+    """
+    def __init__(self) -> None:
+        self.records = []
+        self.info = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def __getstate__(self) -> dict:
+        return {}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+
+    @contextmanager
+    def stage(self, name: str, item=None, **counters):
+        """
+        Times the body of the with statement as stage ``name`` of ``item``.
+
+        The yielded record can be updated with the counters known only at
+        the end of the stage, e.g. ``record["bytes_written"] = f.tell()``.
+        """
+        record = {"item": None if item is None else str(item), "stage": name,
+                  "seconds": 0.0, **dict.fromkeys(COUNTERS, 0), **counters}
+        rss, peak = rss_mb(), peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["rss_mb"] = rss_mb()
+            record["rss_delta_mb"] = _delta(record["rss_mb"], rss)
+            record["peak_rss_delta_mb"] = _delta(peak_rss_mb(), peak)
+            with self._lock:
+                self.records.append(record)
+
+    def merge(self, records: list) -> None:
+        """
+        Adds the records collected by another Metrics instance.
+        """
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self) -> dict:
+        """
+        Returns the totals of the run, per stage and per item.
+        """
+        with self._lock:
+            records = list(self.records)
+
+        def empty():
+            return {"count": 0, "seconds": 0.0, "max_seconds": 0.0, **dict.fromkeys(COUNTERS, 0),
+                    "max_rss_delta_mb": None, "peak_rss_delta_mb": None}
+
+        def add_memory(total, record):
+            if record["rss_delta_mb"] is not None:
+                total["max_rss_delta_mb"] = max(
+                    (v for v in (record["rss_delta_mb"], total["max_rss_delta_mb"])
+                     if v is not None))
+            if record["peak_rss_delta_mb"] is not None:
+                total["peak_rss_delta_mb"] = ((total["peak_rss_delta_mb"] or 0)
+                                              + record["peak_rss_delta_mb"])
+
+        stages, items = {}, {}
+        for record in records:
+            total = stages.setdefault(record["stage"], empty())
+            total["count"] += 1
+            total["seconds"] += record["seconds"]
+            total["max_seconds"] = max(total["max_seconds"], record["seconds"])
+            for counter in COUNTERS:
+                total[counter] += record[counter]
+            add_memory(total, record)
+
+            if record["item"] is not None:
+                item = items.setdefault(record["item"], {"seconds": 0.0, "stages": {},
+                                                         **dict.fromkeys(COUNTERS, 0),
+                                                         "max_rss_delta_mb": None,
+                                                         "peak_rss_delta_mb": None})
+                item["seconds"] += record["seconds"]
+                item["stages"][record["stage"]] = (item["stages"].get(record["stage"], 0.0)
+                                                   + record["seconds"])
+                for counter in COUNTERS:
+                    item[counter] += record[counter]
+                add_memory(item, record)
+
+        for total in stages.values():
+            total["mean_seconds"] = total["seconds"] / total["count"]
+        return {
+            "elapsed": time.perf_counter() - self._start,
+            "process_peak_rss_mb": peak_rss_mb(),
+            "children_peak_rss_mb": peak_rss_mb(children=True),
+            "totals": {counter: sum(s[counter] for s in stages.values()) for counter in COUNTERS},
+            "info": dict(self.info),
+            "stages": stages,
+            "items": items,
+        }
+
+    def write(self, path) -> None:
+        """
+        Saves the summary as JSON.
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+def stage(metrics: Metrics, name: str, item=None, **counters):
+    """
+    Returns ``metrics.stage(...)``, or a no-op context if metrics is None.
+    """
+    if metrics is None:
+        return nullcontext({})
+    return metrics.stage(name, item, **counters)
@@ -0,0 +1,99 @@
+"""
+Staged pipeline used to process many files with overlapping I/O and compute.
+
+The items go through three stages connected by bounded queues:
+
+- a reader thread that prefetches the input of the next items;
+- the render stage, run by the calling thread, that turns each input into a
+  list of write tasks;
+- a pool of writer threads that executes the write tasks.
+
+Disk reads and writes therefore overlap with the decoding of the current
+item, while the bounds keep the memory used by queued items limited.
+"""
+
+# Standard library
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+# pylint: disable-next=too-many-arguments,too-many-locals
+def run(items: list, read, render, write, key=None, prefetch: int = 4, writers: int = 4) -> tuple:
+    """
+    Runs read -> render -> write over the items.
+
+    Parameters:
+    items: items to process.
+    read: function(item) -> data, run in the reader thread.
+    render: function(item, data) -> list of write tasks, run in the calling thread.
+    write: function(task) -> result, run in the writer pool.
+    key: function(item) -> hashable key of the results (default: the item).
+    prefetch: number of items read ahead of the render stage.
+    writers: number of writer threads; at most 2 * writers tasks wait for them.
+
+    Returns:
+    tuple: (results, errors) dicts keyed by item: the results of the write
+    tasks of every successful item, and the exception of every failed one.
+    """
+    if prefetch < 1 or writers < 1:
+        raise ValueError("Invalid pipeline size: expected positive integers.")
+    key = key if key is not None else (lambda item: item)
+
+    inputs = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def reader():
+        for item in items:
+            if stop.is_set():
+                break
+            try:
+                inputs.put((item, read(item), None))
+            except Exception as e: # pylint: disable=broad-exception-caught
+                inputs.put((item, None, e))
+        inputs.put(_DONE)
+
+    thread = threading.Thread(target=reader, name="pipeline-reader", daemon=True)
+    thread.start()
+
+    slots = threading.BoundedSemaphore(2 * writers)
+    pending = {}
+    errors = {}
+    try:
+        with ThreadPoolExecutor(max_workers=writers, thread_name_prefix="pipeline-writer") as pool:
+            while (entry := inputs.get()) is not _DONE:
+                item, data, error = entry
+                if error is None:
+                    try:
+                        tasks = render(item, data)
+                    except Exception as e: # pylint: disable=broad-exception-caught
+                        error = e
+                if error is not None:
+                    errors[key(item)] = error
+                    continue
+
+                futures = []
+                for task in tasks:
+                    slots.acquire() # pylint: disable=consider-using-with
+                    future = pool.submit(write, task)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+                pending[key(item)] = futures
+    finally:
+        stop.set()
+        # Unblocks the reader if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                inputs.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+    results = {}
+    for item_key, futures in pending.items():
+        try:
+            results[item_key] = [future.result() for future in futures]
+        except Exception as e: # pylint: disable=broad-exception-caught
+            errors[item_key] = e
+    return results, errors
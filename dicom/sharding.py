@@ -0,0 +1,147 @@
+"""
+Deterministic split of the DICOM files of a tree over N shards.
+
+Independent processes or hosts run ``processing --shard i/N`` (i from 0 to
+N-1) on the same tree and together cover every file exactly once:
+
+- with hashing (the default) a file belongs to shard ``hash(key) % N``,
+  where the key is its path relative to the tree, or its patient folder
+  (the first-level folder) with ``by="patient"``, so that a patient is never
+  split. The assignment depends only on the key, so it is the same on every
+  host whatever the mount point, and it does not need any coordination;
+- a work list, written once by ``write_worklist``, assigns the files (or the
+  patient folders) to the shards by size, largest first, to the shard with
+  the fewest bytes so far, so the shards read about the same volume.
+"""
+
+# Standard library
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import os
+
+# Local modules
+from .discovery import discover
+
+GROUPS = ("file", "patient")
+WORKLIST_VERSION = 1
+
+
+def parse_shard(value: str) -> tuple:
+    """
+    Parses a shard "i/N" with 0 <= i < N, e.g. "0/4".
+
+    Returns:
+    tuple: (i, N).
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}: expected i/N") from e
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}: expected 0 <= i < N")
+    return index, count
+
+
+def shard_key(path: str, root: str, by: str = "file") -> str:
+    """
+    Returns the key of a file: its path relative to root, with / separators,
+    or the first component of that path (the patient folder).
+    """
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(root)).replace(os.sep, "/")
+    return relative.split("/", 1)[0] if by == "patient" else relative
+
+
+def shard_of(key: str, count: int) -> int:
+    """
+    Returns the shard of a key, the same in every process and Python version.
+    """
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def select(paths: list, root: str, shard: tuple, by: str = "file") -> list:
+    """
+    Returns the paths assigned by hashing to shard ``(i, N)``.
+    """
+    if by not in GROUPS:
+        raise ValueError(f"Invalid shard grouping: expected one of {GROUPS}.")
+    index, count = shard
+    return [path for path in paths if shard_of(shard_key(path, root, by), count) == index]
+
+
+def balance(sizes: dict, root: str, count: int, by: str = "file") -> dict:
+    """
+    Assigns the files to ``count`` shards by byte volume.
+
+    The groups (files or patient folders) are taken from the largest to the
+    smallest and each goes to the shard with the fewest bytes, ties broken
+    by key so the result is reproducible.
+
+    Parameters:
+    sizes: size in bytes of every path.
+
+    Returns:
+    dict: Shard of every path.
+    """
+    if by not in GROUPS:
+        raise ValueError(f"Invalid shard grouping: expected one of {GROUPS}.")
+    groups = {}
+    for path in sizes:
+        groups.setdefault(shard_key(path, root, by), []).append(path)
+    volumes = {key: sum(sizes[path] for path in members) for key, members in groups.items()}
+
+    shards = [(0, index) for index in range(count)]
+    assignment = {}
+    for key in sorted(groups, key=lambda key: (-volumes[key], key)):
+        volume, index = heapq.heappop(shards)
+        for path in groups[key]:
+            assignment[path] = index
+        heapq.heappush(shards, (volume + volumes[key], index))
+    return assignment
+
+
+def write_worklist(path, root, count: int, by: str = "file", scan_workers: int = 8) -> list:
+    """
+    Scans the tree and writes a JSON work list of ``count`` balanced shards.
+
+    The paths are stored relative to root, so the list can be used on hosts
+    where the tree is mounted elsewhere.
+
+    Returns:
+    list: Bytes assigned to each shard.
+    """
+    if count < 1:
+        raise ValueError("Invalid shards: expected a positive integer.")
+    sizes = {file: os.path.getsize(file) for file in discover(root, scan_workers)}
+    assignment = balance(sizes, root, count, by)
+    entries = [{"path": shard_key(file, root), "size": size, "shard": assignment[file]}
+               for file, size in sizes.items()]
+    volumes = [0] * count
+    for entry in entries:
+        volumes[entry["shard"]] += entry["size"]
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"version": WORKLIST_VERSION, "shards": count, "by": by,
+                   "bytes": volumes, "files": entries}, f, indent=1)
+    logging.info("Lista di lavoro %s: %d file in %d shard, byte per shard: %s",
+                 path, len(entries), count, volumes)
+    return volumes
+
+
+def read_worklist(path, root, shard: tuple) -> list:
+    """
+    Returns the files of shard ``(i, N)`` of a work list, joined to root.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        worklist = json.load(f)
+    if worklist.get("version") != WORKLIST_VERSION:
+        raise ValueError(f"Invalid work list {path}: expected version {WORKLIST_VERSION}.")
+    index, count = shard
+    if worklist["shards"] != count:
+        raise ValueError(f"Invalid shard {index}/{count}: "
+                         f"the work list {path} has {worklist['shards']} shards.")
+    return [os.path.join(root, *entry["path"].split("/"))
+            for entry in worklist["files"] if entry["shard"] == index]
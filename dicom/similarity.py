@@ -0,0 +1,288 @@
+"""
+Batch comparison of images with the Structural Similarity Index (SSIM).
+
+Two forms are supported:
+- one reference image against many candidates;
+- two directories, pairing the images with the same relative path.
+
+Every image is decoded and converted to grayscale once, then the pairs are
+scored on a thread pool and the scores can be saved as CSV or JSON.
+
+``fast_ssim`` is a faster variant of the scalar SSIM: it never builds the
+full-resolution map, can downscale the images first and works tile by tile,
+stopping as soon as a pass/fail threshold is decided.
+"""
+
+# Standard library
+import csv
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+# Third-party packages
+import cv2
+
+# Local modules
+from .metrics import stage
+
+VALID_EXTENSIONS = {".jpg", ".png"}
+
+# Default window of skimage.metrics.structural_similarity
+WIN_SIZE = 7
+
+
+class SSIMResult(NamedTuple):
+    """
+    Result of ``fast_ssim``.
+
+    ``score`` is the SSIM of the tiles processed; when the computation stops
+    early it is an estimate and the exact value lies in [low, high].
+    ``passed`` is None when no threshold was given.
+    """
+    score: float
+    low: float
+    high: float
+    passed: bool = None
+    ssim_map: object = None
+
+
+def downscale(image, max_side: int):
+    """
+    Reduces the image so that its longest side is at most max_side pixels.
+    """
+    height, width = image.shape[:2]
+    if max_side is None or max(height, width) <= max_side:
+        return image
+    scale = max_side / max(height, width)
+    size = (max(WIN_SIZE, round(width * scale)), max(WIN_SIZE, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA) # pylint: disable=c-extension-no-member
+
+
+# pylint: disable-next=too-many-arguments,too-many-locals
+def fast_ssim(image1, image2, max_side: int = None, tile: int = 256,
+              threshold: float = None, full: bool = False) -> SSIMResult:
+    """
+    Computes the SSIM of two grayscale images tile by tile.
+
+    Each tile is extended by half a window on every side, so the local SSIM
+    values are the same as on the whole image and, without downscaling and
+    early exit, the score equals ``structural_similarity``.
+
+    Parameters:
+    image1, image2: uint8 grayscale images with the same shape.
+    max_side: if set, both images are first downscaled to this longest side.
+    tile: side of the tiles in pixels.
+    threshold: if set, stops as soon as score >= threshold is decided.
+    full: if True, also returns the full SSIM map (no tiling, no early exit).
+    """
+    if image1.shape != image2.shape:
+        raise ValueError(f"different sizes {image1.shape} and {image2.shape}")
+    if min(image1.shape[:2]) < WIN_SIZE:
+        raise ValueError(f"images smaller than the {WIN_SIZE}x{WIN_SIZE} SSIM window")
+    if tile < 1:
+        raise ValueError("Invalid tile: expected a positive integer.")
+    # Imported here: scikit-image loads scipy.stats, too slow for the
+    # modules that only need downscale (e.g. capture without dedup)
+    from skimage.metrics import structural_similarity # pylint: disable=import-outside-toplevel
+
+    image1, image2 = downscale(image1, max_side), downscale(image2, max_side)
+
+    if full:
+        score, ssim_map = structural_similarity(image1, image2, data_range=255, full=True)
+        passed = None if threshold is None else bool(score >= threshold)
+        return SSIMResult(float(score), float(score), float(score), passed, ssim_map)
+
+    pad = (WIN_SIZE - 1) // 2
+    height, width = image1.shape[:2]
+    total = (height - 2 * pad) * (width - 2 * pad)
+    done_sum, done = 0.0, 0
+    low, high = -1.0, 1.0
+
+    for row in range(pad, height - pad, tile):
+        for col in range(pad, width - pad, tile):
+            rows = slice(row - pad, min(row + tile, height - pad) + pad)
+            cols = slice(col - pad, min(col + tile, width - pad) + pad)
+            _, ssim_map = structural_similarity(image1[rows, cols], image2[rows, cols],
+                                                data_range=255, full=True)
+            values = ssim_map[pad:-pad, pad:-pad]
+            done_sum += values.sum(dtype=float)
+            done += values.size
+
+            # The SSIM of the remaining pixels is within [-1, 1]
+            low = (done_sum - (total - done)) / total
+            high = (done_sum + (total - done)) / total
+            if threshold is not None and (low >= threshold or high < threshold):
+                return SSIMResult(done_sum / done, low, high, bool(low >= threshold))
+
+    score = done_sum / total
+    passed = None if threshold is None else bool(score >= threshold)
+    return SSIMResult(score, score, score, passed)
+
+
+def is_valid_image(path: Path) -> bool:
+    """
+    Checks that the path is an existing `.jpg` or `.png` file.
+    """
+    return path.is_file() and path.suffix.lower() in VALID_EXTENSIONS
+
+
+class GrayscaleCache():
+    """
+    Thread-safe cache of the images converted to grayscale.
+
+    Each path is decoded at most once, even when several threads ask for it
+    at the same time. The decodes are recorded as "decode" stages when a
+    metrics collector is given.
+
+    The uses of a path announced with ``expect`` are counted: its image is
+    dropped by the ``release`` of the last one, so a batch holds only the
+    images of the pairs still to compare. The other images are kept.
+    """
+    def __init__(self, metrics=None) -> None:
+        self.metrics = metrics
+        self._images = {}
+        self._locks = {}
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def expect(self, paths) -> None:
+        """
+        Announces one more use of every path (once per occurrence).
+        """
+        with self._lock:
+            for path in paths:
+                self._uses[str(path)] = self._uses.get(str(path), 0) + 1
+
+    def release(self, path: Path) -> None:
+        """
+        Ends a use announced with ``expect``, dropping the image after the last one.
+        """
+        key = str(path)
+        with self._lock:
+            if key not in self._uses:
+                return
+            self._uses[key] -= 1
+            if self._uses[key] == 0:
+                del self._uses[key]
+                self._images.pop(key, None)
+                self._locks.pop(key, None)
+
+    def get(self, path: Path):
+        """
+        Returns the grayscale image of the path, decoding it on first use.
+        """
+        key = str(path)
+        with self._lock:
+            if key in self._images:
+                return self._images[key]
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._images:
+                if not is_valid_image(Path(path)):
+                    raise ValueError(f"{path} It is not a valid image file.")
+                with stage(self.metrics, "decode", key,
+                                   bytes_read=os.path.getsize(key), frames=1):
+                    image = cv2.imread(key) # pylint: disable=c-extension-no-member
+                    if image is None:
+                        raise ValueError(f"{path} It is not a valid image file.")
+                    #conversione scala di grigi
+                    self._images[key] = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) # pylint: disable=c-extension-no-member
+            return self._images[key]
+
+
+def pairs_one_to_many(reference: Path, candidates: list) -> list:
+    """
+    Returns the pairs (reference, candidate) for every candidate.
+    """
+    return [(Path(reference), Path(candidate)) for candidate in candidates]
+
+
+def pairs_directories(dir1: Path, dir2: Path) -> list:
+    """
+    Returns the pairs of images with the same relative path in two directories.
+
+    Images present in only one of the directories are logged and skipped.
+    """
+    def images(root):
+        return {p.relative_to(root): p for p in Path(root).rglob("*") if is_valid_image(p)}
+
+    images1, images2 = images(dir1), images(dir2)
+    for missing in sorted(images1.keys() ^ images2.keys()):
+        logging.warning("Immagine senza corrispondenza: %s", missing)
+    return [(images1[rel], images2[rel]) for rel in sorted(images1.keys() & images2.keys())]
+
+
+def compare_batch(pairs: list, workers: int = 1, cache: GrayscaleCache = None,
+                  fast: dict = None, metrics=None) -> list:
+    """
+    Computes the SSIM of every pair on a pool of threads.
+
+    Parameters:
+    pairs: list of (Path, Path) tuples.
+    workers: number of threads.
+    cache: grayscale cache to reuse across calls, keeping its images; without
+    it every image is dropped after its last pair.
+    fast: if set, keyword arguments of ``fast_ssim`` used instead of the exact SSIM.
+    metrics: if set, Metrics collector of the "decode" and "ssim" stages.
+
+    Returns:
+    list: One dict per pair with "image1", "image2", "score" and "error";
+    score is None when a pair could not be compared.
+    """
+    if workers < 1:
+        raise ValueError("Invalid workers: expected a positive integer.")
+    from skimage.metrics import structural_similarity # pylint: disable=import-outside-toplevel
+
+    release = cache is None
+    cache = cache if cache is not None else GrayscaleCache(metrics)
+    if release:
+        cache.expect(path for pair in pairs for path in pair)
+
+    def score(pair):
+        path1, path2 = pair
+        row = {"image1": str(path1), "image2": str(path2), "score": None, "error": ""}
+        try:
+            image1, image2 = cache.get(path1), cache.get(path2)
+            if image1.shape != image2.shape:
+                raise ValueError(f"different sizes {image1.shape} and {image2.shape}")
+            with stage(metrics, "ssim", f"{path1} - {path2}"):
+                if fast is None:
+                    row["score"] = float(structural_similarity(image1, image2))
+                else:
+                    result = fast_ssim(image1, image2, **fast)
+                    row["score"] = result.score
+                    if result.passed is not None:
+                        row["passed"] = result.passed
+        except ValueError as e:
+            row["error"] = str(e)
+            logging.error("Confronto %s - %s fallito: %s", path1, path2, e)
+        finally:
+            if release:
+                cache.release(path1)
+                cache.release(path2)
+        return row
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(score, pairs))
+
+
+def write_scores(rows: list, path: Path) -> None:
+    """
+    Saves the scores as JSON if the path ends with `.json`, as CSV otherwise.
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=1)
+        return
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        fieldnames = ["image1", "image2", "score", "error"]
+        if any("passed" in row for row in rows):
+            fieldnames.insert(3, "passed")
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,271 @@
+"""
+Assembly of the DICOM series of a tree into 3D volumes.
+
+The files are grouped by StudyInstanceUID and SeriesInstanceUID and every
+series is written as ``<output>/<StudyInstanceUID>/<SeriesInstanceUID>.npy``,
+a NumPy array of shape (slices, rows, columns[, samples]), with a JSON
+sidecar next to it. The ``.npy`` can be opened without reading it, e.g.
+``numpy.load(path, mmap_mode="r")``, so consumers get the slices of a large
+series zero-copy instead of parsing hundreds of files.
+
+The slices are sorted along the normal of ImageOrientationPatient by their
+ImagePositionPatient when every file has both, otherwise by InstanceNumber,
+otherwise by path. The frames of a multi-frame file are kept in their order.
+The stored pixel values are written unchanged: the rescale slope and
+intercept, the spacing and the order of the source files are in the sidecar.
+
+A series is written again only if its files changed since the sidecar was
+written. The volume is filled one slice at a time through a memory map, so
+the memory used does not depend on the size of the series.
+"""
+
+# Standard library
+import json
+import logging
+import os
+import statistics
+
+# Third-party packages
+import numpy as np
+import pydicom
+from pydicom.pixel_data_handlers.util import pixel_dtype
+
+# Local modules
+from .discovery import discover
+from .metrics import stage
+
+HEADER_TAGS = [
+    "StudyInstanceUID", "SeriesInstanceUID", "SeriesDescription", "Modality",
+    "InstanceNumber", "ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing",
+    "SliceThickness", "Rows", "Columns", "SamplesPerPixel", "NumberOfFrames",
+    "BitsAllocated", "PixelRepresentation", "RescaleSlope", "RescaleIntercept",
+]
+ORDERS = ("auto", "position", "instance", "path")
+
+
+def _number(value, default=None):
+    return default if value is None or value == "" else float(value)
+
+
+def read_header(path: str) -> dict:
+    """
+    Reads the tags of a file needed to place it in its series.
+    """
+    ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    stat = os.stat(path)
+    position = ds.get("ImagePositionPatient")
+    orientation = ds.get("ImageOrientationPatient")
+    instance = ds.get("InstanceNumber")
+    return {
+        "path": path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "study": str(ds.get("StudyInstanceUID", "")),
+        "series": str(ds.get("SeriesInstanceUID", "")),
+        "description": str(ds.get("SeriesDescription", "")),
+        "modality": str(ds.get("Modality", "")),
+        "instance": None if instance in (None, "") else int(instance),
+        "position": None if not position else [float(v) for v in position],
+        "orientation": None if not orientation else [float(v) for v in orientation],
+        "spacing": None if not ds.get("PixelSpacing") else [float(v) for v in ds.PixelSpacing],
+        "thickness": _number(ds.get("SliceThickness")),
+        "shape": [int(ds.Rows), int(ds.Columns), int(ds.get("SamplesPerPixel", 1) or 1)],
+        "frames": int(ds.get("NumberOfFrames", 1) or 1),
+        "dtype": pixel_dtype(ds).str,
+        "slope": _number(ds.get("RescaleSlope"), 1.0),
+        "intercept": _number(ds.get("RescaleIntercept"), 0.0),
+    }
+
+
+def sort_slices(headers: list, order: str = "auto") -> tuple:
+    """
+    Sorts the headers of a series.
+
+    Returns:
+    tuple: The sorted headers, the order used and the slice spacing along
+    the normal (None unless sorted by position).
+    """
+    if order not in ORDERS:
+        raise ValueError(f"Invalid order: expected one of {ORDERS}.")
+    by_position = all(h["position"] and h["orientation"] for h in headers)
+    by_instance = all(h["instance"] is not None for h in headers)
+    if order == "auto":
+        order = "position" if by_position else "instance" if by_instance else "path"
+    if (order == "position" and not by_position) or (order == "instance" and not by_instance):
+        raise ValueError(f"Invalid order {order}: not every file has the tags needed.")
+
+    if order == "position":
+        orientation = np.array(headers[0]["orientation"])
+        normal = np.cross(orientation[:3], orientation[3:])
+        for h in headers:
+            h["location"] = float(np.dot(h["position"], normal))
+        headers = sorted(headers, key=lambda h: (h["location"], h["instance"] or 0, h["path"]))
+        steps = np.diff([h["location"] for h in headers])
+        spacing = float(statistics.median(steps)) if len(steps) else None
+        if len(steps) and not np.all(steps > 0):
+            logging.warning("Serie %s: posizioni delle slice ripetute", headers[0]["series"])
+        return headers, order, spacing
+    if order == "instance":
+        return sorted(headers, key=lambda h: (h["instance"], h["path"])), order, None
+    return sorted(headers, key=lambda h: h["path"]), order, None
+
+
+def _sidecar(headers: list, order: str, spacing, root: str, shape: tuple, dtype) -> dict:
+    """
+    Returns the JSON sidecar of a volume.
+    """
+    first = headers[0]
+
+    def uniform(key):
+        values = [h[key] for h in headers]
+        return values[0] if all(v == values[0] for v in values) else values
+
+    return {
+        "study_instance_uid": first["study"],
+        "series_instance_uid": first["series"],
+        "series_description": first["description"],
+        "modality": first["modality"],
+        "shape": list(shape),
+        "dtype": np.dtype(dtype).str,
+        "order": order,
+        "pixel_spacing": first["spacing"],
+        "slice_thickness": first["thickness"],
+        "slice_spacing": spacing,
+        "orientation": first["orientation"],
+        "rescale_slope": uniform("slope"),
+        "rescale_intercept": uniform("intercept"),
+        "files": [{"path": os.path.relpath(h["path"], root), "size": h["size"],
+                   "mtime_ns": h["mtime_ns"], "frames": h["frames"],
+                   "instance": h["instance"], "position": h["position"]} for h in headers],
+    }
+
+
+def _is_current(sidecar_path: str, headers: list, root: str) -> bool:
+    """
+    Checks whether the volume of a sidecar was built from the same files.
+    """
+    try:
+        with open(sidecar_path, "r", encoding="utf-8") as f:
+            files = json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return False
+    previous = {(f["path"], f["size"], f["mtime_ns"]) for f in files}
+    return previous == {(os.path.relpath(h["path"], root), h["size"], h["mtime_ns"])
+                        for h in headers}
+
+
+def write_volume(headers: list, path: str, root: str, order: str = "auto",
+                 metrics=None) -> dict:
+    """
+    Writes a series as a .npy volume and its JSON sidecar (same name, .json).
+
+    Returns:
+    dict: The sidecar.
+    """
+    from .dicom import RenderContext # pylint: disable=import-outside-toplevel
+
+    headers, order, spacing = sort_slices(headers, order)
+    shapes = {tuple(h["shape"]) for h in headers}
+    if len(shapes) > 1:
+        raise ValueError(f"slices of different sizes {sorted(shapes)}")
+    rows, columns, samples = shapes.pop()
+    shape = (sum(h["frames"] for h in headers), rows, columns) + ((samples,) if samples > 1 else ())
+    #The type that holds the values of every slice, e.g. int16 for uint8 and int16 slices
+    dtype = np.result_type(*{np.dtype(h["dtype"]) for h in headers}).newbyteorder("=")
+
+    series = headers[0]["series"]
+    tmp_path = path + ".tmp"
+    with stage(metrics, "volume", series, frames=shape[0]) as record:
+        volume = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+        index = 0
+        try:
+            for header in headers:
+                pixels = RenderContext(pydicom.dcmread(header["path"])).pixels
+                if header["frames"] == 1:
+                    pixels = pixels[np.newaxis]
+                if not np.can_cast(pixels.dtype, dtype, "safe"):
+                    raise ValueError(f"pixels of type {pixels.dtype} in {header['path']}, "
+                                     f"expected {dtype}")
+                volume[index:index + len(pixels)] = pixels
+                index += len(pixels)
+            volume.flush()
+            del volume
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        record["bytes_written"] = os.path.getsize(path)
+
+    sidecar = _sidecar(headers, order, spacing, root, shape, dtype)
+    sidecar["npy"] = os.path.basename(path)
+    with open(os.path.splitext(path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(sidecar, f, indent=1)
+    return sidecar
+
+
+# pylint: disable-next=too-many-arguments,too-many-locals
+def assemble(root, output, order: str = "auto", force: bool = False, files: list = None,
+             metrics=None, scan_workers: int = 8) -> dict:
+    """
+    Groups the DICOM files under root by series and writes their volumes.
+
+    Parameters:
+    root: directory with the DICOM files.
+    output: directory of the volumes.
+    order: "auto", "position", "instance" or "path".
+    force: if True, the volumes are written even if their files did not change.
+    files: if given, only these files are used instead of scanning root.
+
+    Returns:
+    dict: Number of series written and up to date, and the error of every
+    series or file that could not be assembled.
+    """
+    root = os.path.abspath(root)
+    paths = discover(root, scan_workers) if files is None else [os.path.abspath(f) for f in files]
+
+    series = {}
+    errors = {}
+    for path in paths:
+        try:
+            with stage(metrics, "header", path, bytes_read=os.path.getsize(path)):
+                header = read_header(path)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            errors[path] = f"{type(e).__name__}: {e}"
+            continue
+        series.setdefault((header["study"], header["series"]), []).append(header)
+
+    stats = {"series": len(series), "written": 0, "unchanged": 0, "errors": errors}
+    for (study, uid), headers in sorted(series.items()):
+        directory = os.path.join(output, study or "unknown")
+        path = os.path.join(directory, f"{uid or 'unknown'}.npy")
+        if not force and os.path.isfile(path) and _is_current(path[:-4] + ".json", headers, root):
+            stats["unchanged"] += 1
+            continue
+        try:
+            os.makedirs(directory, exist_ok=True)
+            sidecar = write_volume(headers, path, root, order, metrics)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            errors[uid] = f"{type(e).__name__}: {e}"
+            continue
+        stats["written"] += 1
+        logging.info("Serie %s: volume %s %s in %s", uid, sidecar["shape"], sidecar["dtype"], path)
+
+    for key, error in sorted(errors.items()):
+        logging.error("Impossibile assemblare %s: %s", key, error)
+    logging.info("Serie: %d, scritte: %d, invariate: %d, errori: %d", stats["series"],
+                 stats["written"], stats["unchanged"], len(errors))
+    return stats
+
+
+def open_volume(path, mmap_mode: str = "r") -> tuple:
+    """
+    Opens a volume without reading it.
+
+    Returns:
+    tuple: The memory-mapped array and its sidecar.
+    """
+    path = str(path)
+    with open(os.path.splitext(path)[0] + ".json", "r", encoding="utf-8") as f:
+        sidecar = json.load(f)
+    return np.load(path, mmap_mode=mmap_mode), sidecar
@@ -0,0 +1,243 @@
+"""
+Watch mode: process the DICOM files arriving in a spool directory.
+
+The tree is polled every ``interval`` seconds. Only the directories whose
+modification time changed are listed again, so an idle tree costs one
+``stat`` per directory and per file still being written. A file is
+processed once it is settled: its size and modification time have not
+changed for ``settle`` seconds. It must also be a DICOM file, by suffix or
+content (see discovery). Names starting with a dot or ending with a
+temporary suffix are ignored until they are renamed.
+
+The files go through a single ``DICOM`` instance that stays loaded, with
+the same pipeline, options and manifests as ``processing``, in batches of
+at most ``batch`` files. The queue between the poller and the processing
+holds at most ``max_pending`` files: when it is full the poller waits, so a
+burst of arrivals is taken in at the rate the host can process it instead
+of piling up in memory.
+"""
+
+# Standard library
+import logging
+import os
+import queue
+import threading
+import time
+
+# Local modules
+from .discovery import SKIPPED, is_dicom
+
+# pylint: disable=import-outside-toplevel
+
+# Names written by copy tools before the final rename
+TEMPORARY_SUFFIXES = (".tmp", ".part", ".partial", ".filepart")
+
+# Directory timestamps are coarse: a directory modified less than this many
+# seconds ago is listed again, in case a file arrived in the same tick
+RECENT = 1.0
+
+
+class Watcher():
+    """
+    Poller of a directory tree feeding a DICOM processor.
+
+    Parameters
+    ----------
+    processor : dicom.DICOM
+        Processor of the tree; its ``files`` are replaced by each batch.
+    interval : float
+        Seconds between two polls.
+    settle : float
+        Seconds a file must stay unchanged before it is processed.
+    batch : int
+        Maximum number of files per processing call.
+    max_pending : int
+        Maximum number of settled files waiting to be processed.
+    """
+    # pylint: disable-next=too-many-arguments
+    def __init__(self, processor, interval: float = 1.0, settle: float = 2.0,
+                 batch: int = 16, max_pending: int = 256) -> None:
+        if interval <= 0 or settle < 0:
+            raise ValueError("Invalid interval/settle: expected positive seconds.")
+        if batch < 1 or max_pending < 1:
+            raise ValueError("Invalid batch/max_pending: expected positive integers.")
+        self.processor = processor
+        self.interval = interval
+        self.settle = settle
+        self.batch = batch
+        self.root = os.path.abspath(processor.path)
+        self.stats = {"processed": 0, "errors": 0, "batches": 0, "waits": 0}
+        self._directories = {} # path -> modification time when it was listed
+        self._files = {}       # directory -> {name: [state, size, mtime_ns, since]}
+        self._queue = queue.Queue(max_pending)
+        self._stop = threading.Event()
+        self._failing = set() # paths whose last access failed, logged once
+        self._error = None    # exception that stopped the poller
+
+    def stop(self) -> None:
+        """
+        Asks ``run`` to return after the files already queued.
+        """
+        self._stop.set()
+
+    def _list(self, directory: str) -> None:
+        """
+        Lists a directory, keeping the state of the files already known.
+
+        A processed file that was replaced (e.g. renamed over) is new again.
+        """
+        known = self._files.get(directory, {})
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in SKIPPED and entry.path not in self._directories:
+                            self._directories[entry.path] = None
+                    elif (entry.is_file() and not entry.name.startswith(".")
+                          and not entry.name.endswith(TEMPORARY_SUFFIXES)):
+                        state = known.get(entry.name, ["new", None, None, None])
+                        if state[0] == "done":
+                            stat = entry.stat()
+                            if state[1:3] != [stat.st_size, stat.st_mtime_ns]:
+                                state = ["new", None, None, None]
+                        files[entry.name] = state
+                except OSError as e:
+                    #Kept with its previous state, if any, and checked again by poll
+                    if entry.name in known:
+                        files[entry.name] = known[entry.name]
+                    self._warn(entry.path, e)
+        self._files[directory] = files
+
+    def _warn(self, path: str, error: OSError) -> None:
+        """
+        Logs an access error, once until the path is readable again.
+        """
+        if path not in self._failing:
+            self._failing.add(path)
+            logging.warning("Impossibile leggere %s: %s", path, error)
+
+    def poll(self) -> list:
+        """
+        Scans the tree once and returns the files that just settled.
+        """
+        now = time.time()
+        if not self._directories:
+            self._directories[self.root] = None
+        for directory in list(self._directories):
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+                if mtime_ns != self._directories[directory] or now - mtime_ns / 1e9 < RECENT:
+                    self._list(directory)
+                    self._directories[directory] = mtime_ns
+                self._failing.discard(directory)
+            except FileNotFoundError:
+                del self._directories[directory]
+                self._files.pop(directory, None)
+            except OSError as e:
+                #e.g. EACCES or a stale NFS handle: listed again at the next poll
+                self._warn(directory, e)
+
+        settled = []
+        for directory, files in self._files.items():
+            for name, state in files.items():
+                if state[0] == "done":
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # dropped when the directory is listed again
+                except OSError as e:
+                    self._warn(path, e)
+                    continue
+                self._failing.discard(path)
+                if state[0] != "pending" or state[1:3] != [stat.st_size, stat.st_mtime_ns]:
+                    state[:] = ["pending", stat.st_size, stat.st_mtime_ns, now]
+                elif now - state[3] >= self.settle and now - stat.st_mtime_ns / 1e9 >= self.settle:
+                    state[0] = "done"
+                    if is_dicom(path):
+                        settled.append(path)
+        return settled
+
+    def _poll_loop(self) -> None:
+        """
+        Polls the tree and queues the settled files until stopped.
+
+        An unexpected error stops the watcher: ``run`` raises it.
+        """
+        try:
+            while not self._stop.is_set():
+                for path in self.poll():
+                    while not self._stop.is_set():
+                        try:
+                            self._queue.put(path, timeout=self.interval)
+                            break
+                        except queue.Full:
+                            self.stats["waits"] += 1
+                            logging.warning("Coda piena (%d file): in attesa dell'elaborazione",
+                                            self._queue.maxsize)
+                self._stop.wait(self.interval)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logging.exception("Controllo della cartella %s interrotto", self.root)
+            self._error = e
+            self._stop.set()
+
+    def _warm_up(self) -> None:
+        """
+        Imports the libraries of processing before the first file arrives.
+        """
+        import numpy # pylint: disable=unused-import
+        import pydicom # pylint: disable=unused-import
+        from PIL import Image # pylint: disable=unused-import
+        from . import intensity # pylint: disable=unused-import
+
+    def _process(self, files: list) -> None:
+        """
+        Processes a batch of settled files.
+        """
+        start = time.perf_counter()
+        self.processor.files = files
+        errors = self.processor.processing()
+        self.stats["batches"] += 1
+        self.stats["processed"] += len(files) - len(errors)
+        self.stats["errors"] += len(errors)
+        logging.info("Elaborati %d file in %.2f s, %d in coda",
+                     len(files), time.perf_counter() - start, self._queue.qsize())
+
+    def run(self) -> dict:
+        """
+        Watches the tree until ``stop`` is called or the process is interrupted.
+
+        Returns:
+        dict: Files processed, files in error, batches, waits on a full queue.
+
+        Raises:
+        RuntimeError: if the polling of the tree failed.
+        """
+        self._warm_up()
+        poller = threading.Thread(target=self._poll_loop, name="watch-poller", daemon=True)
+        poller.start()
+        logging.info("In attesa di nuovi file in %s", self.root)
+        try:
+            while not (self._stop.is_set() and self._queue.empty()):
+                try:
+                    files = [self._queue.get(timeout=self.interval)]
+                except queue.Empty:
+                    continue
+                while len(files) < self.batch:
+                    try:
+                        files.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._process(files)
+        except KeyboardInterrupt:
+            logging.info("Interruzione richiesta")
+        finally:
+            self._stop.set()
+            poller.join()
+        if self.processor.metrics is not None:
+            self.processor.metrics.info.update(self.stats)
+        if self._error is not None:
+            raise RuntimeError(f"watch of {self.root} stopped: {self._error}") from self._error
+        return dict(self.stats)
@@ -1,38 +1,114 @@
 import pytest
 import argparse
+import json
+import shutil
+import subprocess
+import sys
 import dicom.dicom as dicom
+from dicom import capture, similarity
 
 #They ensure that dicom.main() calls the correct methods/functions
 #with the correct parameters based on the arguments passed.
 
+HEAVY = {"numpy", "pydicom", "PIL", "cv2", "matplotlib", "skimage", "scipy"}
+# The dicom command in a new interpreter
+CLI = [sys.executable, "-c", "import sys, dicom; sys.argv[0] = 'dicom'; dicom.main()"]
+
+
+def run_cli(*args):
+    """
+    Runs the command line with -X importtime in a new interpreter.
+
+    Returns the top-level packages imported and the cumulative import time
+    of dicom.dicom in seconds.
+    """
+    code = ("import sys\n"
+            "import dicom.dicom as d\n"
+            "sys.argv = ['dicom', *sys.argv[1:]]\n"
+            "try:\n"
+            "    d.main(d.setup_parser())\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))\n")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code, *args],
+                            capture_output=True, text=True, check=True)
+    import_time = next(int(line.split("|")[1]) for line in result.stderr.splitlines()
+                       if line.startswith("import time:") and line.endswith("| dicom.dicom"))
+    return set(result.stdout.split()), import_time / 1e6
+
 
 class TestIntegration:
 
-    def test_processing_integration(self, monkeypatch):
+    def test_processing_integration(self, monkeypatch, tmp_path):
         """
         Test that main calls DICOM.processing with the correct parameters
         """
         fake_args = argparse.Namespace(
             verbosity="CRITICAL",
+            metrics_out=tmp_path / "metrics.json",
+            profile=tmp_path / "run.prof",
             action="processing",
             dicom_dir="fake_dir",
-            anonymous=True
+            anonymous=True,
+            workers=2,
+            force=False,
+            png_mode="figure",
+            formats=("jpg", "txt"),
+            intensity="window",
+            percentiles=(1.0, 99.0),
+            metadata_out=None,
+            tags=None,
+            index=None,
+            where=[],
+            prefetch=2,
+            writers=3,
+            scan_workers=4,
+            output_root=None,
+            archive=None,
+            archive_group="run",
+            shard=(1, 3),
+            shard_by="patient",
+            worklist=None,
+            cache_dir=tmp_path / "cache",
+            cache_size=1 << 20
             )
 
         called = {}
 
         class FakeDICOM:
-            def __init__(self, path, anonymous):
+            def __init__(self, path, anonymous, **options):
                 called["init"] = (path, anonymous)
+                called["options"] = options
 
             def processing(self):
                 called["processing"] = True
+                return {}
 
         monkeypatch.setattr(dicom, "DICOM", FakeDICOM)
         dicom.main(fake_args)
 
         assert called["init"] == ("fake_dir", True)
+        assert called["options"] == {"workers": 2, "force": False, "png_mode": "figure",
+                                      "formats": ("jpg", "txt"),
+                                      "intensity": "window",
+                                      "percentiles": (1.0, 99.0),
+                                      "prefetch": 2,
+                                      "writers": 3,
+                                      "metrics": called["options"]["metrics"],
+                                      "files": None,
+                                      "export": None,
+                                      "scan_workers": 4,
+                                      "output_root": None,
+                                      "archive": None,
+                                      "shard": (1, 3),
+                                      "shard_by": "patient",
+                                      "cache": called["options"]["cache"]}
+        assert isinstance(called["options"]["metrics"], dicom.Metrics)
+        assert called["options"]["cache"].directory == str(tmp_path / "cache")
+        assert called["options"]["cache"].max_bytes == 1 << 20
         assert called["processing"] is True
+        assert json.loads((tmp_path / "metrics.json").read_text())["stages"] == {}
+        assert (tmp_path / "run.prof").exists()
 
 
     def test_acquire_integration(self, monkeypatch, tmp_path):
@@ -41,14 +117,23 @@ class TestIntegration:
         """
         fake_args = argparse.Namespace(
             verbosity="CRITICAL",
+            metrics_out=None,
+            profile=None,
             action="acquire",
             fd=0,
             video=None,
-            output=tmp_path / "frame.png"
+            output=tmp_path / "frame.png",
+            frames=None,
+            duration=None,
+            fps=None,
+            buffer=64,
+            writers=2,
+            dedup=None,
+            dedup_size=64
         )
 
         called = {}
-        def fake_acquire(source, output):
+        def fake_acquire(source, output, metrics):
             called["source"] = source
             called["output"] = output
 
@@ -59,6 +144,42 @@ class TestIntegration:
         assert called["output"] == tmp_path / "frame.png"
 
 
+    def test_acquire_continuous_integration(self, monkeypatch, tmp_path):
+        """
+        Confirms that main() starts a continuous capture when --frames is given.
+        """
+        fake_args = argparse.Namespace(
+            verbosity="CRITICAL",
+            metrics_out=None,
+            profile=None,
+            action="acquire",
+            fd=None,
+            video="video.wmv",
+            output=tmp_path,
+            frames=10,
+            duration=None,
+            fps=25.0,
+            buffer=8,
+            writers=3,
+            dedup=0.95,
+            dedup_size=32
+        )
+
+        called = {}
+        def fake_sequence(source, output_dir, **options):
+            called["args"] = (source, output_dir)
+            called["options"] = options
+
+        monkeypatch.setattr(capture, "acquire_sequence", fake_sequence)
+        dicom.main(fake_args)
+
+        assert called["args"] == ("video.wmv", tmp_path)
+        assert called["options"] == {"frames": 10, "duration": None, "fps": 25.0,
+                                     "buffer_size": 8, "writers": 3,
+                                     "dedup_threshold": 0.95, "dedup_size": 32,
+                                     "metrics": None}
+
+
     def test_compare_integration(self, monkeypatch, tmp_path):
         """
         Test that main calls compare_image and logs the result
@@ -70,13 +191,25 @@ class TestIntegration:
 
         fake_args = argparse.Namespace(
             verbosity="CRITICAL",
+            metrics_out=None,
+            profile=None,
             action="compare",
             image1=img1,
-            image2=img2
+            image2=img2,
+            reference=None,
+            candidates=None,
+            dir1=None,
+            dir2=None,
+            output=None,
+            workers=1,
+            fast=False,
+            max_side=None,
+            tile=256,
+            threshold=None
         )
 
         called = {}
-        def fake_compare(p1, p2):
+        def fake_compare(p1, p2, metrics):
             called["p1"] = p1
             called["p2"] = p2
             return 0.99
@@ -85,4 +218,177 @@ class TestIntegration:
         dicom.main(fake_args)
 
         assert called["p1"] == img1
-        assert called["p2"] == img2
\ No newline at end of file
+        assert called["p2"] == img2
+
+    def test_compare_batch_integration(self, monkeypatch, tmp_path):
+        """
+        Test that main pairs the directories and saves the batch scores
+        """
+        fake_args = argparse.Namespace(
+            verbosity="CRITICAL",
+            metrics_out=None,
+            profile=None,
+            action="compare",
+            image1=None,
+            image2=None,
+            reference=None,
+            candidates=None,
+            dir1=tmp_path / "a",
+            dir2=tmp_path / "b",
+            output=tmp_path / "scores.csv",
+            workers=3,
+            fast=True,
+            max_side=256,
+            tile=128,
+            threshold=0.9
+        )
+
+        called = {}
+        def fake_pairs(dir1, dir2):
+            called["dirs"] = (dir1, dir2)
+            return [("x.png", "y.png")]
+
+        def fake_batch(pairs, workers, fast, metrics):
+            called["batch"] = (pairs, workers, fast)
+            return [{"image1": "x.png", "image2": "y.png", "score": 0.5, "error": ""}]
+
+        def fake_write(rows, path):
+            called["write"] = (rows, path)
+
+        monkeypatch.setattr(similarity, "pairs_directories", fake_pairs)
+        monkeypatch.setattr(similarity, "compare_batch", fake_batch)
+        monkeypatch.setattr(similarity, "write_scores", fake_write)
+        dicom.main(fake_args)
+
+        assert called["dirs"] == (tmp_path / "a", tmp_path / "b")
+        assert called["batch"] == ([("x.png", "y.png")], 3,
+                                   {"max_side": 256, "tile": 128, "threshold": 0.9})
+        assert called["write"][1] == tmp_path / "scores.csv"
+
+
+    def test_interrupted_archive_integration(self, monkeypatch, tmp_path):
+        """
+        Test that an interrupted run leaves the previous archive in place
+        """
+        import zipfile
+
+        for i in range(1, 3):
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", tmp_path)
+        arguments = argparse.Namespace(
+            verbosity="CRITICAL", metrics_out=None, profile=None,
+            action="processing", dicom_dir=tmp_path, anonymous=False, workers=1,
+            force=False, png_mode="pixels", formats=("txt",), intensity="minmax",
+            percentiles=(0.5, 99.5), metadata_out=None, tags=None, index=None, where=[],
+            prefetch=4, writers=1, scan_workers=8, output_root=None, archive="zip",
+            archive_group="run", shard=None, shard_by="file", worklist=None,
+            cache_dir=None, cache_size=1 << 30)
+        dicom.main(arguments)
+        with zipfile.ZipFile(tmp_path / "OUTPUT.zip") as archive:
+            assert archive.namelist() == ["OUTPUT/1-1.txt", "OUTPUT/1-2.txt"]
+
+        write = dicom.DICOM._write
+        def interrupted_write(self, task):
+            if task[1].endswith("1-2.txt"):
+                raise KeyboardInterrupt
+            return write(self, task)
+
+        monkeypatch.setattr(dicom.DICOM, "_write", interrupted_write)
+        monkeypatch.setattr(dicom.pipeline, "run", lambda items, read, render, write, **_: (
+            {item["dicom"]: [write(t) for t in render(item, read(item))] for item in items}, {}))
+        with pytest.raises(KeyboardInterrupt):
+            dicom.main(arguments)
+        with zipfile.ZipFile(tmp_path / "OUTPUT.zip") as archive:
+            assert archive.namelist() == ["OUTPUT/1-1.txt", "OUTPUT/1-2.txt"]
+        assert not (tmp_path / "OUTPUT.zip.tmp").exists()
+
+
+    def test_index_query_integration(self, monkeypatch, tmp_path, capsys):
+        """
+        Test that main indexes a tree, queries it and processes the query results
+        """
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+        shutil.copy("tests/Data/DICOM_2/DICOM/1-2.dcm", tmp_path)
+        db = tmp_path / "index.db"
+        common = {"verbosity": "CRITICAL", "metrics_out": None, "profile": None}
+
+        dicom.main(argparse.Namespace(action="index", dicom_dir=tmp_path, db=db, **common))
+        dicom.main(argparse.Namespace(action="query", db=db, where=["InstanceNumber>0"],
+                                      columns=["path", "PatientID"], output_format="csv",
+                                      limit=None, **common))
+        assert capsys.readouterr().out.splitlines() == [
+            "path,PatientID", f"{tmp_path / '1-2.dcm'},LiverUS-01"]
+
+        called = {}
+        class FakeDICOM:
+            def __init__(self, path, anonymous, **options):
+                called["files"] = options["files"]
+            def processing(self):
+                return {}
+
+        monkeypatch.setattr(dicom, "DICOM", FakeDICOM)
+        dicom.main(argparse.Namespace(
+            action="processing", dicom_dir=tmp_path, anonymous=False, workers=1,
+            force=False, png_mode="pixels", formats=("txt",), intensity="minmax",
+            percentiles=(0.5, 99.5), metadata_out=None, tags=None,
+            index=db, where=["PatientID=Anonymous"],
+            prefetch=4, writers=4, scan_workers=8, output_root=None, archive=None,
+            archive_group="run", shard=None, shard_by="file", worklist=None,
+            cache_dir=None, cache_size=1 << 30, **common))
+        assert called["files"] == [str(tmp_path / "1-1.dcm")]
+
+    @pytest.mark.parametrize("worklist", [False, True])
+    def test_sharded_processing(self, tmp_path, worklist):
+        """
+        N concurrent processes with --shard i/N cover the tree exactly once
+        and share the manifests of the common folders
+        """
+        root = tmp_path / "tree"
+        for p in range(2):
+            (root / f"P{p}").mkdir(parents=True)
+            for i in range(1, 5):
+                shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", root / f"P{p}" / f"IM{i}")
+        options = ["--dicom_dir", str(root), "--formats", "txt"]
+        if worklist:
+            subprocess.run([*CLI, "worklist", "--dicom_dir", str(root),
+                            "--shards", "3", "--output", str(tmp_path / "list.json")], check=True)
+            options += ["--worklist", str(tmp_path / "list.json")]
+
+        shards = [subprocess.Popen([*CLI, "--verbosity", "ERROR",
+                                    "processing", *options, "--shard", f"{i}/3"])
+                  for i in range(3)]
+        assert [shard.wait() for shard in shards] == [0, 0, 0]
+        for p in range(2):
+            output = root / f"P{p}" / "OUTPUT"
+            assert sorted(f.name for f in output.glob("*.txt")) == [f"IM{i}.txt" for i in range(1, 5)]
+            manifest = json.loads((output / ".manifest.json").read_text())
+            assert sorted(manifest) == [f"IM{i}" for i in range(1, 5)]
+
+    def test_startup_help(self):
+        """
+        The CLI module and --help load none of the third-party packages
+        """
+        modules, import_time = run_cli("--help")
+        assert not modules & HEAVY
+        # About 0.05 s, 2 s when everything was imported eagerly
+        assert import_time < 0.5
+
+    @pytest.mark.parametrize("action, loaded, unused", [
+        ("acquire", {"cv2"}, {"pydicom", "PIL", "matplotlib", "skimage", "scipy"}),
+        ("compare", {"cv2", "skimage"}, {"pydicom", "PIL", "matplotlib"}),
+        ("processing", {"pydicom", "numpy", "PIL"}, {"cv2", "matplotlib", "skimage", "scipy"}),
+    ])
+    def test_startup_per_subcommand(self, tmp_path, action, loaded, unused):
+        """
+        Each subcommand imports only the libraries it needs
+        """
+        if action == "acquire":
+            args = ["--video", "tests/Data/Acquire/Image1.wmv", "--output", str(tmp_path / "f.png")]
+        elif action == "compare":
+            args = ["--image1", "tests/Data/Compare/1-1.jpg", "--image2", "tests/Data/Compare/1-2.jpg"]
+        else:
+            shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+            args = ["--dicom_dir", str(tmp_path)]
+
+        modules, _ = run_cli("--verbosity", "ERROR", action, *args)
+        assert loaded <= modules
+        assert not modules & unused
@@ -1,10 +1,21 @@
+import argparse
 import numpy as np
+import pydicom
 import pytest
 from pathlib import Path
 import dicom.dicom as dicom
+from dicom import capture, pipeline, similarity
+from dicom.intensity import IntensityMapper
+from dicom.metrics import Metrics
+from dicom.index import Index, parse_condition
+from dicom.export import MetadataExport, parse_tag
+from dicom import api, cache, discovery, sharding, volume
+import io
 import hashlib
-from unittest.mock import MagicMock, patch
-from PIL import Image, ImageChops
+from unittest.mock import MagicMock, PropertyMock, patch
+from PIL import Image, ImageChops, ImageSequence
+import os
+import json
 import shutil
 from skimage.metrics import structural_similarity as ssim
 
@@ -46,6 +57,60 @@ def file_digest(filepath, ignore_whitespace=True, ignore_case=True):
 
 
 
+def write_multiframe(path, pixels, frame_time=40.0):
+    """
+    Scrive un file DICOM multi-frame non compresso con i pixel indicati.
+    """
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.3.1"
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(str(path), {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.PatientName = "Test^Patient"
+    ds.PatientID = "123"
+    ds.PatientBirthDate = "19700101"
+    ds.PatientSex = "O"
+    ds.PatientIdentityRemoved = "NO"
+    ds.Modality = "US"
+    ds.FrameTime = frame_time
+    ds.NumberOfFrames = pixels.shape[0]
+    ds.Rows, ds.Columns = pixels.shape[1:3]
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = ds.BitsAllocated
+    ds.HighBit = ds.BitsStored - 1
+    ds.PixelRepresentation = 1 if pixels.dtype.kind == "i" else 0
+    ds.PixelData = pixels.tobytes()
+    ds.save_as(str(path), write_like_original=False)
+    return path
+
+
+def write_slice(path, pixels, series="1.2.3.1", instance=None, position=None):
+    """
+    Scrive una singola slice di una serie, con InstanceNumber e ImagePositionPatient.
+    """
+    write_multiframe(path, pixels[np.newaxis])
+    ds = pydicom.dcmread(path)
+    del ds.NumberOfFrames, ds.FrameTime
+    ds.StudyInstanceUID = "1.2.3"
+    ds.SeriesInstanceUID = series
+    if instance is not None:
+        ds.InstanceNumber = instance
+    if position is not None:
+        ds.ImagePositionPatient = list(position)
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.save_as(str(path), write_like_original=False)
+    return path
+
+
 class TestClass:
     def test_dicom_to_jpg_0(self, tmp_path):
         dicom_file = Path("tests/Data/DICOM_1/DICOM/1-1.dcm")
@@ -78,7 +143,7 @@ class TestClass:
         output_png = tmp_path / "OUTPUT/1-1.png"
         shutil.copy(dicom_file, tmp_path)
 
-        processing_dicom = dicom.DICOM(path=tmp_path, anonymous=False)
+        processing_dicom = dicom.DICOM(path=tmp_path, anonymous=False, png_mode="figure")
         processing_dicom.processing()
         score = images_are_similar(output_png, correct_png)
         assert score >= 0.99
@@ -92,11 +157,24 @@ class TestClass:
     )
     def test_dicom_to_png_1(self,input,output,correct,tmp_path):
         shutil.copy(input, tmp_path)
-        processing_dicom = dicom.DICOM(path=tmp_path, anonymous=False)
+        processing_dicom = dicom.DICOM(path=tmp_path, anonymous=False, png_mode="figure")
         processing_dicom.processing()
         score = images_are_similar(tmp_path / output, correct)
         assert score >= 0.99
 
+    @pytest.mark.parametrize("number", [1, 2, 3])
+    def test_dicom_to_png_pixels(self, number, tmp_path):
+        dicom_file = Path(f"tests/Data/DICOM_{number}/DICOM/1-{number}.dcm")
+        shutil.copy(dicom_file, tmp_path)
+
+        processing_dicom = dicom.DICOM(path=tmp_path, anonymous=False)
+        processing_dicom.processing()
+
+        pixels = pydicom.dcmread(dicom_file).pixel_array.astype(float)
+        expected = np.uint8(np.maximum(pixels, 0) / pixels.max() * 255)
+        output = np.array(Image.open(tmp_path / f"OUTPUT/1-{number}.png"))
+        assert np.array_equal(output, expected)
+
     def test_txt_0(self,tmp_path):
         dicom_file = Path("tests/Data/DICOM_1/DICOM/1-1.dcm")
         correct_txt = "tests/Data/DICOM_1/SOL/1-1.txt"
@@ -158,6 +236,87 @@ class TestClass:
         score = images_are_similar(output, expected)
         assert score >= 0.99
 
+    def test_acquire_sequence(self, tmp_path):
+        source = "tests/Data/Acquire/Image1.wmv"
+        expected = "tests/Data/Acquire/expected.png"
+
+        stats = capture.acquire_sequence(source, tmp_path, frames=5, buffer_size=8)
+
+        assert stats["captured"] == stats["written"] == 5
+        assert stats["dropped"] == 0
+        assert stats["fps"] > 0
+        assert sorted(p.name for p in tmp_path.iterdir()) == [f"frame_00000{i}.png" for i in range(5)]
+        assert images_are_similar(tmp_path / "frame_000000.png", expected) >= 0.99
+
+    def test_acquire_sequence_end_of_video(self, tmp_path):
+        stats = capture.acquire_sequence("tests/Data/Acquire/Image1.wmv", tmp_path,
+                                         duration=60, writers=4)
+        assert stats["captured"] == stats["written"] + stats["dropped"] == 90
+
+    def test_acquire_sequence_dedup(self, tmp_path):
+        stats = capture.acquire_sequence("tests/Data/Acquire/Image1.wmv", tmp_path,
+                                         frames=90, dedup_threshold=0.95)
+
+        assert stats["captured"] == 90
+        assert 0 < stats["written"] < 90
+        assert stats["written"] + stats["skipped"] + stats["dropped"] == 90
+        assert (tmp_path / "frame_000000.png").exists()
+
+    def test_acquire_sequence_dedup_dropped_reference(self, tmp_path):
+        import threading
+
+        rng = np.random.default_rng(0)
+        a, b, c = (rng.integers(0, 255, size=(64, 64, 3), dtype=np.uint8) for _ in range(3))
+        source = [a, b, b.copy(), b.copy(), c]
+        writing, done = threading.Event(), threading.Event()
+
+        class Capture():
+            def isOpened(self):
+                return True
+
+            def read(self):
+                if len(source) < 5:
+                    writing.wait(5) # the first frame is being written
+                if not source:
+                    done.set()
+                    return False, None
+                return True, source.pop(0)
+
+            def release(self):
+                pass
+
+        def slow_write(path, frame):
+            writing.set()
+            done.wait(5)
+            Path(path).write_bytes(b"png")
+            return True
+
+        with patch.object(capture.cv2, "VideoCapture", return_value=Capture()), \
+             patch.object(capture.cv2, "imwrite", side_effect=slow_write):
+            stats = capture.acquire_sequence(0, tmp_path, frames=10, buffer_size=1, writers=1,
+                                             dedup_threshold=0.9, dedup_size=32)
+
+        # b is dropped with its copies: none of them is skipped as a duplicate of it
+        assert stats["captured"] == 5 and stats["skipped"] == 0
+        assert stats["written"] == 2 and stats["dropped"] == 3
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["frame_000000.png",
+                                                               "frame_000004.png"]
+
+    def test_change_detector(self):
+        frame = np.random.default_rng(0).integers(0, 255, size=(120, 160, 3), dtype=np.uint8)
+        detector = capture.ChangeDetector(0.9, size=32)
+        assert detector.is_new(frame)
+        assert not detector.is_new(frame.copy())
+        assert detector.is_new(255 - frame)
+
+    def test_frame_ring_drops_oldest(self):
+        ring = capture.FrameRing(2)
+        for i in range(3):
+            ring.put(i)
+        ring.close()
+        assert ring.dropped == 1
+        assert [ring.get(), ring.get(), ring.get()] == [1, 2, None]
+
     def test_processing_crea_gif(self, tmp_path):
         dcm_file = tmp_path / "test.dcm"
         dcm_file.write_text("FAKE DICOM CONTENT")
@@ -169,12 +328,950 @@ class TestClass:
             MagicMock(value=100) if tag == (0x0018, 0x1063) else MagicMock()
         )
         def contains(tag):
-            return tag == (0x0028, 0x0008)
+            return tag in ((0x0028, 0x0008), "PixelData")
         fake_ds.__contains__.side_effect = contains
 
-        with patch("dicom.dicom.pydicom.dcmread", return_value=fake_ds):
+        with patch("pydicom.dcmread", return_value=fake_ds):
             dcm = dicom.DICOM(tmp_path, anonymous=False)
             dcm.processing()
 
         output_gif = tmp_path / "OUTPUT" / "test.gif"
         assert output_gif.exists()
+
+    def test_processing_workers(self, tmp_path):
+        serial = tmp_path / "serial"
+        parallel = tmp_path / "parallel"
+        for root in (serial, parallel):
+            for i, name in enumerate(["1-1.dcm", "1-2.dcm", "1-3.dcm"], start=1):
+                folder = root / f"Paziente{i}"
+                folder.mkdir(parents=True)
+                shutil.copy(f"tests/Data/DICOM_{i}/DICOM/{name}", folder)
+
+        assert dicom.DICOM(serial, anonymous=True).processing() == {}
+        assert dicom.DICOM(parallel, anonymous=True, workers=2).processing() == {}
+
+        for i, name in enumerate(["1-1", "1-2", "1-3"], start=1):
+            out_s = serial / f"Paziente{i}" / "OUTPUT"
+            out_p = parallel / f"Paziente{i}" / "OUTPUT"
+            assert sorted(p.name for p in out_s.iterdir()) == sorted(p.name for p in out_p.iterdir())
+            for ext in ("jpg", "txt"):
+                assert (out_s / f"{name}.{ext}").read_bytes() == (out_p / f"{name}.{ext}").read_bytes()
+
+    def test_index_update_and_query(self, tmp_path):
+        root = tmp_path / "tree"
+        for i in range(1, 4):
+            folder = root / f"Paziente{i}"
+            folder.mkdir(parents=True)
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", folder)
+        (root / "Paziente1" / "OUTPUT").mkdir()
+        shutil.copy("tests/Data/DICOM_4/DICOM/1-4.dcm", root / "Paziente1" / "OUTPUT")
+
+        with Index(tmp_path / "index.db") as index:
+            assert index.update(root) == {"added": 3, "updated": 0, "removed": 0,
+                                          "unchanged": 0, "errors": 0}
+            rows = index.query(["PatientID=LiverUS-01", "InstanceNumber>=512"],
+                               columns=["path", "InstanceNumber", "frames", "Modality"])
+            assert rows == [{"path": str(root / "Paziente3" / "1-3.dcm"), "InstanceNumber": 512,
+                             "frames": 1, "Modality": "US"}]
+            assert len(index.paths(["PatientName~*"])) == 3
+
+            with open(root / "Paziente2" / "1-2.dcm", "ab") as f:
+                f.write(b"\0\0")
+            (root / "Paziente3" / "1-3.dcm").unlink()
+            with patch("pydicom.dcmread", wraps=pydicom.dcmread) as spy:
+                assert index.update(root) == {"added": 0, "updated": 1, "removed": 1,
+                                              "unchanged": 1, "errors": 0}
+            assert spy.call_count == 1
+            assert index.paths(["Modality=US"]) == [str(root / "Paziente1" / "1-1.dcm"),
+                                                    str(root / "Paziente2" / "1-2.dcm")]
+
+        with Index(tmp_path / "index.db") as index:
+            assert len(index.paths()) == 2
+
+            # A file deleted between the scan and its stat is removed, not an error
+            def discover_then_delete(path):
+                paths = discovery.discover(path)
+                (root / "Paziente2" / "1-2.dcm").unlink()
+                return paths
+
+            with patch("dicom.index.discover", side_effect=discover_then_delete):
+                assert index.update(root) == {"added": 0, "updated": 0, "removed": 1,
+                                              "unchanged": 1, "errors": 0}
+            assert index.paths() == [str(root / "Paziente1" / "1-1.dcm")]
+
+    @pytest.mark.parametrize("workers", [1, 4])
+    def test_discovery_magic_and_lazy_output(self, tmp_path, workers):
+        for i in range(1, 4):
+            folder = tmp_path / f"Paziente{i}" / "Serie"
+            folder.mkdir(parents=True)
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", folder / f"IM{i:04d}")
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path / "Paziente1")
+        (tmp_path / "Paziente1" / "notes.txt").write_text("not a DICOM file")
+        (tmp_path / "Paziente1" / "short").write_bytes(b"DICM")
+        (tmp_path / "Vuota").mkdir()
+        (tmp_path / "Paziente2" / "OUTPUT").mkdir()
+        shutil.copy("tests/Data/DICOM_2/DICOM/1-2.dcm", tmp_path / "Paziente2" / "OUTPUT" / "IM9")
+
+        expected = [str(tmp_path / "Paziente1" / "1-1.dcm")] + [
+            str(tmp_path / f"Paziente{i}" / "Serie" / f"IM{i:04d}") for i in range(1, 4)]
+        assert discovery.discover(tmp_path, workers=workers) == expected
+        assert discovery.discover(tmp_path, workers=workers, sniff=False) == expected[:1]
+
+        dicom.DICOM(tmp_path, anonymous=False, formats=("png", "txt"),
+                    scan_workers=workers).processing()
+        assert sorted(p.name for p in (tmp_path / "Paziente3" / "Serie" / "OUTPUT").iterdir()) == [
+            ".manifest.json", "IM0003.png", "IM0003.txt"]
+        # No OUTPUT directory where there is nothing to write
+        assert not (tmp_path / "OUTPUT").exists()
+        assert not (tmp_path / "Vuota" / "OUTPUT").exists()
+        assert not (tmp_path / "Paziente2" / "OUTPUT" / "OUTPUT").exists()
+
+    def test_processing_output_root(self, tmp_path):
+        source = tmp_path / "in"
+        for i in range(1, 3):
+            (source / f"Paziente{i}").mkdir(parents=True)
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", source / f"Paziente{i}")
+
+        dicom.DICOM(source, anonymous=True, formats=("txt",),
+                    output_root=tmp_path / "out").processing()
+        assert sorted(str(p.relative_to(tmp_path / "out")) for p in (tmp_path / "out").rglob("*")) == [
+            "Paziente1", "Paziente1/.manifest.json", "Paziente1/1-1.txt", "Paziente1/ANONYMUS_1-1.dcm",
+            "Paziente2", "Paziente2/.manifest.json", "Paziente2/1-2.txt", "Paziente2/ANONYMUS_1-2.dcm"]
+        assert not list(source.rglob("OUTPUT"))
+
+        with pytest.raises(ValueError):
+            dicom.DICOM(source, anonymous=False, output_root=source / "out")
+
+    @pytest.mark.parametrize("archive_format, group, workers", [
+        ("zip", "patient", 1), ("zip", "run", 2), ("tar", "run", 1)])
+    def test_processing_archive(self, tmp_path, archive_format, group, workers):
+        import tarfile
+        import zipfile
+        from dicom.archive import ArchiveSink
+
+        for i in range(1, 3):
+            (tmp_path / f"Paziente{i}").mkdir()
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", tmp_path / f"Paziente{i}")
+        shutil.copy("tests/Data/DICOM_3/DICOM/1-3.dcm", tmp_path)
+
+        with ArchiveSink(tmp_path, archive_format, group) as archive:
+            errors = dicom.DICOM(tmp_path, anonymous=False, workers=workers,
+                                 formats=("png", "txt"), archive=archive).processing()
+        assert errors == {}
+        assert not list(tmp_path.rglob("OUTPUT"))
+
+        def members(name):
+            path = tmp_path / f"{name}.{archive_format}"
+            if archive_format == "zip":
+                with zipfile.ZipFile(path) as f:
+                    return {info.filename: f.read(info) for info in f.infolist()}
+            with tarfile.open(path) as f:
+                return {info.name: f.extractfile(info).read() for info in f.getmembers()}
+
+        if group == "patient":
+            assert sorted(members("Paziente1")) == ["OUTPUT/1-1.png", "OUTPUT/1-1.txt"]
+            assert sorted(members("OUTPUT")) == ["1-3.png", "1-3.txt"]
+            png = members("Paziente1")["OUTPUT/1-1.png"]
+        else:
+            assert sorted(members("OUTPUT")) == [
+                "OUTPUT/1-3.png", "OUTPUT/1-3.txt", "Paziente1/OUTPUT/1-1.png",
+                "Paziente1/OUTPUT/1-1.txt", "Paziente2/OUTPUT/1-2.png", "Paziente2/OUTPUT/1-2.txt"]
+            png = members("OUTPUT")["Paziente1/OUTPUT/1-1.png"]
+        assert np.array_equal(np.array(Image.open(io.BytesIO(png))),
+                              api.to_array(tmp_path / "Paziente1" / "1-1.dcm"))
+        assert not list(tmp_path.glob("*.tmp"))
+
+    @pytest.mark.parametrize("by", ["file", "patient"])
+    def test_sharding_hash(self, tmp_path, by):
+        paths = [str(tmp_path / f"P{p}" / f"S{s}" / f"IM{i}") for p in range(40)
+                 for s in range(3) for i in range(5)]
+        shards = [sharding.select(paths, tmp_path, (i, 4), by) for i in range(4)]
+        assert sorted(sum(shards, [])) == sorted(paths)
+        assert all(shards)
+        # The assignment depends on the relative path only
+        moved = [path.replace(str(tmp_path), "/mnt/elsewhere") for path in shards[2]]
+        assert sharding.select(moved, "/mnt/elsewhere", (2, 4), by) == moved
+        if by == "patient":
+            patients = [{Path(path).parts[-3] for path in shard} for shard in shards]
+            assert sum(len(p) for p in patients) == 40
+
+    @pytest.mark.parametrize("value", ["1", "3/3", "-1/2", "a/b", "0/0"])
+    def test_sharding_invalid(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            sharding.parse_shard(value)
+
+    def test_sharding_worklist(self, tmp_path):
+        sizes = {f"/data/P{i}/IM{j}": (i + 1) * 1000 + j for i in range(7) for j in range(3)}
+        assignment = sharding.balance(sizes, "/data", 3, by="patient")
+        volumes = [sum(size for path, size in sizes.items() if assignment[path] == i)
+                   for i in range(3)]
+        assert max(volumes) - min(volumes) <= 7 * 1000 + 3
+        assert all(len({assignment[f"/data/P{i}/IM{j}"] for j in range(3)}) == 1 for i in range(7))
+
+        source = tmp_path / "a"
+        for i in range(1, 5):
+            (source / f"P{i}").mkdir(parents=True)
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", source / f"P{i}" / "IM1")
+        volumes = sharding.write_worklist(tmp_path / "worklist.json", source, 2)
+        assert sum(volumes) == sum(p.stat().st_size for p in source.rglob("IM1"))
+
+        # The list is relative: it works where the tree is mounted elsewhere
+        shutil.move(source, tmp_path / "b")
+        files = [sharding.read_worklist(tmp_path / "worklist.json", tmp_path / "b", (i, 2))
+                 for i in range(2)]
+        assert sorted(files[0] + files[1]) == sorted(str(p) for p in (tmp_path / "b").rglob("IM1"))
+        with pytest.raises(ValueError):
+            sharding.read_worklist(tmp_path / "worklist.json", tmp_path / "b", (0, 3))
+
+    def test_watch_settle_and_backpressure(self, tmp_path):
+        import threading
+        import time
+        from dicom.watch import Watcher
+
+        def wait_for(condition, timeout=20):
+            deadline = time.monotonic() + timeout
+            while not condition():
+                assert time.monotonic() < deadline
+                time.sleep(0.05)
+
+        processor = dicom.DICOM(tmp_path, anonymous=False, formats=("txt",))
+        watcher = Watcher(processor, interval=0.05, settle=0.3, batch=2, max_pending=1)
+        with patch.object(processor, "processing", wraps=processor.processing) as processing:
+            thread = threading.Thread(target=watcher.run)
+            thread.start()
+            try:
+                # A file still being written is not processed before it settles
+                data = Path("tests/Data/DICOM_1/DICOM/1-1.dcm").read_bytes()
+                (tmp_path / "spool").mkdir()
+                with open(tmp_path / "spool" / "IM1", "wb") as f:
+                    f.write(data[:len(data) // 2])
+                    f.flush()
+                    time.sleep(0.2)
+                    f.write(data[len(data) // 2:])
+                wait_for(lambda: (tmp_path / "spool" / "OUTPUT" / "IM1.txt").exists())
+                assert processing.call_count == 1
+
+                # A burst, copied under temporary names and renamed
+                for i in range(5):
+                    shutil.copy("tests/Data/DICOM_2/DICOM/1-2.dcm", tmp_path / "spool" / f"B{i}.part")
+                    (tmp_path / "spool" / f"B{i}.part").rename(tmp_path / "spool" / f"B{i}")
+                wait_for(lambda: len(list((tmp_path / "spool" / "OUTPUT").glob("*.txt"))) == 6)
+            finally:
+                watcher.stop()
+                thread.join()
+
+        assert watcher.stats["processed"] == 6 and watcher.stats["errors"] == 0
+        assert processing.call_count >= 3 # at most batch files per call
+        assert "Pixel Data" in (tmp_path / "spool" / "OUTPUT" / "IM1.txt").read_text()
+
+    def test_watch_access_errors(self, tmp_path):
+        import time
+        from dicom import watch
+
+        (tmp_path / "locked").mkdir()
+        (tmp_path / "open").mkdir()
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path / "open" / "IM1")
+        scandir = os.scandir
+
+        def failing_scandir(path):
+            if os.path.basename(path) == "locked":
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        watcher = watch.Watcher(dicom.DICOM(tmp_path, anonymous=False), interval=0.05, settle=0)
+        with patch("dicom.watch.os.scandir", failing_scandir), \
+             patch("dicom.watch.time.time", return_value=time.time() + 10):
+            settled = []
+            for _ in range(4):
+                settled += watcher.poll()
+        assert settled == [str(tmp_path / "open" / "IM1")]
+        assert str(tmp_path / "locked") in watcher._failing
+
+        # An unexpected error in the poller stops run instead of leaving it idle
+        with patch.object(watcher, "poll", side_effect=RuntimeError("boom")):
+            with pytest.raises(RuntimeError, match="boom"):
+                watcher.run()
+
+    @pytest.mark.parametrize("condition", ["Modality", "Unknown=1", "Rows>big", "path;drop=1"])
+    def test_index_invalid_condition(self, condition):
+        with pytest.raises(ValueError):
+            parse_condition(condition)
+
+    def test_processing_files_from_index(self, tmp_path):
+        for i in range(1, 3):
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", tmp_path)
+        with Index(tmp_path / "index.db") as index:
+            index.update(tmp_path)
+            files = index.paths(["PatientID=LiverUS-01"])
+
+        dicom.DICOM(tmp_path, anonymous=False, formats=("txt",), files=files).processing()
+        assert sorted(p.name for p in (tmp_path / "OUTPUT").glob("*.txt")) == ["1-2.txt"]
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_processing_metadata_export(self, tmp_path, workers):
+        for i in range(1, 4):
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", tmp_path)
+        tags = ("PatientID", "InstanceNumber", "0028,0030", "ImageType", "SeriesDescription")
+
+        with MetadataExport(tmp_path / "meta.jsonl", tags, buffer_rows=2) as export:
+            dicom.DICOM(tmp_path, anonymous=True, workers=workers, formats=(),
+                        export=export).processing()
+        rows = [json.loads(line) for line in (tmp_path / "meta.jsonl").read_text().splitlines()]
+        assert sorted(row["path"] for row in rows) == [f"{tmp_path}/1-{i}.dcm" for i in range(1, 4)]
+        assert all(list(row) == ["path", "PatientID", "InstanceNumber", "PixelSpacing",
+                                 "ImageType", "SeriesDescription"] for row in rows)
+        row = next(row for row in rows if row["path"].endswith("1-2.dcm"))
+        assert row["PatientID"] == "Anonymous"
+        assert row["InstanceNumber"] == 256
+        assert row["ImageType"][:2] == ["ORIGINAL", "PRIMARY"]
+        assert row["SeriesDescription"] is None
+        assert not list((tmp_path / "OUTPUT").glob("*.txt"))
+
+        # Files skipped by the manifest are still exported, from their header
+        with MetadataExport(tmp_path / "meta.csv", tags) as export:
+            dicom.DICOM(tmp_path, anonymous=True, formats=(), export=export).processing()
+        lines = (tmp_path / "meta.csv").read_text().splitlines()
+        assert lines[0] == "path,PatientID,InstanceNumber,PixelSpacing,ImageType,SeriesDescription"
+        assert len(lines) == 4
+        assert any("Anonymous,256,,ORIGINAL\\PRIMARY\\" in line for line in lines)
+
+    @pytest.mark.parametrize("tag", ["PixelData", "7FE0,0010", "ReferencedImageSequence",
+                                     "NotAKeyword", "zz,10"])
+    def test_metadata_export_invalid_tag(self, tag):
+        with pytest.raises(ValueError):
+            parse_tag(tag)
+
+    def test_api_in_memory(self, tmp_path):
+        source = Path("tests/Data/DICOM_2/DICOM/1-2.dcm")
+        data = source.read_bytes()
+        shutil.copy(source, tmp_path)
+        dicom.DICOM(tmp_path, anonymous=False, formats=("png",)).processing()
+        expected = np.array(Image.open(tmp_path / "OUTPUT" / "1-2.png"))
+
+        image = api.to_array(data)
+        assert np.array_equal(image, expected)
+        assert np.array_equal(api.to_array(io.BytesIO(data)), image)
+        assert np.array_equal(np.array(Image.open(io.BytesIO(api.encode(data, "png")))), image)
+        assert api.encode(image, "jpg")[:2] == b"\xff\xd8"
+        assert [frame.shape for frame in api.iter_frames(data)] == [image.shape]
+
+        anonymous = pydicom.dcmread(io.BytesIO(api.anonymize(data)))
+        assert anonymous.PatientName == "Anonymous"
+        assert anonymous.PixelData == pydicom.dcmread(source).PixelData
+
+        gray = image if image.ndim == 2 else np.array(Image.fromarray(image).convert("L"))
+        assert api.ssim(image, image) == pytest.approx(1.0)
+        assert api.ssim(gray, 255 - gray) == pytest.approx(ssim(gray, 255 - gray))
+        assert api.ssim(gray, gray, fast=True, tile=64) == pytest.approx(1.0)
+        with pytest.raises(ValueError):
+            api.ssim(gray, gray[:-1])
+        assert not list(tmp_path.glob("*.png"))
+
+    def test_api_multiframe_and_tree(self, tmp_path):
+        pixels = np.arange(3 * 16 * 16, dtype=np.uint16).reshape(3, 16, 16)
+        (tmp_path / "a").mkdir()
+        write_multiframe(tmp_path / "a" / "cine.dcm", pixels)
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path / "a")
+        (tmp_path / "a" / "OUTPUT").mkdir()
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path / "a" / "OUTPUT")
+        (tmp_path / "a" / "broken.dcm").write_text("FAKE DICOM CONTENT")
+
+        gif = Image.open(io.BytesIO(api.encode(tmp_path / "a" / "cine.dcm", "png")))
+        assert gif.format == "GIF" and gif.n_frames == 3
+
+        with patch("dicom.api.load", wraps=api.load) as spy:
+            results = api.iter_tree(tmp_path, formats=("gif", "dcm"), anonymous=True)
+            assert spy.call_count == 0
+            first = next(results)
+            assert spy.call_count == 1
+            results = [first, *results]
+
+        assert [Path(r.path).name for r in results] == ["1-1.dcm", "broken.dcm", "cine.dcm"]
+        assert results[0].image.shape == api.to_array(tmp_path / "a" / "1-1.dcm").shape
+        assert pydicom.dcmread(io.BytesIO(results[0].encoded["dcm"])).PatientID == "Anonymous"
+        assert results[1].error is not None and results[1].image is None
+        assert results[2].image.shape == (3, 16, 16)
+        assert Image.open(io.BytesIO(results[2].encoded["gif"])).n_frames == 3
+
+    def test_pipeline_run(self):
+        written = []
+
+        def read(item):
+            if item == 3:
+                raise OSError("unreadable")
+            return item * 10
+
+        def render(item, data):
+            if item == 4:
+                raise ValueError("bad pixels")
+            return [data, data + 1]
+
+        def write(task):
+            written.append(task)
+            return task
+
+        results, errors = pipeline.run(range(6), read, render, write, prefetch=1, writers=2)
+        assert results == {0: [0, 1], 1: [10, 11], 2: [20, 21], 5: [50, 51]}
+        assert sorted(errors) == [3, 4]
+        assert isinstance(errors[3], OSError) and isinstance(errors[4], ValueError)
+        assert sorted(written) == [0, 1, 10, 11, 20, 21, 50, 51]
+        with pytest.raises(ValueError):
+            pipeline.run([], read, render, write, prefetch=0)
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_processing_metrics(self, tmp_path, workers):
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+        write_multiframe(tmp_path / "cine.dcm", np.zeros((3, 8, 8), dtype=np.uint8))
+        collector = Metrics()
+        dicom.DICOM(tmp_path, anonymous=True, workers=workers, metrics=collector).processing()
+
+        summary = collector.summary()
+        assert set(summary["stages"]) == {"digest", "read", "anonymize", "decode", "rescale",
+                                          "write-jpg", "write-png", "write-gif", "write-txt",
+                                          "write-dcm"}
+        assert summary["stages"]["read"]["count"] == 2
+        assert summary["stages"]["decode"]["frames"] == 4
+        cine = summary["items"][str(tmp_path / "cine.dcm")]
+        assert cine["bytes_read"] == (tmp_path / "cine.dcm").stat().st_size
+        assert cine["bytes_written"] == sum((tmp_path / "OUTPUT" / name).stat().st_size
+                                            for name in ["cine.gif", "cine.txt", "ANONYMUS_cine.dcm"])
+        assert cine["peak_rss_delta_mb"] >= 0 and cine["max_rss_delta_mb"] is not None
+        assert summary["process_peak_rss_mb"] > 0
+        assert summary["info"] == {"files": 2, "processed": 2, "errors": 0}
+
+        collector.write(tmp_path / "metrics.json")
+        assert json.loads((tmp_path / "metrics.json").read_text())["totals"] == summary["totals"]
+
+    def test_metrics_stage_memory(self):
+        collector = Metrics()
+        with collector.stage("allocate", "item"):
+            data = np.ones(64 << 20, dtype=np.uint8)
+        with collector.stage("free", "item"):
+            del data
+        allocate, free = collector.records
+        assert allocate["rss_delta_mb"] > 60 and free["rss_delta_mb"] < -60
+        assert allocate["peak_rss_delta_mb"] >= 0
+        summary = collector.summary()
+        assert summary["stages"]["allocate"]["max_rss_delta_mb"] == allocate["rss_delta_mb"]
+        assert summary["items"]["item"]["max_rss_delta_mb"] == allocate["rss_delta_mb"]
+
+    def test_compare_and_acquire_metrics(self, tmp_path):
+        collector = Metrics()
+        image = Path("tests/Data/Compare/1-1.jpg")
+        dicom.compare_image(image, image, metrics=collector)
+        similarity.compare_batch([(image, image)], metrics=collector)
+        capture.acquire_sequence("tests/Data/Acquire/Image1.wmv", tmp_path, frames=3,
+                                 metrics=collector)
+
+        stages = collector.summary()["stages"]
+        assert stages["decode"]["count"] == 3
+        assert stages["decode"]["bytes_read"] == 3 * image.stat().st_size
+        assert stages["ssim"]["count"] == 2
+        assert stages["capture"]["frames"] == stages["write"]["frames"] == 3
+        assert stages["write"]["bytes_written"] == sum(p.stat().st_size for p in tmp_path.iterdir())
+        assert collector.summary()["info"]["written"] == 3
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_processing_collects_errors(self, tmp_path, workers):
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+        (tmp_path / "broken.dcm").write_text("FAKE DICOM CONTENT")
+
+        errors = dicom.DICOM(tmp_path, anonymous=False, workers=workers).processing()
+
+        assert list(errors) == [f"{tmp_path}/broken.dcm"]
+        assert (tmp_path / "OUTPUT" / "1-1.jpg").exists()
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_processing_without_pixel_data(self, tmp_path, workers):
+        write_multiframe(tmp_path / "cine.dcm", np.zeros((2, 8, 8), dtype=np.uint8))
+        ds = pydicom.dcmread(tmp_path / "cine.dcm")
+        # A structured report exported without suffix, found by its content
+        for keyword in ("NumberOfFrames", "FrameTime", "Rows", "Columns", "SamplesPerPixel",
+                        "PhotometricInterpretation", "BitsAllocated", "BitsStored", "HighBit",
+                        "PixelRepresentation", "PixelData"):
+            delattr(ds, keyword)
+        ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.88.11"
+        ds.Modality = "SR"
+        ds.save_as(str(tmp_path / "REPORT"), write_like_original=False)
+
+        errors = dicom.DICOM(tmp_path, anonymous=True, workers=workers).processing()
+        assert errors == {}
+        assert sorted(p.name for p in (tmp_path / "OUTPUT").iterdir()) == [
+            ".manifest.json", "ANONYMUS_REPORT", "ANONYMUS_cine.dcm", "REPORT.txt", "cine.gif",
+            "cine.txt"]
+        anonymized = pydicom.dcmread(tmp_path / "OUTPUT" / "ANONYMUS_REPORT")
+        assert anonymized.PatientName == "Anonymous" and "PixelData" not in anonymized
+        manifest = json.loads((tmp_path / "OUTPUT" / ".manifest.json").read_text())
+        assert manifest["REPORT"]["outputs"] == ["ANONYMUS_REPORT", "REPORT.txt"]
+
+        dcm = dicom.DICOM(tmp_path, anonymous=True, workers=workers)
+        with patch.object(dcm, "_read", wraps=dcm._read) as spy:
+            dcm.processing()
+        assert spy.call_count == 0
+
+    def test_invalid_workers(self, tmp_path):
+        with pytest.raises(ValueError):
+            dicom.DICOM(tmp_path, anonymous=False, workers=0)
+
+    def test_processing_incremental(self, tmp_path):
+        dicom_file = tmp_path / "1-1.dcm"
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", dicom_file)
+        dicom.DICOM(tmp_path, anonymous=False).processing()
+        assert (tmp_path / "OUTPUT" / ".manifest.json").exists()
+
+        def processed(**options):
+            dcm = dicom.DICOM(tmp_path, **options)
+            with patch.object(dcm, "_read", wraps=dcm._read) as spy:
+                dcm.processing()
+            return spy.call_count
+
+        assert processed(anonymous=False) == 0
+        os.utime(dicom_file, ns=(0, 0)) # same content, different mtime
+        assert processed(anonymous=False) == 0
+        assert processed(anonymous=False, force=True) == 1
+        assert processed(anonymous=True) == 1
+        (tmp_path / "OUTPUT" / "1-1.jpg").unlink()
+        assert processed(anonymous=True) == 1
+        with open(dicom_file, "ab") as f:
+            f.write(b"\0\0")
+        assert processed(anonymous=True) == 1
+        assert processed(anonymous=True) == 0
+
+    def test_processing_formats(self, tmp_path):
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+
+        with patch.object(IntensityMapper, "apply", autospec=True,
+                          side_effect=IntensityMapper.apply) as spy:
+            dicom.DICOM(tmp_path, anonymous=False, formats=("jpg", "png")).processing()
+
+        assert spy.call_count == 1
+        outputs = sorted(p.name for p in (tmp_path / "OUTPUT").iterdir() if not p.name.startswith("."))
+        assert outputs == ["1-1.jpg", "1-1.png"]
+
+    def test_processing_formats_without_pixels(self, tmp_path):
+        shutil.copy("tests/Data/DICOM_1/DICOM/1-1.dcm", tmp_path)
+
+        with patch.object(IntensityMapper, "apply") as spy:
+            dicom.DICOM(tmp_path, anonymous=False, formats=("txt", "gif")).processing()
+
+        spy.assert_not_called()
+        assert (tmp_path / "OUTPUT" / "1-1.txt").exists()
+        assert not (tmp_path / "OUTPUT" / "1-1.jpg").exists()
+
+    @pytest.mark.parametrize(
+        "value, expected",
+        [("jpg,txt", ("jpg", "txt")), (" GIF , png ", ("gif", "png"))]
+    )
+    def test_parse_formats(self, value, expected):
+        assert dicom.parse_formats(value) == expected
+
+    @pytest.mark.parametrize("value", ["", "jpg,bmp"])
+    def test_parse_formats_invalid(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            dicom.parse_formats(value)
+
+    def test_processing_header_only(self, tmp_path):
+        full = tmp_path / "full"
+        header = tmp_path / "header"
+        for root in (full, header):
+            root.mkdir()
+            shutil.copy("tests/Data/DICOM_4/DICOM/1-4.dcm", root)
+
+        dicom.DICOM(full, anonymous=True).processing()
+        with patch("pydicom.dcmread", wraps=pydicom.dcmread) as spy:
+            dicom.DICOM(header, anonymous=True, formats=("txt",)).processing()
+
+        assert spy.call_args.kwargs == {"stop_before_pixels": True}
+        anon_full = (full / "OUTPUT" / "ANONYMUS_1-4.dcm").read_bytes()
+        anon_header = (header / "OUTPUT" / "ANONYMUS_1-4.dcm").read_bytes()
+        assert anon_header == anon_full
+        info = (header / "OUTPUT" / "1-4.txt").read_text(encoding="utf-8")
+        assert "Patient's Name                      PN: 'Anonymous'" in info
+        assert "(7FE0,0010)" not in info
+
+    def test_processing_gif_streaming(self, tmp_path):
+        rng = np.random.default_rng(0)
+        pixels = rng.integers(0, 4096, size=(5, 32, 48), dtype=np.uint16)
+        write_multiframe(tmp_path / "cine.dcm", pixels, frame_time=40.0)
+
+        with patch.object(pydicom.dataset.Dataset, "pixel_array",
+                          new_callable=PropertyMock) as pixel_array:
+            dicom.DICOM(tmp_path, anonymous=False, formats=("gif",)).processing()
+        pixel_array.assert_not_called()
+
+        expected = np.uint8(np.maximum(pixels.astype(float), 0) / pixels.max() * 255)
+        gif = Image.open(tmp_path / "OUTPUT" / "cine.gif")
+        assert gif.n_frames == len(pixels)
+        for i, frame in enumerate(ImageSequence.Iterator(gif)):
+            assert frame.info["duration"] == 40
+            assert np.array_equal(np.array(frame.convert("L")), expected[i])
+
+    @pytest.mark.parametrize("syntax", ["1.2.840.10008.1.2", "1.2.840.10008.1.2.1"])
+    def test_processing_mapped_pixel_data(self, tmp_path, monkeypatch, syntax):
+        pixels = np.random.default_rng(0).integers(0, 4096, size=(4, 30, 40), dtype=np.uint16)
+        source = write_multiframe(tmp_path / "cine.dcm", pixels)
+        ds = pydicom.dcmread(source)
+        ds.add_new(0x7FE10010, "LO", "TAIL") # element after the Pixel Data
+        ds.file_meta.TransferSyntaxUID = syntax
+        ds.is_implicit_VR = syntax == "1.2.840.10008.1.2"
+        ds.save_as(str(source), write_like_original=False)
+
+        processor = dicom.DICOM(tmp_path, anonymous=True, formats=("gif",))
+        mapped, pixel_offset = processor._read({"dicom": str(source)})
+        assert pixel_offset is not None and mapped[0x7FE10010].value == "TAIL"
+        context = dicom.RenderContext(mapped)
+        assert np.array_equal(context.pixels, pixels)
+        #The pages released after the first pass are read again from the file
+        assert all(np.array_equal(a, b) for a, b in zip(context.frames(), context.frames()))
+        #Without madvise (e.g. Windows) the frames are the same, the pages are kept
+        import mmap
+        frames = list(context.frames())
+        monkeypatch.delattr(mmap, "MADV_DONTNEED")
+        assert all(np.array_equal(a, b) for a, b in zip(context.frames(), frames))
+        monkeypatch.undo()
+
+        processor.processing()
+        anonymized = pydicom.dcmread(tmp_path / "OUTPUT" / "ANONYMUS_cine.dcm")
+        assert anonymized.PatientName == "Anonymous"
+        assert anonymized.PixelData == pixels.tobytes()
+        assert anonymized[0x7FE10010].value == "TAIL"
+        assert Image.open(tmp_path / "OUTPUT" / "cine.gif").n_frames == 4
+
+    def test_processing_cine_formats(self, tmp_path):
+        import cv2
+
+        pixels = np.random.default_rng(0).integers(0, 256, size=(5, 31, 47), dtype=np.uint8)
+        write_multiframe(tmp_path / "cine.dcm", pixels, frame_time=80.0)
+        dicom.DICOM(tmp_path, anonymous=False, formats=("mp4", "webp", "png")).processing()
+        assert sorted(p.name for p in (tmp_path / "OUTPUT").iterdir()) == [
+            ".manifest.json", "cine.mp4", "cine.webp"]
+
+        video = cv2.VideoCapture(str(tmp_path / "OUTPUT" / "cine.mp4"))
+        assert video.get(cv2.CAP_PROP_FPS) == pytest.approx(12.5)
+        assert video.get(cv2.CAP_PROP_FRAME_COUNT) == 5
+        ok, frame = video.read()
+        video.release()
+        assert ok and frame.shape == (32, 48, 3)
+
+        webp = Image.open(tmp_path / "OUTPUT" / "cine.webp")
+        assert webp.n_frames == 5
+        webp.load()
+        assert webp.info["duration"] == 80
+
+        encoded = api.encode(tmp_path / "cine.dcm", "webp")
+        assert Image.open(io.BytesIO(encoded)).n_frames == 5
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_processing_render_cache(self, tmp_path, workers):
+        pixels = np.random.default_rng(0).integers(0, 4096, size=(3, 16, 24), dtype=np.uint16)
+        for patient in ("A", "B"):
+            (tmp_path / "in" / patient).mkdir(parents=True)
+            write_multiframe(tmp_path / "in" / patient / "cine.dcm", pixels)
+            write_multiframe(tmp_path / "in" / patient / "frame.dcm", pixels[:1])
+        ds = pydicom.dcmread(tmp_path / "in/B/frame.dcm")
+        del ds.NumberOfFrames
+        ds.PatientName = "Other^Patient"
+        ds.save_as(tmp_path / "in/B/frame.dcm")
+        render_cache = cache.RenderCache(tmp_path / "cache")
+        scans = tmp_path / "scans.log"
+        scans.touch()
+        scan = cache.RenderCache._scan
+
+        def counted_scan(self):
+            # Logged to a file, so that the scans of the worker processes are counted too
+            with open(scans, "a", encoding="utf-8") as f:
+                f.write("scan\n")
+            return scan(self)
+
+        def run(folder, **options):
+            metrics = Metrics()
+            before = len(scans.read_text().splitlines())
+            with patch.object(cache.RenderCache, "_scan", counted_scan):
+                dicom.DICOM(tmp_path / "in" / folder, anonymous=False,
+                            formats=("gif", "jpg", "png"), metrics=metrics, cache=render_cache,
+                            workers=workers, **options).processing()
+            # The size of the cache is scanned at most once per process, not once per file
+            assert len(scans.read_text().splitlines()) - before <= workers
+            return {r["stage"] for r in metrics.records}
+
+        first = run("A")
+        assert "write-gif" in first and "cache-gif" not in first
+        assert render_cache.stats == {"hits": 0, "misses": 2, "stored": 2, "evicted": 0}
+        second = run("B")
+        assert "decode" in second # frame.dcm is single-frame in B, a different rendering
+        assert render_cache.stats["hits"] == 1 and render_cache.stats["stored"] == 4
+
+        # A third copy of cine.dcm under another patient is linked, not decoded
+        (tmp_path / "in/C").mkdir()
+        shutil.copy(tmp_path / "in/A/cine.dcm", tmp_path / "in/C/cine.dcm")
+        third = run("C")
+        assert "decode" not in third and "cache-gif" in third
+        output = tmp_path / "in/C/OUTPUT/cine.gif"
+        assert output.read_bytes() == (tmp_path / "in/A/OUTPUT/cine.gif").read_bytes()
+        key = render_cache.key(pydicom.dcmread(tmp_path / "in/C/cine.dcm"), {
+            "png_mode": "pixels", "intensity": "minmax", "percentiles": [0.5, 99.5]})
+        assert os.path.samefile(output, render_cache.entry(key, "gif"))
+
+        # Writing the output again replaces the link instead of truncating the entry
+        entry = Path(render_cache.entry(key, "gif")).read_bytes()
+        run("C", force=True, intensity="percentile")
+        assert not os.path.samefile(output, render_cache.entry(key, "gif"))
+        assert Path(render_cache.entry(key, "gif")).read_bytes() == entry
+
+        # The same hit feeds an archive
+        import zipfile
+        from dicom.archive import ArchiveSink
+
+        with ArchiveSink(tmp_path / "in/C", "zip") as sink:
+            run("C", archive=sink)
+        with zipfile.ZipFile(tmp_path / "in/C/OUTPUT.zip") as archive:
+            assert archive.read("OUTPUT/cine.gif") == entry
+
+        # More files than workers still scan the cache once per process
+        (tmp_path / "in/D").mkdir()
+        for number in range(5):
+            write_multiframe(tmp_path / "in/D" / f"cine{number}.dcm", pixels + number + 1)
+        stored = render_cache.stats["stored"]
+        assert "cache-gif" not in run("D")
+        assert render_cache.stats["stored"] == stored + 5
+
+    def test_render_cache_eviction(self, tmp_path):
+        render_cache = cache.RenderCache(tmp_path, max_bytes=1000)
+        for number in range(3):
+            render_cache.store(f"{number:02d}" * 20, "jpg", data=bytes(300))
+            os.utime(render_cache.entry(f"{number:02d}" * 20, "jpg"), (number, number))
+        assert render_cache.size() == 900
+
+        # Storing an entry again replaces it: the size does not grow and nothing is evicted
+        for _ in range(3):
+            render_cache.store("02" * 20, "jpg", data=bytes(300))
+        assert render_cache.stats["evicted"] == 0
+
+        hit = render_cache.lookup("00" * 20, "jpg") # the oldest becomes the most recent
+        render_cache.store("03" * 20, "jpg", data=bytes(300))
+        # 1200 bytes > 1000: the least recently used entry goes, down to 900
+        assert render_cache.stats["evicted"] == 1
+        assert render_cache.size() == 900
+        assert render_cache.lookup("01" * 20, "jpg") is None
+        render_cache.lookup("02" * 20, "jpg").file.close()
+
+        # An entry evicted after its lookup is still restored from the open file
+        os.remove(hit.entry)
+        assert render_cache.restore(hit, str(tmp_path / "out.jpg")) == 300
+        assert (tmp_path / "out.jpg").read_bytes() == bytes(300)
+
+    @pytest.mark.parametrize("value, expected", [("512", 512), ("500M", 500 << 20),
+                                                 ("1.5g", 3 << 29), ("2TB", 2 << 40)])
+    def test_parse_size(self, value, expected):
+        assert cache.parse_size(value) == expected
+
+    @pytest.mark.parametrize("value", ["", "G", "-1", "0", "ten"])
+    def test_parse_size_invalid(self, value):
+        with pytest.raises(argparse.ArgumentTypeError):
+            cache.parse_size(value)
+
+    @pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+    def test_intensity_minmax_matches_legacy(self, dtype):
+        info = np.iinfo(dtype)
+        pixels = np.random.default_rng(1).integers(info.min, info.max, size=(3, 20, 30), dtype=dtype)
+        mapper = IntensityMapper({}).fit(pixels)
+
+        im = pixels.astype(float)
+        expected = np.uint8(np.maximum(im, 0) / im.max() * 255)
+        assert np.array_equal(mapper.apply(pixels), expected)
+        assert np.array_equal(np.stack([mapper.apply(f) for f in pixels]), expected)
+
+    def test_intensity_blank_frame(self):
+        pixels = np.zeros((8, 8), dtype=np.uint16)
+        mapper = IntensityMapper({}).fit([pixels])
+        assert not mapper.apply(pixels).any()
+
+    def test_intensity_window(self):
+        ds = {"RescaleSlope": 2, "RescaleIntercept": -100, "WindowCenter": [40, 80],
+              "WindowWidth": [401, 800]}
+        pixels = np.array([[0, 120, 170, 220]], dtype=np.int16) # -100, 140, 240, 340
+        mapper = IntensityMapper(ds, "window").fit([pixels])
+        assert mapper.apply(pixels).tolist() == [[39, 192, 255, 255]]
+
+    def test_intensity_window_missing(self):
+        mapper = IntensityMapper({}, "window")
+        assert mapper.strategy == "minmax"
+
+    def test_intensity_percentile(self):
+        pixels = np.arange(1000, dtype=np.uint16).reshape(10, 100)
+        pixels[0, 0] = 60000 # outlier
+        mapper = IntensityMapper({}, "percentile", (1, 99)).fit([pixels])
+        out = mapper.apply(pixels)
+        assert out[0, 0] == 255
+        assert out[0, 5] == 0
+        assert out[5, 0] == pytest.approx(127, abs=2)
+
+    def test_intensity_monochrome1(self):
+        ds = {"PhotometricInterpretation": "MONOCHROME1"}
+        pixels = np.array([[0, 255]], dtype=np.uint8)
+        mapper = IntensityMapper(ds, "percentile", (0, 100)).fit([pixels])
+        assert mapper.apply(pixels).tolist() == [[255, 0]]
+
+    def test_compare_batch_directories(self, tmp_path):
+        for folder, name in [("a", "1-1.jpg"), ("a", "1-2.jpg"), ("b", "1-1.jpg"), ("a/sub", "1-1.jpg")]:
+            (tmp_path / folder).mkdir(parents=True, exist_ok=True)
+            shutil.copy(f"tests/Data/Compare/{name}", tmp_path / folder)
+        shutil.copy("tests/Data/Compare/1-2.jpg", tmp_path / "b" / "1-2.jpg")
+
+        pairs = similarity.pairs_directories(tmp_path / "a", tmp_path / "b")
+        assert [p[0].name for p in pairs] == ["1-1.jpg", "1-2.jpg"]
+
+        rows = similarity.compare_batch(pairs, workers=2)
+        assert [row["score"] for row in rows] == pytest.approx([1.0, 1.0])
+
+    def test_compare_batch_releases_images(self, tmp_path):
+        reference = Path("tests/Data/Compare/1-1.jpg")
+        candidates = []
+        for i in range(4):
+            candidates.append(tmp_path / f"{i}.jpg")
+            shutil.copy("tests/Data/Compare/1-2.jpg", candidates[-1])
+        held = []
+
+        class RecordingCache(similarity.GrayscaleCache):
+            def get(self, path):
+                image = super().get(path)
+                held.append(sorted(self._images))
+                return image
+
+        with patch.object(similarity, "GrayscaleCache", RecordingCache):
+            rows = similarity.compare_batch(
+                similarity.pairs_one_to_many(reference, candidates), workers=1)
+        assert all(row["score"] is not None for row in rows)
+        # The reference stays until its last pair, each candidate goes after its pair
+        assert max(len(images) for images in held) == 2
+        assert all(str(reference) in images for images in held)
+
+    def test_compare_batch_one_to_many(self, tmp_path):
+        reference = Path("tests/Data/Compare/1-1.jpg")
+        candidates = [reference, Path("tests/Data/Compare/1-2.jpg"), tmp_path / "missing.png"]
+        cache = similarity.GrayscaleCache()
+
+        with patch("dicom.similarity.cv2.imread", wraps=similarity.cv2.imread) as imread:
+            rows = similarity.compare_batch(
+                similarity.pairs_one_to_many(reference, candidates), workers=3, cache=cache)
+
+        assert imread.call_count == 2
+        assert rows[0]["score"] == pytest.approx(1.0)
+        assert rows[1]["score"] == pytest.approx(dicom.compare_image(reference, candidates[1]))
+        assert rows[2]["score"] is None and rows[2]["error"]
+
+        similarity.write_scores(rows, tmp_path / "scores.json")
+        similarity.write_scores(rows, tmp_path / "scores.csv")
+        assert json.loads((tmp_path / "scores.json").read_text())[1]["score"] == rows[1]["score"]
+        assert len((tmp_path / "scores.csv").read_text().splitlines()) == 4
+
+    @pytest.mark.parametrize("tile", [64, 256, 1000])
+    def test_fast_ssim_exact(self, tile):
+        cache = similarity.GrayscaleCache()
+        image1 = cache.get(Path("tests/Data/Compare/1-1.jpg"))
+        image2 = cache.get(Path("tests/Data/Compare/1-2.jpg"))
+
+        result = similarity.fast_ssim(image1, image2, tile=tile)
+        assert result.score == pytest.approx(ssim(image1, image2), abs=1e-12)
+        assert result.ssim_map is None
+
+    def test_fast_ssim_downscale_and_threshold(self):
+        cache = similarity.GrayscaleCache()
+        image1 = cache.get(Path("tests/Data/Compare/1-1.jpg"))
+        image2 = cache.get(Path("tests/Data/Compare/1-2.jpg"))
+        exact = ssim(image1, image2)
+
+        # Difference from the exact SSIM on tests/Data/Compare: -0.022 at 512 px, -0.062 at 256 px
+        assert similarity.fast_ssim(image1, image2, max_side=512).score == pytest.approx(exact, abs=0.03)
+        assert similarity.fast_ssim(image1, image2, max_side=256).score == pytest.approx(exact, abs=0.07)
+
+        failed = similarity.fast_ssim(image1, image2, tile=64, threshold=0.95)
+        assert failed.passed is False and failed.high < 0.95
+        passed = similarity.fast_ssim(image1, image1, tile=64, threshold=0.5)
+        assert passed.passed is True and passed.low >= 0.5
+        assert passed.high > passed.low # stopped before the last tile
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_manifest_digest_from_read(self, tmp_path, workers):
+        from dicom import manifest
+
+        for i in range(1, 3):
+            shutil.copy(f"tests/Data/DICOM_{i}/DICOM/1-{i}.dcm", tmp_path)
+        with patch.object(manifest, "file_digest", wraps=manifest.file_digest) as digest:
+            dicom.DICOM(tmp_path, anonymous=False, formats=("txt",), workers=workers).processing()
+        # Hashed once per file while reading (in the workers: not seen here), never after
+        assert digest.call_count == (2 if workers == 1 else 0)
+        entries = json.loads((tmp_path / "OUTPUT" / ".manifest.json").read_text())
+        assert entries["1-1.dcm"]["sha256"] == manifest.file_digest(tmp_path / "1-1.dcm")
+        assert entries["1-2.dcm"]["size"] == os.path.getsize(tmp_path / "1-2.dcm")
+
+    def test_worker_copy_without_files(self, tmp_path):
+        import pickle
+
+        files = [str(tmp_path / f"{number:05d}.dcm") for number in range(20000)]
+        processor = dicom.DICOM(tmp_path, anonymous=False, files=files, metrics=Metrics())
+        job = processor._job(str(tmp_path), "00000.dcm")
+        size = len(pickle.dumps((processor._process_file_measured, job)))
+        assert size < 2000
+        assert processor.files == files
+        assert pickle.loads(pickle.dumps(processor)).files is None
+
+    def test_volume_sorted_by_position(self, tmp_path):
+        slices = [np.full((4, 5), value, dtype=np.int16) for value in range(5)]
+        # Positions along z in reverse order of the names, instance numbers shuffled
+        for number, value in enumerate(range(5)):
+            write_slice(tmp_path / f"s{4 - number}.dcm", slices[value],
+                        instance=(value * 3) % 5, position=(0, 0, 2.5 * value))
+        write_slice(tmp_path / "other.dcm", slices[0], series="1.2.3.2", instance=1)
+
+        stats = volume.assemble(tmp_path, tmp_path / "volumes")
+        assert stats["written"] == 2 and not stats["errors"]
+        array, sidecar = volume.open_volume(tmp_path / "volumes/1.2.3/1.2.3.1.npy")
+        assert isinstance(array, np.memmap)
+        assert array.shape == (5, 4, 5) and array.dtype == np.int16
+        assert array[:, 0, 0].tolist() == [0, 1, 2, 3, 4]
+        assert sidecar["order"] == "position"
+        assert sidecar["slice_spacing"] == pytest.approx(2.5)
+        assert [f["path"] for f in sidecar["files"]] == [f"s{4 - n}.dcm" for n in range(5)]
+
+        by_instance = volume.assemble(tmp_path, tmp_path / "instance", order="instance")
+        array, sidecar = volume.open_volume(tmp_path / "instance/1.2.3/1.2.3.1.npy")
+        assert by_instance["written"] == 2 and sidecar["order"] == "instance"
+        assert [f["instance"] for f in sidecar["files"]] == [0, 1, 2, 3, 4]
+
+        # Up to date until a file changes
+        assert volume.assemble(tmp_path, tmp_path / "volumes")["unchanged"] == 2
+        write_slice(tmp_path / "s0.dcm", slices[4] + 10, instance=2, position=(0, 0, 10))
+        stats = volume.assemble(tmp_path, tmp_path / "volumes")
+        assert stats["written"] == 1 and stats["unchanged"] == 1
+        assert volume.open_volume(tmp_path / "volumes/1.2.3/1.2.3.1.npy")[0][4, 0, 0] == 14
+
+    def test_volume_mixed_bit_depths(self, tmp_path):
+        write_slice(tmp_path / "a.dcm", np.full((4, 5), 200, dtype=np.uint8), instance=1)
+        write_slice(tmp_path / "b.dcm", np.full((4, 5), 1000, dtype=np.uint16), instance=2)
+        write_slice(tmp_path / "c.dcm", np.full((4, 5), -5, dtype=np.int16), instance=3)
+
+        stats = volume.assemble(tmp_path, tmp_path / "volumes", files=[
+            tmp_path / "a.dcm", tmp_path / "b.dcm"])
+        assert stats["written"] == 1 and not stats["errors"]
+        array, sidecar = volume.open_volume(tmp_path / "volumes/1.2.3/1.2.3.1.npy")
+        assert array.dtype == np.uint16 and sidecar["dtype"] == "<u2"
+        assert array[:, 0, 0].tolist() == [200, 1000]
+
+        volume.assemble(tmp_path, tmp_path / "volumes")
+        array, sidecar = volume.open_volume(tmp_path / "volumes/1.2.3/1.2.3.1.npy")
+        assert array.dtype == np.int32
+        assert array[:, 0, 0].tolist() == [200, 1000, -5]
+
+    def test_volume_errors(self, tmp_path):
+        write_slice(tmp_path / "a.dcm", np.zeros((4, 5), dtype=np.uint8), instance=1)
+        write_slice(tmp_path / "b.dcm", np.zeros((4, 6), dtype=np.uint8), instance=2)
+        (tmp_path / "broken.dcm").write_bytes(b"not a DICOM file")
+
+        stats = volume.assemble(tmp_path, tmp_path / "volumes")
+        assert stats["written"] == 0
+        assert set(stats["errors"]) == {str(tmp_path / "broken.dcm"), "1.2.3.1"}
+        assert "different sizes" in stats["errors"]["1.2.3.1"]
+        assert not list((tmp_path / "volumes").rglob("*.npy*"))
+        with pytest.raises(ValueError):
+            volume.sort_slices([volume.read_header(str(tmp_path / "a.dcm"))], "position")